@@ -0,0 +1,480 @@
+""" 性能基准测试
+
+SyntheticData 按会员数等比例生成一套可复现的测试数据（固定随机种子），
+Benchmark 对热点路径逐项计时并记录查询数，结果写入 JSON 后可以与其他提交的结果对比。
+由 manage.py benchmark 调用，在临时创建的测试数据库中运行。
+
+生成数据时尽量使用 bulk_create，不经过模型的 save()，避免调用腾讯云通讯等外部接口；
+礼物订单按实际送礼流程写入流水和钱包。
+"""
+import random
+import subprocess
+from datetime import datetime, timedelta
+from time import time
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection, transaction
+from django.test import Client
+from django.test.utils import CaptureQueriesContext
+
+from . import models as m
+
+USERNAME_PREFIX = 'bench_'
+
+CHUNK_SIZE = 1000
+
+
+def percentile(values, q):
+    """ 已排序数值的分位数（最近秩） """
+    if not values:
+        return 0
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def get_commit():
+    """ 当前代码的提交号，不在 git 仓库中时返回空字符串 """
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], stderr=subprocess.DEVNULL,
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ''
+
+
+class SyntheticData:
+    """ 合成测试数据
+    各类数据的数量按会员数等比例放大，相同的参数和随机种子生成相同的数据
+    """
+    # 每多少个会员中有一个主播
+    ANCHOR_RATIO = 10
+    # 每个主播的直播场数
+    LIVES_PER_ANCHOR = 5
+    # 正在直播的主播比例
+    LIVE_ACTIVE_RATIO = 0.2
+    # 每个会员追踪的人数
+    FOLLOWS_PER_MEMBER = 20
+    # 每个会员的联系人数
+    CONTACTS_PER_MEMBER = 5
+    # 每场直播的观众数
+    VIEWERS_PER_LIVE = 20
+    # 每条观看记录的弹幕数
+    BARRAGES_PER_WATCH = 2
+    # 每个会员的送礼次数
+    ORDERS_PER_MEMBER = 2
+    # 每个会员每年的充值、签到流水条数
+    LEDGER_ROWS_PER_YEAR = 12
+    # 每个会员的登录记录数
+    LOGINS_PER_MEMBER = 20
+    # 测试用户的聊天对象数及每个对象的消息数
+    CHAT_PEERS = 50
+    MESSAGES_PER_PEER = 5
+
+    PRIZES = [
+        ('玫瑰', 1, m.Prize.PRICE_TYPE_COIN),
+        ('香檳', 10, m.Prize.PRICE_TYPE_COIN),
+        ('跑車', 100, m.Prize.PRICE_TYPE_COIN),
+        ('元氣', 1, m.Prize.PRICE_TYPE_STAR),
+        ('元氣寶盒', 10, m.Prize.PRICE_TYPE_STAR),
+    ]
+
+    def __init__(self, members=1000, years=3, seed=0, now=None):
+        """
+        :param members: 会员数量
+        :param years: 历史数据跨越的年数
+        :param seed: 随机种子
+        :param now: 生成数据的基准时间
+        """
+        self.members = members
+        self.years = years
+        self.seed = seed
+        self.random = random.Random(seed)
+        self.now = now or datetime.now().replace(microsecond=0)
+        self.counts = dict()
+        self.seconds = 0
+        self.user_ids = []
+        self.anchor_ids = []
+        self.live_ids = []
+        self.category_ids = []
+        # 测试用户：拥有聊天记录，作为列表接口的当前用户
+        self.viewer_id = None
+
+    def get_scale(self):
+        return dict(members=self.members, years=self.years, seed=self.seed)
+
+    def random_date(self, days=None):
+        """ 基准时间之前 days 天内的随机时间，默认为整个历史区间 """
+        seconds = (days or self.years * 365) * 86400
+        return self.now - timedelta(seconds=self.random.randint(0, seconds))
+
+    def sample(self, ids, k, exclude=None):
+        ids = [item for item in self.random.sample(ids, min(k + 1, len(ids))) if item != exclude]
+        return ids[:k]
+
+    def bulk_create(self, model, objects, **kwargs):
+        """ 分批写入，objects 可以是生成器，kwargs 传给模型的 bulk_create """
+        chunk = []
+        count = 0
+        for item in objects:
+            chunk.append(item)
+            if len(chunk) >= CHUNK_SIZE:
+                model.objects.bulk_create(chunk, **kwargs)
+                count += len(chunk)
+                chunk = []
+        if chunk:
+            model.objects.bulk_create(chunk, **kwargs)
+            count += len(chunk)
+        self.add_count(model, count)
+
+    def add_count(self, model, count):
+        key = model._meta.db_table
+        self.counts[key] = self.counts.get(key, 0) + count
+
+    def spread_dates(self, queryset, field, days=None, group=50):
+        """ 自动填写的时间字段在写入后按主键顺序分组改为递增的随机时间
+        :param queryset: 需要修改的记录
+        :param field: 时间字段
+        :param days: 时间范围（天），默认为整个历史区间
+        :param group: 每组记录数，同组使用相同的时间
+        """
+        ids = list(queryset.order_by('pk').values_list('pk', flat=True))
+        dates = sorted(self.random_date(days) for i in range(0, len(ids), group))
+        for i, date in enumerate(dates):
+            queryset.model.objects.filter(
+                pk__in=ids[i * group:(i + 1) * group],
+            ).update(**{field: date})
+
+    def generate(self):
+        """ 按顺序生成全部数据
+        :return: {表名: 行数}
+        """
+        time_start = time()
+        self.make_members()
+        self.make_follows()
+        self.make_contacts()
+        self.make_lives()
+        self.make_watch_logs()
+        self.make_barrages()
+        self.make_ledgers()
+        self.make_gift_orders()
+        self.make_live_counters()
+        self.make_login_records()
+        self.make_chats()
+        self.make_daily_statistics()
+        self.seconds = round(time() - time_start, 2)
+        return self.counts
+
+    def make_members(self):
+        self.bulk_create(m.User, (
+            m.User(username='{}{:06d}'.format(USERNAME_PREFIX, i))
+            for i in range(self.members)
+        ))
+        self.user_ids = list(m.User.objects.filter(
+            username__startswith=USERNAME_PREFIX,
+        ).order_by('id').values_list('id', flat=True))
+        self.bulk_create(m.Member, (
+            m.Member(
+                user_id=user_id,
+                nickname='會員{}'.format(i),
+                mobile='19{:09d}'.format(i),
+                gender=self.random.choice([m.Member.GENDER_MALE, m.Member.GENDER_FEMALE]),
+            )
+            for i, user_id in enumerate(self.user_ids)
+        ))
+        self.spread_dates(m.Member.objects.filter(user_id__in=self.user_ids), 'date_created')
+        self.anchor_ids = self.user_ids[::self.ANCHOR_RATIO]
+        self.viewer_id = self.user_ids[1]
+
+    def make_follows(self):
+        """ 追踪关系，一半追踪主播 """
+        content_type = ContentType.objects.get_for_model(m.Member)
+        pairs = []
+        for author_id in self.user_ids:
+            half = self.FOLLOWS_PER_MEMBER // 2
+            user_ids = set(self.sample(self.anchor_ids, half, author_id))
+            user_ids.update(self.sample(self.user_ids, self.FOLLOWS_PER_MEMBER - half, author_id))
+            pairs.extend((author_id, user_id) for user_id in sorted(user_ids))
+        self.bulk_create(m.Follow, (
+            m.Follow(author_id=author_id, user_id=user_id)
+            for author_id, user_id in pairs
+        ))
+        # 通知和任务仍然读取追踪标记
+        self.bulk_create(m.UserMark, (
+            m.UserMark(author_id=author_id, content_type=content_type, object_id=user_id, subject='follow')
+            for author_id, user_id in pairs
+        ))
+        m.Follow.rebuild_counts()
+
+    def make_contacts(self):
+        self.bulk_create(m.Contact, (
+            m.Contact(author_id=author_id, user_id=user_id, type=m.Contact.TYPE_OPEN)
+            for author_id in self.user_ids
+            for user_id in self.sample(self.user_ids, self.CONTACTS_PER_MEMBER, author_id)
+        ))
+
+    def make_lives(self):
+        """ 主播的历史直播，部分主播的最后一场正在直播中 """
+        self.bulk_create(m.LiveCategory, (
+            m.LiveCategory(name='分類{}'.format(i)) for i in range(5)
+        ))
+        self.category_ids = list(m.LiveCategory.objects.order_by('id').values_list('id', flat=True))
+        lives = []
+        for author_id in self.anchor_ids:
+            # 至少有一场进行中的直播，保证送礼等项目可以运行
+            is_active = self.random.random() < self.LIVE_ACTIVE_RATIO or author_id == self.anchor_ids[0]
+            for i in range(self.LIVES_PER_ANCHOR):
+                lives.append(m.Live(
+                    author_id=author_id,
+                    name='直播{}-{}'.format(author_id, i),
+                    category_id=self.random.choice(self.category_ids),
+                    date_end=None if is_active and i == self.LIVES_PER_ANCHOR - 1 else self.random_date(),
+                ))
+        self.bulk_create(m.Live, lives)
+        self.live_ids = list(m.Live.objects.order_by('id').values_list('id', 'author_id', 'date_end'))
+
+    def make_watch_logs(self):
+        logs = []
+        for live_id, author_id, date_end in self.live_ids:
+            for user_id in self.sample(self.user_ids, self.VIEWERS_PER_LIVE, author_id):
+                if date_end:
+                    date_enter = date_end - timedelta(minutes=self.random.randint(1, 120))
+                    logs.append(m.LiveWatchLog(
+                        author_id=user_id,
+                        live_id=live_id,
+                        date_enter=date_enter,
+                        date_leave=date_end,
+                        duration=int((date_end - date_enter).seconds / 60),
+                        is_online=False,
+                    ))
+                else:
+                    logs.append(m.LiveWatchLog(
+                        author_id=user_id,
+                        live_id=live_id,
+                        date_enter=self.now - timedelta(minutes=self.random.randint(1, 60)),
+                        date_response=self.now,
+                    ))
+        self.bulk_create(m.LiveWatchLog, logs)
+
+    def make_barrages(self):
+        logs = m.LiveWatchLog.objects.order_by('id').values_list('author_id', 'live_id')
+        self.bulk_create(m.LiveBarrage, (
+            m.LiveBarrage(author_id=author_id, live_id=live_id, content='彈幕{}'.format(i))
+            for author_id, live_id in logs.iterator()
+            for i in range(self.BARRAGES_PER_WATCH)
+        ))
+        self.spread_dates(m.LiveBarrage.objects.all(), 'date_sent')
+
+    def make_ledgers(self):
+        """ 多年的充值、签到流水，流水只写入不逐批同步钱包，钱包余额最后按流水合计一次写入 """
+        rows = self.years * self.LEDGER_ROWS_PER_YEAR
+        coins = {user_id: [self.random.randint(100, 1000) for i in range(rows)] for user_id in self.user_ids}
+        stars = {user_id: [self.random.randint(1, 20) for i in range(rows)] for user_id in self.user_ids}
+        self.bulk_create(m.CreditCoinTransaction, (
+            m.CreditCoinTransaction(
+                user_debit_id=user_id,
+                amount=amount,
+                type=m.CreditCoinTransaction.TYPE_RECHARGE,
+                remark='充值',
+            )
+            for user_id, amounts in coins.items()
+            for amount in amounts
+        ), apply_wallet=False)
+        self.bulk_create(m.CreditStarTransaction, (
+            m.CreditStarTransaction(
+                user_debit_id=user_id,
+                amount=amount,
+                type=m.CreditStarTransaction.TYPE_DAILY,
+                remark='签到获得',
+            )
+            for user_id, amounts in stars.items()
+            for amount in amounts
+        ), apply_wallet=False)
+        self.bulk_create(m.Wallet, (
+            m.Wallet(user_id=user_id, coin=sum(coins[user_id]), star=sum(stars[user_id]))
+            for user_id in self.user_ids
+        ))
+
+    def make_gift_orders(self):
+        """ 按送礼流程写入礼物订单和流水，订单时间分布在整个历史区间 """
+        self.bulk_create(m.Prize, (
+            m.Prize(name=name, price=price, price_type=price_type)
+            for name, price, price_type in self.PRIZES
+        ))
+        prizes = list(m.Prize.objects.order_by('id'))
+        log_ids = list(m.LiveWatchLog.objects.order_by('id').values_list('id', flat=True))
+        log_ids = [self.random.choice(log_ids) for i in range(self.members * self.ORDERS_PER_MEMBER)]
+        for i in range(0, len(log_ids), CHUNK_SIZE):
+            chunk = log_ids[i:i + CHUNK_SIZE]
+            logs = m.LiveWatchLog.objects.select_related('author', 'live__author').in_bulk(chunk)
+            with transaction.atomic():
+                for log_id in chunk:
+                    log = logs[log_id]
+                    prize = self.random.choice(prizes)
+                    count = self.random.randint(1, 10)
+                    m.PrizeOrder.create_orders(log.live, log.author, log, [
+                        (prize, m.PrizeOrder.make_buy_transactions(log.live, prize, count, log.author)),
+                    ])
+        self.add_count(m.PrizeOrder, len(log_ids))
+        self.spread_dates(m.PrizeOrder.objects.all(), 'date_created')
+
+    def make_live_counters(self):
+        for live in m.Live.objects.all():
+            m.LiveCounter.rebuild(live)
+        self.add_count(m.LiveCounter, len(self.live_ids))
+
+    def make_login_records(self):
+        self.bulk_create(m.LoginRecord, (
+            m.LoginRecord(author_id=user_id)
+            for user_id in self.user_ids
+            for i in range(self.LOGINS_PER_MEMBER)
+        ))
+        self.spread_dates(m.LoginRecord.objects.all(), 'date_login')
+
+    def make_daily_statistics(self):
+        """ 结算全部历史日期，后台图表读取每日统计 """
+        self.add_count(m.DailyStatistic, m.DailyStatistic.update(self.now))
+
+    def make_chats(self):
+        """ 测试用户与若干会员的私信，并生成会话摘要 """
+        messages = []
+        for user_id in self.sample(self.user_ids, self.CHAT_PEERS, self.viewer_id):
+            for i in range(self.MESSAGES_PER_PEER):
+                sender_id, receiver_id = (self.viewer_id, user_id) if i % 2 else (user_id, self.viewer_id)
+                messages.append(m.Message(
+                    sender_id=sender_id,
+                    receiver_id=receiver_id,
+                    content='消息{}'.format(i),
+                ))
+        self.bulk_create(m.Message, messages)
+        m.Conversation.rebuild(m.User.objects.get(id=self.viewer_id))
+
+
+class Benchmark:
+    """ 热点路径计时
+    每项先预热，再重复执行 repeat 次，记录每次的耗时（毫秒）和查询数
+    """
+
+    def __init__(self, data, repeat=20, warmup=2):
+        """
+        :param data: 已生成的 SyntheticData
+        :param repeat: 每项计时次数
+        :param warmup: 每项预热次数，不计入结果
+        """
+        self.data = data
+        self.repeat = repeat
+        self.warmup = warmup
+        self.random = random.Random(data.seed)
+        self.results = dict()
+        self.client = Client()
+        self.client_user_id = None
+        self.viewer = m.User.objects.get(id=data.viewer_id)
+        self.admin = m.User.objects.create(
+            username='{}admin'.format(USERNAME_PREFIX),
+            is_staff=True,
+            is_superuser=True,
+        )
+
+    def measure(self, name, func):
+        """ 对 func 计时
+        :return: 该项的统计结果
+        """
+        times = []
+        queries = []
+        for i in range(self.warmup + self.repeat):
+            with CaptureQueriesContext(connection) as context:
+                time_start = time()
+                func()
+                milliseconds = (time() - time_start) * 1000
+            if i >= self.warmup:
+                times.append(milliseconds)
+                queries.append(len(context))
+        times.sort()
+        self.results[name] = dict(
+            runs=len(times),
+            queries=max(queries),
+            mean=round(sum(times) / len(times), 2),
+            min=round(times[0], 2),
+            p50=round(percentile(times, 0.5), 2),
+            p95=round(percentile(times, 0.95), 2),
+            max=round(times[-1], 2),
+        )
+        return self.results[name]
+
+    def get(self, path, data=None, user=None):
+        """ 以 user 的身份请求接口，默认为测试用户 """
+        user = user or self.viewer
+        if self.client_user_id != user.id:
+            self.client.force_login(user)
+            self.client_user_id = user.id
+        response = self.client.get(path, data)
+        assert response.status_code < 400, '{} 返回 {}'.format(path, response.status_code)
+        return response
+
+    def get_cases(self):
+        """ 计时项目
+        :return: [(名称, 无参函数), ...]
+        """
+        now = self.data.now
+        active_logs = list(m.LiveWatchLog.objects.filter(
+            live__date_end=None,
+        ).select_related('author', 'live__author').order_by('id'))
+        prize = m.Prize.objects.filter(price_type=m.Prize.PRICE_TYPE_COIN).order_by('price').first()
+        members = list(m.Member.objects.filter(user_id__in=self.data.user_ids).select_related('user'))
+
+        def gift_purchase():
+            log = self.random.choice(active_logs)
+            m.PrizeOrder.buy_prize(log.live, prize, 1, log.author)
+
+        def balance_read():
+            member = self.random.choice(members)
+            member.get_coin_balance()
+            member.get_diamond_balance()
+            member.get_star_balance()
+
+        def chart(path, days, **params):
+            return lambda: self.get(path, dict(
+                time_begin=(now - timedelta(days=days)).strftime('%Y-%m-%d'),
+                time_end=now.strftime('%Y-%m-%d'),
+                **params
+            ), user=self.admin)
+
+        return [
+            ('gift_purchase', gift_purchase),
+            ('balance_read', balance_read),
+            ('member_list', lambda: self.get('/api/member/')),
+            ('live_list', lambda: self.get('/api/live/', dict(live_status='ACTION'))),
+            ('live_list_hot', lambda: self.get('/api/live/', dict(hot_live=1))),
+            ('chat_list', lambda: self.get('/api/member/get_chat_list/')),
+            ('rank_update', lambda: m.RankRecord.update_all()),
+            ('hot_rating_job', lambda: m.PlannedTask.update_live_hot_ranking()),
+            ('daily_statistic_job', lambda: m.DailyStatistic.update(now)),
+            ('chart_increased_month', chart('/api/member/get_increased_chart_data/', 30)),
+            ('chart_increased_year', chart('/api/member/get_increased_chart_data/', 365)),
+            ('chart_active_month', chart('/api/login_record/get_active_chart_data/', 30)),
+            ('chart_remain_month', chart('/api/login_record/get_remain_chart_data/', 30, days=1)),
+            ('chart_watch', lambda: self.get('/api/live_watch_log/get_watch_chart_data/', dict(
+                category=self.data.category_ids[0],
+            ), user=self.admin)),
+        ]
+
+    def run(self, names=None):
+        """ 依次运行计时项目
+        :param names: 只运行指定名称的项目，默认全部
+        :return: {名称: 统计结果}
+        """
+        for name, func in self.get_cases():
+            if names and name not in names:
+                continue
+            self.measure(name, func)
+        return self.results
+
+    def report(self):
+        """ 写入 JSON 的完整结果 """
+        return dict(
+            commit=get_commit(),
+            date=datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            database=connection.vendor,
+            scale=self.data.get_scale(),
+            repeat=self.repeat,
+            fixtures=dict(seconds=self.data.seconds, counts=self.data.counts),
+            results=self.results,
+        )
@@ -1,8 +1,30 @@
 from django_cron import CronJobBase, Schedule
-from datetime import datetime, timedelta
 
 from . import models as m
 
+# 周期任务计划表，method 为 PlannedTask 上注册的方法
+# interval 单位为秒；cron 为五段式表达式（分 时 日 月 周）
+RECURRING_JOBS = [
+    # 每 15 分钟更新一次全部排行榜
+    dict(method='update_rank_record', interval=15 * 60),
+    # 每天更新一次成员信息
+    dict(method='update_member_check_history', cron='0 0 * * *'),
+    # 每天结算一次活动
+    dict(method='settle_activity', cron='0 0 * * *'),
+    # 每分钟更新一次热门直播
+    dict(method='update_live_hot_ranking', interval=60),
+    # 每分钟更新一次直播结束
+    dict(method='update_live_end', interval=60),
+    # 每分钟更新一次直播日志
+    dict(method='update_live_log_leave', interval=60),
+    # 每分钟处理一次 VIP 到期降级
+    dict(method='expire_vip', interval=60),
+    # 每 5 分钟更新一次每日统计，已结算的日期不再重新统计
+    dict(method='update_daily_statistic', interval=5 * 60),
+    # 每天清理一次已结束的计划任务
+    dict(method='compact_planned_tasks', cron='0 4 * * *'),
+]
+
 
 class AutomaticShelvesCronJob(CronJobBase):
     # > crontab -e  */5 * * * *
@@ -18,64 +40,7 @@ class AutomaticShelvesCronJob(CronJobBase):
         # 执行所有延时命令
         m.PlannedTask.trigger_all()
 
-        now = datetime.now()
-
-        # 每一个小时更新一次全部排行榜
-        rank_record_target_plan = m.PlannedTask.objects.filter(
-            method='update_rank_record',
-            date_planned__gt=now,
-        ).first()
-        if not rank_record_target_plan:
-            date_planned = now + timedelta(minutes=15)
-            m.PlannedTask.make('update_rank_record', date_planned)
-        print('update_rank_record Finish')
-
-        # 每天更新一次成员信息
-        update_member_check_history_plan = m.PlannedTask.objects.filter(
-            method='update_member_check_history',
-            date_planned__gt=now,
-        ).first()
-        if not update_member_check_history_plan:
-            date_planned = datetime(now.year, now.month, now.day) + timedelta(days=1)
-            m.PlannedTask.make('update_member_check_history', date_planned)
-        print('update_member_check_history Finish')
-
-        # 每天更新一次
-        update_activity_settle_plan = m.PlannedTask.objects.filter(
-            method='settle_activity',
-            date_planned__gt=now,
-        ).first()
-        if not update_activity_settle_plan:
-            date_planned = datetime(now.year, now.month, now.day) + timedelta(days=1)
-            m.PlannedTask.make('settle_activity', date_planned)
-        print('settle_activity Finish')
-
-        # 每分钟更新一次热门直播
-        update_live_hot_ranking = m.PlannedTask.objects.filter(
-            method='update_live_hot_ranking',
-            date_planned__gt=now,
-        ).first()
-        if not update_live_hot_ranking:
-            date_planned = now + timedelta(minutes=1)
-            m.PlannedTask.make('update_live_hot_ranking', date_planned)
-        print('update_live_hot_ranking Finish')
-
-        # 每分钟更新一次直播结束
-        update_live_end = m.PlannedTask.objects.filter(
-            method='update_live_end',
-            date_planned__gt=now,
-        ).first()
-        if not update_live_end:
-            date_planned = now + timedelta(minutes=1)
-            m.PlannedTask.make('update_live_end', date_planned)
-        print('update_live_end Finish')
-
-        # 每分钟更新一次直播日志
-        update_log_leave = m.PlannedTask.objects.filter(
-            method='update_live_log_leave',
-            date_planned__gt=now,
-        ).first()
-        if not update_log_leave:
-            date_planned = now + timedelta(minutes=1)
-            m.PlannedTask.make('update_live_log_leave', date_planned)
-        print('update_live_log_leave Finish')
\ No newline at end of file
+        # 执行到期的周期任务
+        m.RecurringJob.sync(RECURRING_JOBS)
+        executed = m.RecurringJob.run_due()
+        print('RecurringJob Finish: {}'.format(executed))
@@ -0,0 +1,338 @@
+""" 实时排行榜
+
+按榜单、统计周期保存有序分数，送礼时增量更新，支持 O(log n) 名次查询和分页。
+统计周期与 RankRecord 一致：日榜每日 5 点重置，周榜每周一 5 点重置，
+周期以日期作为标识，换期后写入新的周期即实现重置，不需要定时清零。
+
+后端通过 settings.LEADERBOARD_BACKEND 选择：
+    'sql'    默认，保存在 LeaderboardScore 表中，多进程共享
+    'memory' 进程内有序表，用于测试或单进程部署
+    'redis'  Redis 有序集合，需要配置 LEADERBOARD_REDIS_URL，
+             也可以通过 set_backend(RedisBackend(client)) 传入兼容的客户端
+"""
+from bisect import bisect_left, insort
+from datetime import datetime, timedelta
+from decimal import Decimal
+from threading import RLock
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import IntegrityError, models, transaction
+
+BOARD_RECEIVE_DIAMOND = 'receive_diamond_amount'
+BOARD_SEND_DIAMOND = 'send_diamond_amount'
+BOARD_STAR_INDEX = 'star_index_amount'
+BOARDS = (BOARD_RECEIVE_DIAMOND, BOARD_SEND_DIAMOND, BOARD_STAR_INDEX)
+
+DURATION_DATE = 'DATE'
+DURATION_WEEK = 'WEEK'
+DURATION_TOTAL = 'TOTAL'
+DURATIONS = (DURATION_DATE, DURATION_WEEK, DURATION_TOTAL)
+
+# 过期周期的保留时间
+RETENTION = {
+    DURATION_DATE: timedelta(days=3),
+    DURATION_WEEK: timedelta(days=15),
+}
+
+
+def get_period(duration, now=None):
+    """ 统计周期标识
+    :return: (period, 周期结束时间)，总榜的结束时间为 None
+    """
+    from .models import RankRecord
+    if duration == DURATION_TOTAL:
+        return 'total', None
+    date_begin, date_end = RankRecord.get_periods(now)[duration]
+    return date_begin.strftime('%Y%m%d'), date_end
+
+def get_alive_periods(duration, now=None):
+    """ 当前周期，以及结束后仍在保留时间（RETENTION）内的过去周期
+    :return: 周期标识列表
+    """
+    from .models import RankRecord
+    if duration == DURATION_TOTAL:
+        return ['total']
+    now = now or datetime.now()
+    periods = []
+    moment = now
+    while True:
+        date_begin, date_end = RankRecord.get_periods(moment)[duration]
+        if date_end + RETENTION[duration] <= now:
+            return periods
+        periods.append(date_begin.strftime('%Y%m%d'))
+        moment = date_begin - timedelta(seconds=1)
+
+
+class MemoryBackend:
+    """ 进程内有序表 """
+
+    def __init__(self):
+        self.lock = RLock()
+        # key => (scores, ordered)，ordered 为 (-score, user_id) 的有序列表
+        self.boards = dict()
+
+    def get_board(self, key):
+        return self.boards.setdefault(key, (dict(), []))
+
+    def incr(self, key, user_id, amount, date_expire=None):
+        with self.lock:
+            scores, ordered = self.get_board(key)
+            old = scores.get(user_id)
+            if old is not None:
+                ordered.pop(bisect_left(ordered, (-old, user_id)))
+            score = (old or 0) + Decimal(amount)
+            scores[user_id] = score
+            insort(ordered, (-score, user_id))
+
+    def replace(self, key, scores, date_expire=None):
+        with self.lock:
+            self.boards[key] = (
+                dict(scores),
+                sorted((-Decimal(score), user_id) for user_id, score in scores.items()),
+            )
+
+    def score(self, key, user_id):
+        return self.get_board(key)[0].get(user_id)
+
+    def rank(self, key, user_id):
+        with self.lock:
+            scores, ordered = self.get_board(key)
+            if user_id not in scores:
+                return None
+            return bisect_left(ordered, (-scores[user_id], user_id))
+
+    def top(self, key, offset, limit):
+        ordered = self.get_board(key)[1]
+        return [(user_id, -score) for score, user_id in ordered[offset:offset + limit]]
+
+    def count(self, key):
+        return len(self.get_board(key)[0])
+
+    def prune(self, keys_alive):
+        with self.lock:
+            for key in list(self.boards.keys()):
+                if key not in keys_alive:
+                    del self.boards[key]
+
+
+class SqlBackend:
+    """ 保存在 LeaderboardScore 表，(board, period, score) 上有索引 """
+
+    def get_queryset(self, key):
+        from .models import LeaderboardScore
+        board, period = key
+        return LeaderboardScore.objects.filter(board=board, period=period)
+
+    def incr(self, key, user_id, amount, date_expire=None):
+        from .models import LeaderboardScore
+        qs = self.get_queryset(key).filter(user_id=user_id)
+        if qs.update(score=models.F('score') + amount):
+            return
+        try:
+            with transaction.atomic():
+                LeaderboardScore.objects.create(
+                    board=key[0],
+                    period=key[1],
+                    user_id=user_id,
+                    score=amount,
+                )
+        except IntegrityError:
+            # 并发情况下其他请求已经创建
+            qs.update(score=models.F('score') + amount)
+
+    def replace(self, key, scores, date_expire=None):
+        from .models import LeaderboardScore
+        with transaction.atomic():
+            self.get_queryset(key).delete()
+            LeaderboardScore.objects.bulk_create([
+                LeaderboardScore(board=key[0], period=key[1], user_id=user_id, score=score)
+                for user_id, score in scores.items() if score
+            ], batch_size=1000)
+
+    def score(self, key, user_id):
+        return self.get_queryset(key).filter(
+            user_id=user_id,
+        ).values_list('score', flat=True).first()
+
+    def rank(self, key, user_id):
+        score = self.score(key, user_id)
+        if score is None:
+            return None
+        qs = self.get_queryset(key)
+        return qs.filter(score__gt=score).count() + \
+               qs.filter(score=score, user_id__lt=user_id).count()
+
+    def top(self, key, offset, limit):
+        return list(self.get_queryset(key).order_by('-score', 'user_id').values_list(
+            'user_id', 'score',
+        )[offset:offset + limit])
+
+    def count(self, key):
+        return self.get_queryset(key).count()
+
+    def prune(self, keys_alive):
+        from .models import LeaderboardScore
+        qs = LeaderboardScore.objects.all()
+        for board, period in keys_alive:
+            qs = qs.exclude(board=board, period=period)
+        qs.delete()
+
+
+class RedisBackend:
+    """ Redis 有序集合，client 可以是任何实现了相应命令的兼容客户端 """
+
+    def __init__(self, client=None, prefix='leaderboard'):
+        if client is None:
+            try:
+                import redis
+            except ImportError:
+                raise ImproperlyConfigured('使用 redis 排行榜后端需要安装 redis 包')
+            client = redis.StrictRedis.from_url(settings.LEADERBOARD_REDIS_URL)
+        self.client = client
+        self.prefix = prefix
+
+    def get_key(self, key):
+        return '{}:{}:{}'.format(self.prefix, *key)
+
+    def expire(self, name, date_expire):
+        if date_expire:
+            self.client.expireat(name, int(date_expire.timestamp()))
+
+    def incr(self, key, user_id, amount, date_expire=None):
+        name = self.get_key(key)
+        self.client.execute_command('ZINCRBY', name, float(amount), user_id)
+        self.expire(name, date_expire)
+
+    def replace(self, key, scores, date_expire=None):
+        name = self.get_key(key)
+        self.client.delete(name)
+        for user_id, score in scores.items():
+            if score:
+                self.client.execute_command('ZADD', name, float(score), user_id)
+        self.expire(name, date_expire)
+
+    def score(self, key, user_id):
+        score = self.client.zscore(self.get_key(key), user_id)
+        return None if score is None else Decimal(str(score))
+
+    def rank(self, key, user_id):
+        return self.client.zrevrank(self.get_key(key), user_id)
+
+    def top(self, key, offset, limit):
+        rows = self.client.zrevrange(self.get_key(key), offset, offset + limit - 1, withscores=True)
+        return [(int(user_id), Decimal(str(score))) for user_id, score in rows]
+
+    def count(self, key):
+        return self.client.zcard(self.get_key(key))
+
+    def prune(self, keys_alive):
+        # 过期周期由 Redis 的过期时间自动清理
+        pass
+
+
+_backend = None
+
+
+def get_backend():
+    global _backend
+    if _backend is None:
+        name = getattr(settings, 'LEADERBOARD_BACKEND', 'sql')
+        if name == 'sql':
+            _backend = SqlBackend()
+        elif name == 'memory':
+            _backend = MemoryBackend()
+        elif name == 'redis':
+            _backend = RedisBackend()
+        else:
+            raise ImproperlyConfigured('未知的排行榜后端：{}'.format(name))
+    return _backend
+
+
+def set_backend(backend):
+    """ 替换排行榜后端，例如测试时传入 MemoryBackend 或 Redis 的本地替代客户端 """
+    global _backend
+    _backend = backend
+
+
+def incr(board, user_id, amount, now=None):
+    """ 给用户在各个统计周期的榜单上累加分数 """
+    if not user_id or not amount:
+        return
+    backend = get_backend()
+    for duration in DURATIONS:
+        period, date_end = get_period(duration, now)
+        date_expire = date_end and date_end + RETENTION[duration]
+        backend.incr((board, period), user_id, amount, date_expire)
+
+
+def top(board, duration, offset=0, limit=10, now=None):
+    """ 榜单分页
+    :return: [(名次（从 1 开始）, user_id, score), ...]
+    """
+    period, date_end = get_period(duration, now)
+    rows = get_backend().top((board, period), offset, limit)
+    return [(offset + i + 1, user_id, score) for i, (user_id, score) in enumerate(rows)]
+
+
+def rank(board, duration, user_id, now=None):
+    """ 用户在榜单上的名次和分数
+    :return: (名次（从 1 开始）, score)，未上榜返回 (None, 0)
+    """
+    period, date_end = get_period(duration, now)
+    backend = get_backend()
+    position = backend.rank((board, period), user_id)
+    if position is None:
+        return None, 0
+    return position + 1, backend.score((board, period), user_id)
+
+
+def count(board, duration, now=None):
+    period, date_end = get_period(duration, now)
+    return get_backend().count((board, period))
+
+
+def record_prize_orders(orders, now=None):
+    """ 送礼订单计入排行榜 """
+    for order in orders:
+        if order.diamond_transaction:
+            amount = order.diamond_transaction.amount
+            incr(BOARD_RECEIVE_DIAMOND, order.diamond_transaction.user_debit_id, amount, now)
+            incr(BOARD_SEND_DIAMOND, order.author_id, amount, now)
+        if order.receiver_star_index_transaction:
+            # 揹包送禮的元氣指數流水沒有借方用戶，與 RankRecord 一致按送禮用戶計入
+            incr(BOARD_STAR_INDEX, order.author_id, order.receiver_star_index_transaction.amount, now)
+
+
+def rebuild(now=None):
+    """ 从礼物订单重建当前各周期的榜单 """
+    from .models import PrizeOrder, RankRecord
+    backend = get_backend()
+    for duration in DURATIONS:
+        period, date_end = get_period(duration, now)
+        date_expire = date_end and date_end + RETENTION[duration]
+        orders = PrizeOrder.objects.all()
+        if duration != DURATION_TOTAL:
+            date_begin, date_end = RankRecord.get_periods(now)[duration]
+            orders = orders.filter(date_created__gt=date_begin, date_created__lt=date_end)
+        for board, group_field, amount_field in (
+                (BOARD_RECEIVE_DIAMOND, 'diamond_transaction__user_debit', 'diamond_transaction__amount'),
+                (BOARD_SEND_DIAMOND, 'author', 'diamond_transaction__amount'),
+                (BOARD_STAR_INDEX, 'author', 'receiver_star_index_transaction__amount'),
+        ):
+            rows = orders.filter(**{group_field + '__isnull': False, amount_field + '__isnull': False}).values(
+                group_field,
+            ).annotate(amount=models.Sum(amount_field))
+            backend.replace((board, period), {
+                row[group_field]: row['amount'] for row in rows
+            }, date_expire)
+
+
+def prune(now=None):
+    """ 清理结束后超过保留时间的过去周期的榜单 """
+    keys_alive = [
+        (board, period)
+        for board in BOARDS for duration in DURATIONS
+        for period in get_alive_periods(duration, now)
+    ]
+    get_backend().prune(keys_alive)
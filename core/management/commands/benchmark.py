@@ -0,0 +1,55 @@
+import json
+
+from django.core.management.base import BaseCommand
+from django.test.utils import (
+    setup_databases, setup_test_environment, teardown_databases, teardown_test_environment,
+)
+
+from core.benchmark import Benchmark, SyntheticData
+
+
+class Command(BaseCommand):
+    help = '热点路径性能基准测试：在临时测试数据库中生成合成数据后逐项计时，结束后删除测试数据库'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--members', type=int, default=1000, help='会员数量，其余数据按比例生成')
+        parser.add_argument('--years', type=int, default=3, help='历史数据跨越的年数')
+        parser.add_argument('--seed', type=int, default=0, help='随机种子')
+        parser.add_argument('--repeat', type=int, default=20, help='每项计时次数')
+        parser.add_argument('--case', action='append', dest='cases', default=[],
+                            help='只运行指定的项目，可多次指定')
+        parser.add_argument('--output', default=None, help='结果写入的 JSON 文件')
+        parser.add_argument('--compare', default=None, help='与之前输出的 JSON 文件对比')
+
+    def handle(self, *args, **options):
+        setup_test_environment()
+        old_config = setup_databases(verbosity=0, interactive=False)
+        try:
+            data = SyntheticData(members=options['members'], years=options['years'], seed=options['seed'])
+            for table, count in sorted(data.generate().items()):
+                self.stdout.write('{:<50} {:>10}'.format(table, count))
+            self.stdout.write('generated in {:.2f}s'.format(data.seconds))
+
+            benchmark = Benchmark(data, repeat=options['repeat'])
+            benchmark.run(options['cases'])
+            report = benchmark.report()
+        finally:
+            teardown_databases(old_config, verbosity=0)
+            teardown_test_environment()
+
+        baseline = dict()
+        if options['compare']:
+            with open(options['compare']) as f:
+                baseline = json.load(f).get('results', dict())
+        for name, result in report['results'].items():
+            line = '{:<24} p50 {:>9.2f}ms  p95 {:>9.2f}ms  {:>5} queries'.format(
+                name, result['p50'], result['p95'], result['queries'],
+            )
+            if name in baseline and baseline[name]['p50']:
+                line += '  x{:.2f} vs baseline'.format(result['p50'] / baseline[name]['p50'])
+            self.stdout.write(line)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+            self.stdout.write('written to {}'.format(options['output']))
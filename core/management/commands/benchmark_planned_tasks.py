@@ -0,0 +1,39 @@
+from datetime import datetime
+from time import time
+
+from django.core.management.base import BaseCommand
+
+from django_base.models import PlannedTask
+
+
+class Command(BaseCommand):
+    help = '计划任务执行器吞吐量测试：插入一批空任务后全部执行，结束后删除'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=100000, help='任务数量')
+        parser.add_argument('--workers', type=int, default=None, help='并发数')
+        parser.add_argument('--pool', choices=['thread', 'process'], default=None, help='执行池类型')
+        parser.add_argument('--batch-size', type=int, default=None, dest='batch_size', help='每次认领数量')
+
+    def handle(self, *args, **options):
+        count = options['count']
+        now = datetime.now()
+        time_start = time()
+        PlannedTask.objects.bulk_create([
+            PlannedTask(method='noop', date_planned=now, args='[]', kwargs='{}')
+            for i in range(count)
+        ], batch_size=5000)
+        self.stdout.write('queued {} tasks in {:.2f}s'.format(count, time() - time_start))
+
+        time_start = time()
+        executed = PlannedTask.run_due(
+            workers=options['workers'],
+            pool=options['pool'],
+            batch_size=options['batch_size'],
+        )
+        seconds = time() - time_start
+        self.stdout.write('executed {} tasks in {:.2f}s, {:.0f} tasks/s'.format(
+            executed, seconds, executed / seconds if seconds else 0,
+        ))
+
+        PlannedTask.objects.filter(method='noop').delete()
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Conversation, User
+
+
+class Command(BaseCommand):
+    help = '从消息、标记和评论重建用户的会话摘要'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='users',
+            type=int,
+            default=[],
+            help='只处理指定用户 id，可多次指定',
+        )
+
+    def handle(self, *args, **options):
+        users = User.objects.all()
+        if options['users']:
+            users = users.filter(id__in=options['users'])
+        total = 0
+        for user in users.iterator():
+            total += Conversation.rebuild(user)
+        self.stdout.write('{} conversations rebuilt'.format(total))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Follow
+
+
+class Command(BaseCommand):
+    help = '按追踪关系表重新计算会员的追踪数和粉丝数'
+
+    def handle(self, *args, **options):
+        Follow.rebuild_counts()
+        self.stdout.write('{} follows'.format(Follow.objects.count()))
@@ -0,0 +1,16 @@
+from django.core.management.base import BaseCommand
+
+from core import leaderboard
+
+
+class Command(BaseCommand):
+    help = '从礼物订单重建当前周期的实时排行榜，并清理过期周期'
+
+    def handle(self, *args, **options):
+        leaderboard.rebuild()
+        leaderboard.prune()
+        for board in leaderboard.BOARDS:
+            for duration in leaderboard.DURATIONS:
+                self.stdout.write('{} {}: {} users'.format(
+                    board, duration, leaderboard.count(board, duration),
+                ))
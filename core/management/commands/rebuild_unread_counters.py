@@ -0,0 +1,61 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from core.models import UnreadCounter
+
+
+class Command(BaseCommand):
+    help = '按会话摘要重建用户未读数，或仅对账（--check）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='只对账，不修改未读数',
+        )
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='users',
+            type=int,
+            default=[],
+            help='只处理指定用户 id，可多次指定',
+        )
+
+    def handle(self, *args, **options):
+        user_ids = options['users']
+        expected = UnreadCounter.compute(user_ids)
+        counters = UnreadCounter.objects.all()
+        if user_ids:
+            counters = counters.filter(user_id__in=user_ids)
+        counters = {counter.user_id: counter for counter in counters}
+
+        mismatched = 0
+        for user_id in set(expected.keys()) | set(counters.keys()):
+            counter = counters.get(user_id) or UnreadCounter(user_id=user_id)
+            counts = expected.get(user_id, {})
+            diff = {
+                field: (getattr(counter, field), counts.get(field, 0))
+                for field in UnreadCounter.FIELDS
+                if getattr(counter, field) != counts.get(field, 0)
+            }
+            if not diff:
+                continue
+            mismatched += 1
+            self.stdout.write('user {}: {}'.format(user_id, ', '.join(
+                '{} {} != {}'.format(field, actual, conversation)
+                for field, (actual, conversation) in diff.items()
+            )))
+            if options['check']:
+                continue
+            with transaction.atomic():
+                UnreadCounter.objects.update_or_create(user_id=user_id, defaults={
+                    field: counts.get(field, 0) for field in UnreadCounter.FIELDS
+                })
+
+        if options['check']:
+            self.stdout.write('{} counters mismatched'.format(mismatched))
+        else:
+            self.stdout.write('{} counters rebuilt'.format(mismatched))
@@ -0,0 +1,82 @@
+from collections import defaultdict
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import models, transaction
+
+from core.models import User, Wallet
+
+
+class Command(BaseCommand):
+    help = '从流水表重建用户钱包余额，或仅对账（--check）'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='只对账，不修改钱包',
+        )
+        parser.add_argument(
+            '--user',
+            action='append',
+            dest='users',
+            type=int,
+            default=[],
+            help='只处理指定用户 id，可多次指定',
+        )
+
+    def get_ledger_balances(self, user_ids):
+        """ 按用户分组聚合所有流水，得到每个用户的各项余额
+        :return: {user_id: {field: balance}}
+        """
+        balances = defaultdict(lambda: defaultdict(Decimal))
+        for field, model in Wallet.get_transaction_models():
+            for side, sign in (('user_debit', 1), ('user_credit', -1)):
+                qs = model.objects.filter(**{side + '__isnull': False})
+                if user_ids:
+                    qs = qs.filter(**{side + '__in': user_ids})
+                rows = qs.values(side).annotate(amount=models.Sum('amount'))
+                for row in rows:
+                    balances[row[side]][field] += sign * (row['amount'] or 0)
+        return balances
+
+    def handle(self, *args, **options):
+        user_ids = options['users']
+        fields = [field for field, model in Wallet.get_transaction_models()]
+        balances = self.get_ledger_balances(user_ids)
+        wallets = Wallet.objects.all()
+        if user_ids:
+            wallets = wallets.filter(user_id__in=user_ids)
+        wallets = {wallet.user_id: wallet for wallet in wallets}
+
+        mismatched = 0
+        for user_id in set(balances.keys()) | set(wallets.keys()):
+            expected = balances.get(user_id, {})
+            wallet = wallets.get(user_id)
+            diff = dict()
+            for field in fields:
+                actual = wallet and getattr(wallet, field) or Decimal(0)
+                if actual != expected.get(field, Decimal(0)):
+                    diff[field] = (actual, expected.get(field, Decimal(0)))
+            if not diff and wallet:
+                continue
+            mismatched += 1
+            if diff:
+                self.stdout.write('user {}: {}'.format(user_id, ', '.join(
+                    '{} {} != {}'.format(field, actual, ledger)
+                    for field, (actual, ledger) in diff.items()
+                )))
+            if options['check']:
+                continue
+            with transaction.atomic():
+                Wallet.objects.update_or_create(
+                    user=User.objects.get(pk=user_id),
+                    defaults={field: expected.get(field, Decimal(0)) for field in fields},
+                )
+
+        if options['check']:
+            self.stdout.write('{} wallets mismatched'.format(mismatched))
+        else:
+            self.stdout.write('{} wallets rebuilt'.format(mismatched))
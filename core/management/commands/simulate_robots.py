@@ -0,0 +1,65 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.models import Live, Prize
+from core.simulator import RATES, RobotSwarm, get_rates, prepare_robots
+
+
+class Command(BaseCommand):
+    help = '直播间流量模拟：机器人观众进入本地直播间心跳、发弹幕、送礼、追踪，统计各接口的吞吐量、延迟和错误率'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--robots', type=int, default=100, help='机器人数量')
+        parser.add_argument('--live', action='append', dest='lives', type=int, default=[],
+                            help='目标直播间 id，可多次指定，默认为进行中的直播')
+        parser.add_argument('--rooms', type=int, default=1, help='未指定直播间时取热度最高的几个进行中的直播')
+        parser.add_argument('--skew', type=float, default=1.0, help='直播间热度倾斜程度，0 为平均分配')
+        parser.add_argument('--duration', type=int, default=60, help='持续秒数')
+        parser.add_argument('--ramp', type=int, default=10, help='机器人在开始后多少秒内陆续进入')
+        parser.add_argument('--workers', type=int, default=20, help='工作线程数')
+        parser.add_argument('--prize', type=int, default=None, help='送出的礼物 id，默认为最便宜的金币礼物')
+        parser.add_argument('--rate', action='append', dest='rates', default=[],
+                            help='覆盖行为频率（每分钟次数），格式 key=value，可选 {}'.format(', '.join(sorted(RATES))))
+        parser.add_argument('--seed', type=int, default=0, help='随机种子')
+        parser.add_argument('--output', default=None, help='结果写入的 JSON 文件')
+
+    def handle(self, *args, **options):
+        if options['lives']:
+            lives = list(Live.objects.filter(id__in=options['lives']).order_by('id'))
+        else:
+            lives = list(Live.objects.filter(date_end=None).order_by('-hot_rating')[:options['rooms']])
+        if not lives:
+            raise CommandError('没有可用的直播间')
+
+        prizes = Prize.objects.filter(price_type=Prize.PRICE_TYPE_COIN, vip_limit=0)
+        if options['prize']:
+            prizes = prizes.filter(id=options['prize'])
+        prize = prizes.order_by('price').first()
+        if not prize:
+            raise CommandError('没有可用的金币礼物')
+
+        overrides = dict()
+        for item in options['rates']:
+            key, _, value = item.partition('=')
+            if key not in RATES:
+                raise CommandError('未知的行为：{}'.format(key))
+            overrides[key] = float(value)
+
+        users = prepare_robots(options['robots'])
+        swarm = RobotSwarm(users, lives, prize, rates=get_rates(overrides), skew=options['skew'], seed=options['seed'])
+        report = swarm.run(options['duration'], workers=options['workers'], ramp=options['ramp'])
+
+        self.stdout.write('{} robots, lives {}, {:.1f}s (total {:.1f}s)'.format(
+            report['robots'], report['lives'], report['seconds'], report['total_seconds']))
+        for name, item in report['endpoints'].items():
+            self.stdout.write('{:<10} {:>7} req {:>8.2f}/s  p50 {:>8.2f}ms  p95 {:>8.2f}ms  p99 {:>8.2f}ms  errors {:.2%}'.format(
+                name, item['count'], item['throughput'], item['p50'], item['p95'], item['p99'], item['error_rate'],
+            ))
+            for error, count in item['error_samples']:
+                self.stdout.write('    {:>6} {}'.format(count, error))
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(report, f, ensure_ascii=False, indent=2, sort_keys=True)
+            self.stdout.write('written to {}'.format(options['output']))
@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0056_merge_20171011_1808'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Wallet',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='wallet', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+                ('coin', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='金币余额')),
+                ('diamond', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='钻石余额')),
+                ('star', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='星星（元气）余额')),
+                ('star_index_sender', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='星光指数余额（送礼）')),
+                ('star_index_receiver', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='星光指数余额（收礼）')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '用户钱包',
+                'verbose_name_plural': '用户钱包',
+                'db_table': 'core_wallet',
+            },
+        ),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0057_wallet'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LiveCounter',
+            fields=[
+                ('live', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='counter', serialize=False, to='core.Live', verbose_name='直播')),
+                ('viewer_count', models.IntegerField(default=0, verbose_name='当前观看人数')),
+                ('barrage_count', models.IntegerField(default=0, verbose_name='弹幕数')),
+                ('comment_count', models.IntegerField(default=0, verbose_name='评论数')),
+                ('diamond_amount', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='获得钻石数')),
+                ('tier4_count', models.IntegerField(default=0, verbose_name='VIP4/2级观众数')),
+                ('tier5_count', models.IntegerField(default=0, verbose_name='VIP5/3级观众数')),
+                ('tier6_count', models.IntegerField(default=0, verbose_name='VIP6/4级观众数')),
+                ('tier7_count', models.IntegerField(default=0, verbose_name='VIP7/5级观众数')),
+                ('tier8_count', models.IntegerField(default=0, verbose_name='VIP8/6级观众数')),
+                ('tier9_count', models.IntegerField(default=0, verbose_name='VIP9/7级观众数')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '直播热度计数',
+                'verbose_name_plural': '直播热度计数',
+                'db_table': 'core_live_counter',
+            },
+        ),
+    ]
@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def sync_total_experience(apps, schema_editor):
+    """ 会员总经验改为增量维护，先按经验流水校准一次 """
+    Member = apps.get_model('core', 'Member')
+    ExperienceTransaction = apps.get_model('core', 'ExperienceTransaction')
+    totals = ExperienceTransaction.objects.values('author').annotate(
+        amount=models.Sum('experience'),
+    )
+    for row in totals:
+        Member.objects.filter(user_id=row['author']).update(
+            total_experience=row['amount'] or 0,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0058_livecounter'),
+    ]
+
+    operations = [
+        migrations.RunPython(sync_total_experience, migrations.RunPython.noop),
+    ]
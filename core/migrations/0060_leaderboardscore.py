@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0059_sync_member_total_experience'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LeaderboardScore',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('board', models.CharField(max_length=30, verbose_name='榜單')),
+                ('period', models.CharField(max_length=20, verbose_name='統計週期')),
+                ('score', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='分數')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='leaderboard_scores', to=settings.AUTH_USER_MODEL, verbose_name='用戶')),
+            ],
+            options={
+                'verbose_name': '排行榜分數',
+                'verbose_name_plural': '排行榜分數',
+                'db_table': 'core_leaderboard_score',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='leaderboardscore',
+            unique_together=set([('board', 'period', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='leaderboardscore',
+            index_together=set([('board', 'period', 'score')]),
+        ),
+    ]
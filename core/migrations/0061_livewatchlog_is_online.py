@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+def sync_is_online(apps, schema_editor):
+    LiveWatchLog = apps.get_model('core', 'LiveWatchLog')
+    LiveWatchLog.objects.exclude(
+        models.Q(date_leave=None) |
+        models.Q(date_leave__lt=models.F('date_enter'))
+    ).update(is_online=False)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0060_leaderboardscore'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='livewatchlog',
+            name='is_online',
+            field=models.BooleanField(default=True, help_text='保存时根据进入、离开时间自动维护', verbose_name='是否观看中'),
+        ),
+        migrations.RunPython(sync_is_online, migrations.RunPython.noop),
+        migrations.AlterIndexTogether(
+            name='livewatchlog',
+            index_together=set([('is_online', 'date_response')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='live',
+            index_together=set([('date_end', 'date_response')]),
+        ),
+    ]
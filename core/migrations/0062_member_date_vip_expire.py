@@ -0,0 +1,51 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import json
+
+from django.db import migrations, models
+
+
+def get_member_id(args):
+    """ 旧的 change_vip_level 任务参数是 JSON 编码两次的 [member_id] """
+    value = json.loads(args or '[]')
+    while isinstance(value, (list, str)):
+        if isinstance(value, str):
+            value = json.loads(value)
+        elif value:
+            value = value[0]
+        else:
+            return None
+    return value
+
+
+def convert_planned_tasks(apps, schema_editor):
+    """ 把每个会员的 change_vip_level 计划任务转换为 VIP 到期时间 """
+    Member = apps.get_model('core', 'Member')
+    PlannedTask = apps.get_model('django_base', 'PlannedTask')
+    tasks = PlannedTask.objects.filter(method='change_vip_level')
+    expires = dict()
+    for args, date_planned in tasks.filter(status='PLANNED').values_list('args', 'date_planned'):
+        member_id = get_member_id(args)
+        if member_id and (member_id not in expires or date_planned > expires[member_id]):
+            expires[member_id] = date_planned
+    for member_id, date_planned in expires.items():
+        Member.objects.filter(pk=member_id, vip_level__gt=0).update(date_vip_expire=date_planned)
+    tasks.delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0061_livewatchlog_is_online'),
+        ('django_base', '0014_recurringjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='member',
+            name='date_vip_expire',
+            field=models.DateTimeField(blank=True, db_index=True, help_text='到期后由 expire_vip 任务降一级，仍有 VIP 等级则再顺延 30 天', null=True, verbose_name='VIP到期时间'),
+        ),
+        migrations.RunPython(convert_planned_tasks, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0062_member_date_vip_expire'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('type', models.CharField(choices=[('chat', '私聊'), ('family', '家族消息'), ('follow', '追踪'), ('activeevent', '动态互动'), ('activity', '活动消息'), ('system', '系统消息')], max_length=20, verbose_name='会话类型')),
+                ('key', models.CharField(help_text='私聊为 chat:对方用户id，家族为 family:家族id，其他类型与会话类型相同', max_length=50, verbose_name='会话标识')),
+                ('content', models.TextField(blank=True, default='', verbose_name='最后一条消息')),
+                ('date_last', models.DateTimeField(verbose_name='最后消息时间')),
+                ('unread_count', models.IntegerField(default=0, verbose_name='未读数')),
+                ('family', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Family', verbose_name='家族')),
+                ('owner', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+                ('peer', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL, verbose_name='对方用户')),
+            ],
+            options={
+                'verbose_name': '会话摘要',
+                'verbose_name_plural': '会话摘要',
+                'db_table': 'core_conversation',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversation',
+            unique_together=set([('owner', 'key')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='conversation',
+            index_together=set([('owner', 'date_last')]),
+        ),
+    ]
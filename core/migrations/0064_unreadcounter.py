@@ -0,0 +1,34 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0063_conversation'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UnreadCounter',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='unread_counter', serialize=False, to=settings.AUTH_USER_MODEL, verbose_name='用户')),
+                ('chat', models.IntegerField(default=0, verbose_name='私聊未读')),
+                ('family', models.IntegerField(default=0, verbose_name='家族消息未读')),
+                ('follow', models.IntegerField(default=0, verbose_name='追踪未读')),
+                ('activeevent', models.IntegerField(default=0, verbose_name='动态互动未读')),
+                ('activity', models.IntegerField(default=0, verbose_name='活动消息未读')),
+                ('system', models.IntegerField(default=0, verbose_name='系统消息未读')),
+            ],
+            options={
+                'verbose_name': '未读数',
+                'verbose_name_plural': '未读数',
+                'db_table': 'core_unread_counter',
+            },
+        ),
+    ]
@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0064_unreadcounter'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_message_id',
+            field=models.IntegerField(default=0, verbose_name='最后消息id'),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='last_read_id',
+            field=models.IntegerField(default=0, help_text='id 大于此值的消息为未读，追踪和动态互动会话不使用', verbose_name='已读水位'),
+        ),
+    ]
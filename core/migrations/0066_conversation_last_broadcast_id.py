@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_base', '0015_broadcast_delivery'),
+        ('core', '0065_conversation_watermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='last_broadcast_id',
+            field=models.IntegerField(default=0, help_text='活动、系统会话已拉取到的阅读时拉取推送 id', verbose_name='推送拉取水位'),
+        ),
+    ]
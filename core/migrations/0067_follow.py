@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_follows(apps, schema_editor):
+    """ 从 base_user_mark 的追踪标记导入追踪关系，并计算会员的追踪数、粉丝数 """
+    ContentType = apps.get_model('contenttypes', 'ContentType')
+    content_type = ContentType.objects.filter(app_label='core', model='member').first()
+    if not content_type:
+        return
+    with schema_editor.connection.cursor() as cursor:
+        cursor.execute('''
+        insert into core_follow (author_id, user_id, date_created)
+        select um.author_id, um.object_id, um.date_created
+        from base_user_mark um, core_member m
+        where um.subject = 'follow'
+          and um.content_type_id = %s
+          and um.author_id is not null
+          and um.object_id = m.user_id
+        ''', [content_type.id])
+        cursor.execute('''
+        update core_member set
+          follow_count = (select count(*) from core_follow f where f.author_id = core_member.user_id),
+          followed_count = (select count(*) from core_follow f where f.user_id = core_member.user_id)
+        ''')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0066_conversation_last_broadcast_id'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Follow',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_created', models.DateTimeField(auto_now_add=True, verbose_name='追踪时间')),
+                ('author', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='follows_owned', to=settings.AUTH_USER_MODEL, verbose_name='追踪者')),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='follows_related', to=settings.AUTH_USER_MODEL, verbose_name='被追踪者')),
+            ],
+            options={
+                'verbose_name': '追踪关系',
+                'verbose_name_plural': '追踪关系',
+                'db_table': 'core_follow',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='follow',
+            unique_together=set([('author', 'user')]),
+        ),
+        migrations.AlterIndexTogether(
+            name='follow',
+            index_together=set([('user', 'author')]),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='follow_count',
+            field=models.IntegerField(default=0, help_text='由 Follow.set 维护', verbose_name='追蹤數'),
+        ),
+        migrations.AddField(
+            model_name='member',
+            name='followed_count',
+            field=models.IntegerField(default=0, help_text='由 Follow.set 维护', verbose_name='粉絲數'),
+        ),
+        migrations.RunPython(backfill_follows, migrations.RunPython.noop),
+    ]
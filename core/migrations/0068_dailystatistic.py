@@ -0,0 +1,39 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0067_follow'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyStatistic',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date', models.DateField(unique=True, verbose_name='统计日期')),
+                ('active_count', models.IntegerField(default=0, help_text='当天有登录记录的用户数', verbose_name='活跃用户数')),
+                ('login_count', models.IntegerField(default=0, verbose_name='登录次数')),
+                ('new_member_count', models.IntegerField(default=0, verbose_name='新增会员数')),
+                ('recharge_count', models.IntegerField(default=0, verbose_name='充值笔数')),
+                ('recharge_amount', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='充值金额')),
+                ('withdraw_amount', models.DecimalField(decimal_places=2, default=0, help_text='当天审批通过的提现', max_digits=18, verbose_name='提现金额')),
+                ('gift_count', models.IntegerField(default=0, verbose_name='送礼次数')),
+                ('gift_diamond_amount', models.DecimalField(decimal_places=2, default=0, max_digits=18, verbose_name='礼物钻石数')),
+                ('live_count', models.IntegerField(default=0, verbose_name='开播场数')),
+                ('live_minutes', models.IntegerField(default=0, help_text='当天处于直播中的总时长，跨天的直播按每天的部分分别计入', verbose_name='直播分钟数')),
+                ('peak_viewer_count', models.IntegerField(default=0, help_text='按观看记录的进入、离开时间计算', verbose_name='最高同时观看人数')),
+                ('is_closed', models.BooleanField(default=False, verbose_name='是否已结算')),
+                ('date_updated', models.DateTimeField(auto_now=True, verbose_name='更新时间')),
+            ],
+            options={
+                'verbose_name': '每日统计',
+                'verbose_name_plural': '每日统计',
+                'db_table': 'core_daily_statistic',
+            },
+        ),
+    ]
@@ -2,6 +2,12 @@ from django_base.models import *
 from django_finance.models import *
 from django_member.models import *
 
+from bisect import bisect_right
+from collections import defaultdict
+
+from django.db import transaction, IntegrityError
+from django.db.models.functions import Coalesce, Greatest
+
 
 @patch_methods(User)
 class UserPatcher:
@@ -81,11 +87,62 @@ class InformableModel(models.Model):
                and self.protect_from < datetime.now() < self.protect_until
 
 
+class LevelCurve:
+    """ 等级曲线
+    由 level_rules 编译得到的累计经验分段表，按总经验二分查找等级。
+    level_rules 格式：{"level_1": [{"value": 每级经验}, ...5], "level_more": [{"value": 每级经验}, ...4]}
+    大等级 1 分 5 段（1~20, 21~40, 41~60, 61~80, 81~99 小等级），大等级 2~5 各 99 个小等级
+    """
+    # 缓存 (level_rules 原始值, 编译结果)，选项变化时原始值不同即重新编译
+    _cache = None
+
+    def __init__(self, rules):
+        # 每段：(起始累计经验, 大等级, 起始小等级, 每级经验, 小等级数)
+        self.segments = []
+        total = 0
+        for i, count in enumerate((20, 20, 20, 20, 19)):
+            step = rules.get('level_1')[i].get('value')
+            self.segments.append((total, 1, 1 + i * 20, step, count))
+            total += step * count
+        for i in range(4):
+            step = rules.get('level_more')[i].get('value')
+            self.segments.append((total, i + 2, 1, step, 99))
+            total += step * 99
+        self.starts = [segment[0] for segment in self.segments]
+        self.max_experience = total
+
+    @classmethod
+    def get(cls):
+        """ 获取当前 level_rules 对应的等级曲线，没有配置时返回 None
+        :return: LevelCurve
+        """
+        value = Option.get('level_rules')
+        if not value:
+            return None
+        cache = cls._cache
+        if cache and cache[0] == value:
+            return cache[1]
+        curve = cls(Option.get_json('level_rules'))
+        cls._cache = (value, curve)
+        return curve
+
+    def get_level(self, total_experience):
+        """ 根据总经验计算等级
+        :param total_experience: 总经验
+        :return: (large_level, small_level, current_level_experience)
+        """
+        i = max(bisect_right(self.starts, total_experience) - 1, 0)
+        start, large_level, small_level, step, count = self.segments[i]
+        # 超出曲线最高等级时停留在最高等级
+        n = min(int((total_experience - start) / step), count - 1)
+        return large_level, small_level + n, total_experience - start - n * step
+
+
 class Member(AbstractMember,
              InformableModel,
              UserMarkableModel):
     """ 会员
-    注意：用户的追踪状态通过 UserMark 的 subject=follow 类型实现
+    注意：用户的追踪关系保存在 Follow 表，同时保留 UserMark 的 subject=follow 记录用于追踪提醒
     """
     relative_id = models.IntegerField(
         verbose_name='相对id',
@@ -182,6 +239,14 @@ class Member(AbstractMember,
         blank=True,
     )
 
+    date_vip_expire = models.DateTimeField(
+        verbose_name='VIP到期时间',
+        null=True,
+        blank=True,
+        db_index=True,
+        help_text='到期后由 expire_vip 任务降一级，仍有 VIP 等级则再顺延 30 天',
+    )
+
     amount_extend = models.DecimalField(
         verbose_name='VIP续等余额',
         decimal_places=2,
@@ -233,6 +298,18 @@ class Member(AbstractMember,
         default=True,
     )
 
+    follow_count = models.IntegerField(
+        verbose_name='追蹤數',
+        default=0,
+        help_text='由 Follow.set 维护',
+    )
+
+    followed_count = models.IntegerField(
+        verbose_name='粉絲數',
+        default=0,
+        help_text='由 Follow.set 维护',
+    )
+
     stream_id = models.CharField(
         verbose_name='直播码',
         max_length=100,
@@ -245,6 +322,9 @@ class Member(AbstractMember,
         verbose_name_plural = '会员'
         db_table = 'core_member'
 
+    # 由 SQL 增量维护的计数：追踪数、粉丝数由 Follow.set，总经验由 ExperienceTransaction.make
+    COUNTER_FIELDS = ('follow_count', 'followed_count', 'total_experience')
+
     def delete(self, *args, **kwargs):
         from django_base.middleware import get_request
         user = get_request().user
@@ -254,6 +334,16 @@ class Member(AbstractMember,
 
     def save(self, *args, **kwargs):
         from django_base.middleware import get_request
+        if not self._state.adding and 'update_fields' not in kwargs:
+            # 计数字段只由 SQL 增量维护，保存资料时不覆盖
+            kwargs['update_fields'] = [
+                field.name for field in self._meta.concrete_fields
+                if not field.primary_key and field.name not in Member.COUNTER_FIELDS
+            ]
+        old_levels = None
+        if not self._state.adding and {'vip_level', 'large_level'} & set(kwargs['update_fields']):
+            # 等级变化时同步直播间的高等级观众计数
+            old_levels = Member.objects.filter(pk=self.pk).values_list('vip_level', 'large_level').first()
         user = get_request().user
         if user.is_staff and self.user and not self.is_del:
             super().save(*args, **kwargs)
@@ -304,6 +394,9 @@ class Member(AbstractMember,
                         self.relative_id = relative_id
                         flag = False
         super().save(*args, **kwargs)
+        if old_levels and old_levels != (self.vip_level, self.large_level):
+            LiveCounter.on_levels_changed(self.user_id, LiveCounter.get_level_tiers(*old_levels),
+                                          LiveCounter.get_tiers(self))
 
     def load_tencent_sig(self, force=False):
         from tencent import auth
@@ -330,7 +423,7 @@ class Member(AbstractMember,
         raise NotImplemented()
 
     def is_followed_by(self, user):
-        return self.is_marked_by(user, 'follow')
+        return Follow.objects.filter(author=user, user_id=self.user_id).exists()
 
     def is_followed_by_current_user(self):
         """ 返回用戶是否被當前登錄用戶跟蹤
@@ -348,26 +441,22 @@ class Member(AbstractMember,
         :param is_follow: True 設置爲跟蹤，False 取消跟蹤
         :return:
         """
-        self.set_marked_by(user, 'follow', is_follow)
+        if not Follow.set(user, self.user, is_follow):
+            return
+        if self.set_marked_by(user, 'follow', is_follow):
+            Conversation.on_follow(user, self)
 
     def get_follow(self):
         """ 獲取會員跟蹤（關注）的用戶列表
         :return:
         """
-        return Member.get_objects_marked_by(self.user, 'follow')
+        return Member.objects.filter(user__follows_related__author=self.user)
 
     def get_followed(self):
         """ 獲取跟蹤當前會員的用戶（粉絲）列表
         :return:
         """
-        return Member.objects.filter(
-            user__usermarks_owned__content_type=ContentType.objects.get(
-                app_label=type(self)._meta.app_label,
-                model=type(self)._meta.model_name,
-            ),
-            user__usermarks_owned__object_id=self.pk,
-            user__usermarks_owned__subject='follow',
-        )
+        return Member.objects.filter(user__follows_owned__user=self.user)
 
     def get_blacklist(self):
         """获取会员标记黑名单列表"""
@@ -383,13 +472,13 @@ class Member(AbstractMember,
         """ 獲取跟蹤數
         :return:
         """
-        return self.get_follow().count()
+        return self.follow_count
 
     def get_followed_count(self):
         """ 獲取粉絲數（被跟蹤數）
         :return:
         """
-        return self.get_followed().count()
+        return self.followed_count
 
     def get_contacts(self):
         """ 獲取聯繫人列表
@@ -451,39 +540,30 @@ class Member(AbstractMember,
     #     #     amount=models.Sum('amount')
     #     # ).get('amount') or 0
 
+    def get_wallet(self):
+        """ 用户钱包，同一会员对象只读取一次，查询集 select_related('user__wallet') 时不再查询
+        :return: Wallet
+        """
+        if not hasattr(self, '_wallet'):
+            try:
+                self._wallet = self.user.wallet
+            except Wallet.DoesNotExist:
+                self._wallet = Wallet.get(self.user)
+        return self._wallet
+
     def get_diamond_balance(self):
         # 钻石余额
-        # 支出鑽石數
-        credit_diamond = self.user.creditdiamondtransactions_credit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        # 收入鑽石數
-        debit_diamond = self.user.creditdiamondtransactions_debit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        return debit_diamond - credit_diamond
+        return self.get_wallet().diamond
 
     def get_coin_balance(self):
         # 金币余额
-        # 支出金币
-        credit_coin = self.user.creditcointransactions_credit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        # 收入金币
-        debit_coin = self.user.creditcointransactions_debit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        return debit_coin - credit_coin
+        return self.get_wallet().coin
 
     def get_star_index_sender_balance(self):
-        credit = self.user.creditstarindexsendertransactions_credit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        debit = self.user.creditstarindexsendertransactions_debit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        return debit - credit
+        return self.get_wallet().star_index_sender
 
     def get_star_index_receiver_balance(self):
-        credit = self.user.creditstarindexreceivertransactions_credit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        debit = self.user.creditstarindexreceivertransactions_debit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        return debit - credit
+        return self.get_wallet().star_index_receiver
 
     def total_recharge(self):
         amount = self.user.rechargerecords_owned.aggregate(
@@ -509,11 +589,7 @@ class Member(AbstractMember,
     def get_star_balance(self):
         """星星（元气）余额
         """
-        credit_star = self.user.creditstartransactions_credit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        debit_star = self.user.creditstartransactions_debit.aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
-        return debit_star - credit_star
+        return self.get_wallet().star
 
     # def get_star_prize_expend(self):
     #     """元气礼物赠送的元气数量，观众背包礼物宝盒礼物使用，每500开一个礼盒
@@ -589,7 +665,7 @@ class Member(AbstractMember,
         獲得用戶等級
         :return:
         """
-        level_rules = json.loads(Option.get('level_rules') or '[]')
+        level_rules = Option.get_json('level_rules', [])
         if not level_rules:
             return 1
         return self.small_level
@@ -620,7 +696,7 @@ class Member(AbstractMember,
         """
         if not Option.get('vip_rules'):
             return 0
-        vip_rules = json.loads(Option.get('vip_rules'))
+        vip_rules = Option.get_json('vip_rules')
         current_vip_level = self.vip_level
         # 最近一个月的储值量
         amount_this_month = self.get_recharge_this_month(recharge_record.date_created)
@@ -678,9 +754,10 @@ class Member(AbstractMember,
         self.vip_upgrade_award(level)
         if date_update_vip:
             self.date_update_vip = date_update_vip
-            self.make_update_vip_plan(date_update_vip + timedelta(days=30 * level), self.user_id)
+            self.date_vip_expire = date_update_vip + timedelta(days=30 * level)
         elif date_update_vip == 0:
-            self.make_update_vip_plan(None, self.user_id)
+            # 续等，到期时间顺延 30 天
+            self.date_vip_expire = (self.date_vip_expire or datetime.now()) + timedelta(days=30)
         if amount_extend:
             self.amount_extend += amount_extend
         else:
@@ -723,28 +800,44 @@ class Member(AbstractMember,
                 )
 
     @staticmethod
-    def make_update_vip_plan(date_planned, member_id):
-        planned_task = PlannedTask.objects.filter(
-            method='change_vip_level',
-            args__exact=json.dumps([member_id]),
-        ).first()
-        if not planned_task:
-            PlannedTask.make('change_vip_level', date_planned, json.dumps([member_id]))
-            return
-        if not date_planned:
-            planned_task.date_planned += timedelta(days=30)
-        else:
-            planned_task.date_planned = date_planned
-        planned_task.save()
+    def expire_vip(now=None):
+        """ 批量处理 VIP 到期的会员
+        到期降一级；降级后仍有 VIP 等级的，到期时间顺延 30 天，降为 0 级的清除到期时间
+        顺延后仍已到期（长时间未执行）的会在下一轮继续降级
+        :return: 降级的人次
+        """
+        now = now or datetime.now()
+        downgraded = 0
+        while True:
+            expired = Member.objects.filter(date_vip_expire__lte=now)
+            # 正在直播间内的会员降级后要调整直播间的高等级观众计数
+            watching = list(expired.filter(
+                vip_level__gt=0,
+                user_id__in=LiveWatchLog.objects.filter(live__date_end=None).values('author_id'),
+            ).values_list('user_id', 'vip_level', 'large_level'))
+            count = expired.filter(vip_level__gt=1).update(
+                vip_level=models.F('vip_level') - 1,
+                date_update_vip=now,
+                is_vip_demand=False,
+                date_vip_expire=models.F('date_vip_expire') + timedelta(days=30),
+            )
+            count += expired.filter(vip_level=1).update(
+                vip_level=0,
+                date_update_vip=now,
+                is_vip_demand=False,
+                date_vip_expire=None,
+            )
+            # 已经不是 VIP 的只清除到期时间
+            expired.filter(vip_level__lte=0).update(date_vip_expire=None)
+            for user_id, vip_level, large_level in watching:
+                LiveCounter.on_levels_changed(user_id, LiveCounter.get_level_tiers(vip_level, large_level),
+                                              LiveCounter.get_level_tiers(vip_level - 1, large_level))
+            if not count:
+                return downgraded
+            downgraded += count
 
     def get_vip_end_time(self):
-        planned_task = PlannedTask.objects.filter(
-            method='change_vip_level',
-            args__exact=json.dumps([self.user_id]),
-        ).first()
-        if not planned_task:
-            return None
-        return planned_task.date_planned
+        return self.date_vip_expire
 
     def get_today_watch_mission_count(self):
         """当前用户当天完成观看任务次数
@@ -968,69 +1061,106 @@ class Member(AbstractMember,
     def update_level(self):
         """
         更新用户的等级
+        总经验由 ExperienceTransaction.make 增量维护，这里从数据库读取最新值后按等级曲线换算
         :return:
         """
-        large_level = self.large_level
-        small_level = self.small_level
-        current_level_exp = self.current_level_experience
-        total_experience = ExperienceTransaction.objects.filter(author=self.user).aggregate(
-            amount=models.Sum('experience')).get('amount') or 0
-        if not Option.get('level_rules'):
+        curve = LevelCurve.get()
+        if not curve:
             return
-        rules = json.loads(Option.get('level_rules'))
-        level1 = rules.get('level_1')[0].get('value') * 20
-        level2 = rules.get('level_1')[1].get('value') * 20 + level1
-        level3 = rules.get('level_1')[2].get('value') * 20 + level2
-        level4 = rules.get('level_1')[3].get('value') * 20 + level3
-        level5 = rules.get('level_1')[4].get('value') * 19 + level4
-        level6 = rules.get('level_more')[0].get('value') * 99 + level5
-        level7 = rules.get('level_more')[1].get('value') * 99 + level6
-        level8 = rules.get('level_more')[2].get('value') * 99 + level7
-        level9 = rules.get('level_more')[3].get('value') * 99 + level8
-        total_exp_list = [0, level1, level2, level3, level4, level5, level6, level7, level8, level9]
-        for i in range(0, 9):
-            if total_exp_list[i] <= total_experience < total_exp_list[i + 1]:
-                if i == 0:
-                    large_level = 1
-                    small_level = 1 + int(total_experience / rules.get('level_1')[0].get('value'))
-                    current_level_exp = total_experience % rules.get('level_1')[0].get('value')
-                if i == 1:
-                    large_level = 1
-                    small_level = 21 + int((total_experience - level1) / rules.get('level_1')[1].get('value'))
-                    current_level_exp = (total_experience - level1) % rules.get('level_1')[1].get('value')
-                if i == 2:
-                    large_level = 1
-                    small_level = 41 + int((total_experience - level2) / rules.get('level_1')[2].get('value'))
-                    current_level_exp = (total_experience - level2) % rules.get('level_1')[2].get('value')
-                if i == 3:
-                    large_level = 1
-                    small_level = 61 + int((total_experience - level3) / rules.get('level_1')[3].get('value'))
-                    current_level_exp = (total_experience - level3) % rules.get('level_1')[3].get('value')
-                if i == 4:
-                    large_level = 1
-                    small_level = 81 + int((total_experience - level4) / rules.get('level_1')[4].get('value'))
-                    current_level_exp = (total_experience - level4) % rules.get('level_1')[4].get('value')
-                if i == 5:
-                    large_level = 2
-                    small_level = 1 + int((total_experience - level5) / rules.get('level_more')[0].get('value'))
-                    current_level_exp = (total_experience - level5) % rules.get('level_more')[0].get('value')
-                if i == 6:
-                    large_level = 3
-                    small_level = 1 + int((total_experience - level6) / rules.get('level_more')[1].get('value'))
-                    current_level_exp = (total_experience - level6) % rules.get('level_more')[1].get('value')
-                if i == 6:
-                    large_level = 4
-                    small_level = 1 + int((total_experience - level7) / rules.get('level_more')[2].get('value'))
-                    current_level_exp = (total_experience - level7) % rules.get('level_more')[2].get('value')
-                if i == 7:
-                    large_level = 5
-                    small_level = 1 + int((total_experience - level8) / rules.get('level_more')[3].get('value'))
-                    current_level_exp = (total_experience - level8) % rules.get('level_more')[3].get('value')
-        self.small_level = small_level
-        self.large_level = large_level
-        self.total_experience = total_experience
-        self.current_level_experience = current_level_exp
-        self.save()
+        self.total_experience = Member.objects.filter(pk=self.pk).values_list(
+            'total_experience', flat=True).first() or 0
+        self.large_level, self.small_level, self.current_level_experience = \
+            curve.get_level(self.total_experience)
+        self.save(update_fields=['large_level', 'small_level', 'current_level_experience'])
+
+
+class Follow(models.Model):
+    """ 追踪关系
+    author 追踪 user，两个方向都有索引，双方会员上的追踪数、粉丝数由 Follow.set 同步维护
+    """
+    author = models.ForeignKey(
+        verbose_name='追踪者',
+        to=User,
+        related_name='follows_owned',
+    )
+
+    user = models.ForeignKey(
+        verbose_name='被追踪者',
+        to=User,
+        related_name='follows_related',
+    )
+
+    date_created = models.DateTimeField(
+        verbose_name='追踪时间',
+        auto_now_add=True,
+    )
+
+    CHUNK_SIZE = 1000
+
+    class Meta:
+        verbose_name = '追踪关系'
+        verbose_name_plural = '追踪关系'
+        db_table = 'core_follow'
+        unique_together = [('author', 'user')]
+        index_together = [('user', 'author')]
+
+    @staticmethod
+    def set(author, user, is_follow=True):
+        """ 设置或取消 author 对 user 的追踪
+        :param author: 发起追踪的用户
+        :param user: 被追踪的用户
+        :param is_follow: True 追踪，False 取消追踪
+        :return: 追踪关系是否发生变化
+        """
+        with transaction.atomic():
+            if is_follow:
+                try:
+                    with transaction.atomic():
+                        Follow.objects.create(author=author, user=user)
+                except IntegrityError:
+                    return False
+            elif not Follow.objects.filter(author=author, user=user).delete()[0]:
+                return False
+            delta = 1 if is_follow else -1
+            Member.objects.filter(user=author).update(follow_count=models.F('follow_count') + delta)
+            Member.objects.filter(user=user).update(followed_count=models.F('followed_count') + delta)
+        return True
+
+    @staticmethod
+    def get_following_ids(author, user_ids):
+        """ 批量查询 author 追踪了 user_ids 中的哪些用户
+        :param author: 用户，未登录时返回空集合
+        :param user_ids: 用户 id 列表
+        :return: set(user_id)
+        """
+        if not author or author.is_anonymous:
+            return set()
+        user_ids = list(set(user_ids))
+        following_ids = set()
+        for i in range(0, len(user_ids), Follow.CHUNK_SIZE):
+            following_ids.update(Follow.objects.filter(
+                author=author,
+                user_id__in=user_ids[i:i + Follow.CHUNK_SIZE],
+            ).values_list('user_id', flat=True))
+        return following_ids
+
+    @staticmethod
+    def rebuild_counts():
+        """ 按追踪关系重新计算全部会员的追踪数和粉丝数
+        :return:
+        """
+        with transaction.atomic():
+            Member.objects.update(follow_count=0, followed_count=0)
+            for field, group_field in (('follow_count', 'author'), ('followed_count', 'user')):
+                user_ids_by_count = defaultdict(list)
+                for user_id, count in Follow.objects.values_list(group_field).annotate(
+                        count=models.Count('id')).order_by():
+                    user_ids_by_count[count].append(user_id)
+                for count, user_ids in user_ids_by_count.items():
+                    for i in range(0, len(user_ids), Follow.CHUNK_SIZE):
+                        Member.objects.filter(
+                            user_id__in=user_ids[i:i + Follow.CHUNK_SIZE],
+                        ).update(**{field: count})
 
 
 class LoginRecord(UserOwnedModel):
@@ -1099,7 +1229,7 @@ class ExperienceTransaction(EntityModel, UserOwnedModel):
     def make(author, experience, transaction_type, is_vip_double=True):
         # vip 经验值提升
         if is_vip_double and author.member.vip_level > 0 and Option.get('vip_rules'):
-            vip_rules = json.loads(Option.get('vip_rules'))
+            vip_rules = Option.get_json('vip_rules')
             if vip_rules[author.member.vip_level - 1].get('experience_double') > 1:
                 experience = int(experience * vip_rules[author.member.vip_level - 1].get('experience_double'))
         experience_transaction = ExperienceTransaction.objects.create(
@@ -1107,6 +1237,11 @@ class ExperienceTransaction(EntityModel, UserOwnedModel):
             experience=experience,
             type=transaction_type,
         )
+        # 增量累计会员总经验
+        Member.objects.filter(user=author).update(
+            total_experience=models.F('total_experience') + experience,
+        )
+        author.member.total_experience += experience
         return experience_transaction
 
     def update_level(self):
@@ -1114,68 +1249,7 @@ class ExperienceTransaction(EntityModel, UserOwnedModel):
         根据当前经验流水，更新用户等级
         :return:
         """
-        member = self.author.member
-        large_level = member.large_level
-        small_level = member.small_level
-        current_level_exp = member.current_level_experience
-        total_experience = ExperienceTransaction.objects.filter(author=self.author).aggregate(
-            amount=models.Sum('experience')).get('amount') or 0
-        if not Option.get('level_rules'):
-            return
-        rules = json.loads(Option.get('level_rules'))
-        level1 = rules.get('level_1')[0].get('value') * 20
-        level2 = rules.get('level_1')[1].get('value') * 20 + level1
-        level3 = rules.get('level_1')[2].get('value') * 20 + level2
-        level4 = rules.get('level_1')[3].get('value') * 20 + level3
-        level5 = rules.get('level_1')[4].get('value') * 19 + level4
-        level6 = rules.get('level_more')[0].get('value') * 99 + level5
-        level7 = rules.get('level_more')[1].get('value') * 99 + level6
-        level8 = rules.get('level_more')[2].get('value') * 99 + level7
-        level9 = rules.get('level_more')[3].get('value') * 99 + level8
-        total_exp_list = [0, level1, level2, level3, level4, level5, level6, level7, level8, level9]
-        for i in range(0, 9):
-            if total_exp_list[i] <= total_experience < total_exp_list[i + 1]:
-                if i == 0:
-                    large_level = 1
-                    small_level = 1 + int(total_experience / rules.get('level_1')[0].get('value'))
-                    current_level_exp = total_experience % rules.get('level_1')[0].get('value')
-                if i == 1:
-                    large_level = 1
-                    small_level = 21 + int((total_experience - level1) / rules.get('level_1')[1].get('value'))
-                    current_level_exp = (total_experience - level1) % rules.get('level_1')[1].get('value')
-                if i == 2:
-                    large_level = 1
-                    small_level = 41 + int((total_experience - level2) / rules.get('level_1')[2].get('value'))
-                    current_level_exp = (total_experience - level2) % rules.get('level_1')[2].get('value')
-                if i == 3:
-                    large_level = 1
-                    small_level = 61 + int((total_experience - level3) / rules.get('level_1')[3].get('value'))
-                    current_level_exp = (total_experience - level3) % rules.get('level_1')[3].get('value')
-                if i == 4:
-                    large_level = 1
-                    small_level = 81 + int((total_experience - level4) / rules.get('level_1')[4].get('value'))
-                    current_level_exp = (total_experience - level4) % rules.get('level_1')[4].get('value')
-                if i == 5:
-                    large_level = 2
-                    small_level = 1 + int((total_experience - level5) / rules.get('level_more')[0].get('value'))
-                    current_level_exp = (total_experience - level5) % rules.get('level_more')[0].get('value')
-                if i == 6:
-                    large_level = 3
-                    small_level = 1 + int((total_experience - level6) / rules.get('level_more')[1].get('value'))
-                    current_level_exp = (total_experience - level6) % rules.get('level_more')[1].get('value')
-                if i == 6:
-                    large_level = 4
-                    small_level = 1 + int((total_experience - level7) / rules.get('level_more')[2].get('value'))
-                    current_level_exp = (total_experience - level7) % rules.get('level_more')[2].get('value')
-                if i == 7:
-                    large_level = 5
-                    small_level = 1 + int((total_experience - level8) / rules.get('level_more')[3].get('value'))
-                    current_level_exp = (total_experience - level8) % rules.get('level_more')[3].get('value')
-        member.small_level = small_level
-        member.large_level = large_level
-        member.total_experience = total_experience
-        member.current_level_experience = current_level_exp
-        member.save()
+        self.author.member.update_level()
 
 
 class Robot(models.Model):
@@ -1300,7 +1374,258 @@ class CelebrityCategory(EntityModel):
         return dict(category_id=None, category_name=None)
 
 
-class CreditStarTransaction(AbstractTransactionModel):
+class Wallet(models.Model):
+    """ 用户钱包余额
+    各类流水的物化余额，每写入一条流水在同一事务内更新对应字段，
+    读取余额时不再需要对流水表做聚合，流水表仍然是唯一的权威数据，
+    可以通过 manage.py rebuild_wallet 从流水重建或对账
+    """
+    user = models.OneToOneField(
+        verbose_name='用户',
+        to=User,
+        related_name='wallet',
+        primary_key=True,
+    )
+
+    coin = models.DecimalField(
+        verbose_name='金币余额',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    diamond = models.DecimalField(
+        verbose_name='钻石余额',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    star = models.DecimalField(
+        verbose_name='星星（元气）余额',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    star_index_sender = models.DecimalField(
+        verbose_name='星光指数余额（送礼）',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    star_index_receiver = models.DecimalField(
+        verbose_name='星光指数余额（收礼）',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    date_updated = models.DateTimeField(
+        verbose_name='更新时间',
+        auto_now=True,
+    )
+
+    class Meta:
+        verbose_name = '用户钱包'
+        verbose_name_plural = '用户钱包'
+        db_table = 'core_wallet'
+
+    @staticmethod
+    def get_transaction_models():
+        """ 余额字段与对应流水模型
+        :return: [(field, model), ...]
+        """
+        return [
+            ('coin', CreditCoinTransaction),
+            ('diamond', CreditDiamondTransaction),
+            ('star', CreditStarTransaction),
+            ('star_index_sender', CreditStarIndexSenderTransaction),
+            ('star_index_receiver', CreditStarIndexReceiverTransaction),
+        ]
+
+    @staticmethod
+    def compute_balances(user):
+        """ 从流水表聚合计算用户各项余额
+        :param user: 用户
+        :return: dict(field=balance)
+        """
+        balances = dict()
+        for field, model in Wallet.get_transaction_models():
+            debit = model.objects.filter(user_debit=user).aggregate(
+                amount=models.Sum('amount')).get('amount') or 0
+            credit = model.objects.filter(user_credit=user).aggregate(
+                amount=models.Sum('amount')).get('amount') or 0
+            balances[field] = debit - credit
+        return balances
+
+    @staticmethod
+    def get(user):
+        """ 获取用户钱包，不存在时从流水表初始化
+        :param user: 用户
+        :return: Wallet
+        """
+        wallet = Wallet.objects.filter(user=user).first()
+        if wallet:
+            return wallet
+        try:
+            with transaction.atomic():
+                return Wallet.objects.create(user=user, **Wallet.compute_balances(user))
+        except IntegrityError:
+            # 并发情况下其他请求已经创建
+            return Wallet.objects.get(user=user)
+
+    @staticmethod
+    def apply(user, field, amount):
+        """ 对用户钱包的某项余额增加 amount（可为负数）
+        使用 F 表达式在数据库中累加，避免读改写覆盖并发更新
+        :param user: 用户
+        :param field: 余额字段
+        :param amount: 变动金额
+        """
+        if not user or not amount:
+            return
+        Wallet.get(user)
+        Wallet.objects.filter(user=user).update(**{field: models.F(field) + amount})
+
+    @staticmethod
+    def lock(user, *others):
+        """ 在当前事务中锁定用户钱包行（SELECT ... FOR UPDATE）
+        同一用户的扣费操作会在此排队，需在 transaction.atomic() 内调用
+        同时涉及多个用户时按 user_id 顺序加锁，避免互相送礼时死锁
+        :param user: 用户
+        :param others: 同一事务中会变动余额的其他用户
+        :return: user 的 Wallet
+        """
+        users = [user] + [other for other in others if other]
+        for item in users:
+            Wallet.get(item)
+        wallets = Wallet.objects.select_for_update().filter(
+            user__in=users,
+        ).order_by('user_id')
+        return {wallet.user_id: wallet for wallet in wallets}[user.pk]
+
+    @staticmethod
+    def apply_transactions(transactions, sign=1):
+        """ 把一批已写入的流水计入钱包，同一用户的多项变动合并为一条 UPDATE
+        流水需以 save(apply_wallet=False) 写入；钱包尚不存在的用户跳过，第一次读取时会从流水表初始化
+        :param transactions: 流水列表，可以包含 None
+        :param sign: 1 为计入，-1 为冲销
+        """
+        deltas = dict()
+        for item in transactions:
+            if not item:
+                continue
+            for user_id, side in ((item.user_debit_id, sign), (item.user_credit_id, -sign)):
+                if not user_id:
+                    continue
+                fields = deltas.setdefault(user_id, dict())
+                fields[item.wallet_field] = fields.get(item.wallet_field, 0) + side * item.amount
+        for user_id, fields in deltas.items():
+            fields = {field: models.F(field) + amount for field, amount in fields.items() if amount}
+            if fields:
+                Wallet.objects.filter(user_id=user_id).update(**fields)
+
+    @staticmethod
+    def rebuild(user):
+        """ 从流水表重建用户钱包
+        :param user: 用户
+        :return: Wallet
+        """
+        wallet, created = Wallet.objects.get_or_create(user=user)
+        for field, balance in Wallet.compute_balances(user).items():
+            setattr(wallet, field, balance)
+        wallet.save()
+        return wallet
+
+    def reconcile(self):
+        """ 对账，返回物化余额与流水聚合结果不一致的字段
+        :return: dict(field=(wallet_balance, ledger_balance))
+        """
+        diff = dict()
+        for field, balance in Wallet.compute_balances(self.user).items():
+            if getattr(self, field) != balance:
+                diff[field] = (getattr(self, field), balance)
+        return diff
+
+
+class WalletTransactionQuerySet(models.QuerySet):
+    """ 流水的批量写入、修改、删除同样在同一事务内同步钱包余额
+    只写流水、由调用方自行维护钱包时，bulk_create 传入 apply_wallet=False
+    """
+    # 修改这些字段会影响余额
+    WALLET_FIELDS = ('amount', 'user_debit', 'user_credit', 'user_debit_id', 'user_credit_id')
+
+    def bulk_create(self, objs, batch_size=None, apply_wallet=True):
+        if not apply_wallet:
+            return super().bulk_create(objs, batch_size)
+        with transaction.atomic(using=self.db):
+            objs = super().bulk_create(list(objs), batch_size)
+            Wallet.apply_transactions(objs)
+        return objs
+
+    def update(self, **kwargs):
+        if not any(field in kwargs for field in self.WALLET_FIELDS):
+            return super().update(**kwargs)
+        with transaction.atomic(using=self.db):
+            # 先冲销原流水，修改后按新值重新计入
+            old = list(self.select_for_update())
+            Wallet.apply_transactions(old, -1)
+            count = super().update(**kwargs)
+            Wallet.apply_transactions(self.model.objects.filter(pk__in=[item.pk for item in old]))
+        return count
+
+    update.alters_data = True
+
+    def delete(self):
+        with transaction.atomic(using=self.db):
+            Wallet.apply_transactions(list(self.select_for_update()), -1)
+            return super().delete()
+
+    delete.alters_data = True
+    delete.queryset_only = True
+
+
+class WalletTransactionModel(AbstractTransactionModel):
+    """ 会影响钱包余额的流水
+    写入、修改、删除流水时在同一事务内同步更新 Wallet 对应字段，批量操作见 WalletTransactionQuerySet
+    """
+    # 对应 Wallet 上的余额字段
+    wallet_field = None
+
+    objects = WalletTransactionQuerySet.as_manager()
+
+    class Meta:
+        abstract = True
+
+    def apply_wallet(self, sign=1):
+        Wallet.apply(self.user_debit, self.wallet_field, sign * self.amount)
+        Wallet.apply(self.user_credit, self.wallet_field, -sign * self.amount)
+
+    def save(self, *args, apply_wallet=True, **kwargs):
+        if not apply_wallet:
+            # 由调用方负责通过 Wallet.apply_transactions 批量计入钱包
+            return super().save(*args, **kwargs)
+        with transaction.atomic():
+            if self.pk:
+                # 修改流水时先冲销原流水
+                old = type(self).objects.filter(pk=self.pk).first()
+                if old:
+                    old.apply_wallet(-1)
+            # 钱包需在写入流水前初始化，否则初始化时会把本条流水重复计入
+            self.user_debit and Wallet.get(self.user_debit)
+            self.user_credit and Wallet.get(self.user_credit)
+            super().save(*args, **kwargs)
+            self.apply_wallet()
+
+    def delete(self, *args, **kwargs):
+        with transaction.atomic():
+            self.apply_wallet(-1)
+            return super().delete(*args, **kwargs)
+
+
+class CreditStarTransaction(WalletTransactionModel):
     """ 元气流水
     每日签到或者元气任务可以获得元气，元气可用于购买赠送元气礼品
     """
@@ -1323,13 +1648,15 @@ class CreditStarTransaction(AbstractTransactionModel):
         choices=TYPE_CHOICES,
     )
 
+    wallet_field = 'star'
+
     class Meta:
         verbose_name = '星星（元气）流水'
         verbose_name_plural = '星星（元气）流水'
         db_table = 'core_credit_star_transaction'
 
 
-class CreditStarIndexReceiverTransaction(AbstractTransactionModel):
+class CreditStarIndexReceiverTransaction(WalletTransactionModel):
     """ 元气指数（收礼产生类）
     主播用户收到元气礼品时可以获得此类指数，每达到 500 个就可以换一个元气宝盒
     """
@@ -1346,13 +1673,15 @@ class CreditStarIndexReceiverTransaction(AbstractTransactionModel):
         choices=TYPE_CHOICES,
     )
 
+    wallet_field = 'star_index_receiver'
+
     class Meta:
         verbose_name = '星光指数（元氣）流水（收礼）'
         verbose_name_plural = '星光指数（元氣）流水（收礼）'
         db_table = 'core_credit_star_index_receiver_transaction'
 
 
-class CreditStarIndexSenderTransaction(AbstractTransactionModel):
+class CreditStarIndexSenderTransaction(WalletTransactionModel):
     """ 元气指数（送礼产生类）
     用户送出元气礼品时可以获得此类指数，每达到 500 个就可以换一个元气宝盒
     """
@@ -1370,13 +1699,15 @@ class CreditStarIndexSenderTransaction(AbstractTransactionModel):
         choices=TYPE_CHOICES,
     )
 
+    wallet_field = 'star_index_sender'
+
     class Meta:
         verbose_name = '星光指数（元氣）流水（送礼）'
         verbose_name_plural = '星光指数（元氣）流水（送礼）'
         db_table = 'core_credit_star_index_sender_transaction'
 
 
-class CreditDiamondTransaction(AbstractTransactionModel):
+class CreditDiamondTransaction(WalletTransactionModel):
     TYPE_ADMIN = 'ADMIN'
     TYPE_LIVE_GIFT = 'LIVE_GIFT'
     TYPE_EXCHANGE = 'EXCHANGE'
@@ -1401,13 +1732,15 @@ class CreditDiamondTransaction(AbstractTransactionModel):
         choices=TYPE_CHOICES,
     )
 
+    wallet_field = 'diamond'
+
     class Meta:
         verbose_name = '钻石流水'
         verbose_name_plural = '钻石流水'
         db_table = 'core_credit_diamond_transaction'
 
 
-class CreditCoinTransaction(AbstractTransactionModel):
+class CreditCoinTransaction(WalletTransactionModel):
     TYPE_ADMIN = 'ADMIN'
     TYPE_LIVE_GIFT = 'LIVE_GIFT'
     TYPE_RECHARGE = 'RECHARGE'
@@ -1441,6 +1774,8 @@ class CreditCoinTransaction(AbstractTransactionModel):
         choices=TYPE_CHOICES,
     )
 
+    wallet_field = 'coin'
+
     class Meta:
         verbose_name = '金币流水'
         verbose_name_plural = '金币流水'
@@ -1453,7 +1788,7 @@ class CreditCoinTransaction(AbstractTransactionModel):
         [{"product": "", "coin": int, "money": int, "award": int, "award2": int}]
         :return:
         """
-        rules = json.loads(Option.get('coin_recharge_rules') or '[]')
+        rules = Option.get_json('coin_recharge_rules', [])
         for rule in rules:
             if rule.get('product') == product_id:
                 return rule.get('coin')
@@ -1467,7 +1802,7 @@ class CreditCoinTransaction(AbstractTransactionModel):
         :param product_id:
         :return:
         """
-        rules = json.loads(Option.get('coin_recharge_rules') or '[]')
+        rules = Option.get_json('coin_recharge_rules', [])
         for rule in rules:
             if rule.get('product') == product_id:
                 if is_first:
@@ -2117,100 +2452,753 @@ class FamilyMember(UserOwnedModel):
         return True
 
 
-class FamilyArticle(UserOwnedModel,
-                    EntityModel):
-    family = models.ForeignKey(
-        verbose_name='家族',
-        to='Family',
-        related_name='articles',
+class Conversation(models.Model):
+    """ 会话摘要
+    每个用户的每个会话一行，保存最后一条消息的预览和未读数，聊天列表直接按时间分页读取
+    私聊、家族消息、推送、追踪和动态互动产生时由 Conversation.touch 维护
+    消息类会话的已读状态是水位 last_read_id，id 大于水位的消息为未读，阅读只需推进水位
+    全体推送在用户读取时由 Conversation.deliver_broadcasts 按 last_broadcast_id 拉取写入
+    """
+    owner = models.ForeignKey(
+        verbose_name='用户',
+        to=User,
+        related_name='conversations',
     )
 
-    content = models.TextField(
-        verbose_name='内容',
-        blank=True,
-        default='',
+    TYPE_CHAT = 'chat'
+    TYPE_FAMILY = 'family'
+    TYPE_FOLLOW = 'follow'
+    TYPE_ACTIVEEVENT = 'activeevent'
+    TYPE_ACTIVITY = 'activity'
+    TYPE_SYSTEM = 'system'
+    TYPE_CHOICES = (
+        (TYPE_CHAT, '私聊'),
+        (TYPE_FAMILY, '家族消息'),
+        (TYPE_FOLLOW, '追踪'),
+        (TYPE_ACTIVEEVENT, '动态互动'),
+        (TYPE_ACTIVITY, '活动消息'),
+        (TYPE_SYSTEM, '系统消息'),
     )
 
-    class Meta:
-        verbose_name = '家族文章'
-        verbose_name_plural = '家族文章'
-        db_table = 'core_family_article'
+    type = models.CharField(
+        verbose_name='会话类型',
+        max_length=20,
+        choices=TYPE_CHOICES,
+    )
 
-    def get_author_role(self):
-        """ 返回公告作者的家族角色"""
-        return FamilyMember.objects.filter(
-            family=self.family,
-            author=self.author,
-        ).first().role
+    key = models.CharField(
+        verbose_name='会话标识',
+        max_length=50,
+        help_text='私聊为 chat:对方用户id，家族为 family:家族id，其他类型与会话类型相同',
+    )
 
+    peer = models.ForeignKey(
+        verbose_name='对方用户',
+        to=User,
+        related_name='+',
+        null=True,
+        blank=True,
+    )
 
-class FamilyMission(UserOwnedModel,
-                    EntityModel):
     family = models.ForeignKey(
         verbose_name='家族',
         to='Family',
-        related_name='missions',
+        related_name='+',
+        null=True,
+        blank=True,
     )
 
-    ITEM_WATCH_MASTER_PRIZE = 'WATCH_MASTER_PRIZE'
-    ITEM_WATCH_MASTER_DURATION = 'WATCH_MASTER_DURATION'
-    ITEM_COUNT_WATCH_LOG = 'COUNT_WATCH_LOG'
-    ITEM_COUNT_FOLLOWED = 'COUNT_FOLLOWED'
-    ITEM_COUNT_FRIEND = 'COUNT_FRIEND'
-    ITEM_COUNT_LOGIN = 'COUNT_LOGIN'
-    ITEM_COUNT_INVITE = 'COUNT_INVITE'
-    ITEM_COUNT_SHARE_MASTER_LIVE = 'COUNT_SHARE_MASTER_LIVE'
-    ITEM_COUNT_WATCH_MASTER_LIVE = 'COUNT_WATCH_MASTER_LIVE'
-    ITEM_COUNT_LIVE = 'COUNT_LIVE'
-    ITEM_COUNT_RECEIVE_DIAMOND = 'COUNT_RECEIVE_DIAMOND'
-    ITEM_CHOICES = (
-        (ITEM_WATCH_MASTER_PRIZE, '送家族长礼物额度'),
-        (ITEM_WATCH_MASTER_DURATION, '观看家族长直播时长'),
-        (ITEM_COUNT_WATCH_LOG, '累计观看数'),
-        (ITEM_COUNT_FOLLOWED, '陌生人追踪你的个数'),
-        (ITEM_COUNT_FRIEND, '拥有的好友数'),
-        (ITEM_COUNT_LOGIN, '连续登录天数'),
-        (ITEM_COUNT_INVITE, '邀请好友注册数'),
-        (ITEM_COUNT_SHARE_MASTER_LIVE, '分享家族长直播的分享数'),
-        (ITEM_COUNT_WATCH_MASTER_LIVE, '在家族长直播间的访谈数'),
-        (ITEM_COUNT_LIVE, '连续开播的天数'),
-        (ITEM_COUNT_RECEIVE_DIAMOND, '收到钻石额度'),
+    content = models.TextField(
+        verbose_name='最后一条消息',
+        blank=True,
+        default='',
     )
 
-    mission_item = models.CharField(
-        verbose_name='任务元件',
-        max_length=50,
-        default=ITEM_WATCH_MASTER_PRIZE,
-        choices=ITEM_CHOICES,
+    date_last = models.DateTimeField(
+        verbose_name='最后消息时间',
     )
 
-    mission_item_value = models.IntegerField(
-        verbose_name='任务元件数值',
-        blank=True,
+    unread_count = models.IntegerField(
+        verbose_name='未读数',
         default=0,
-        help_text='指定条件达到所需的数值'
     )
 
-    AWARD_EXPERIENCE_POINTS = 'EXPERIENCE_POINTS'
-    AWARD_ICOIN = 'ICOIN'
-    AWARD_COIN = 'COIN'
-    AWARD_PRIZE = 'PRIZE'
-    AWARD_CONTRIBUTION = 'CONTRIBUTION'
-    AWARD_BADGE = 'BADGE'
-    AWARD_MARQUEE_CONTENT = 'MARQUEE_CONTENT'
-    AWARD_STAR = 'STAR'
-    AWARD_CHOICES = (
-        (AWARD_EXPERIENCE_POINTS, '经验值'),
-        (AWARD_ICOIN, 'i币'),
-        (AWARD_COIN, '金币'),
-        (AWARD_PRIZE, '礼物'),
-        (AWARD_CONTRIBUTION, '贡献值'),
-        (AWARD_BADGE, '勋章'),
-        (AWARD_MARQUEE_CONTENT, '跑马灯内容'),
-        (AWARD_STAR, '元气'),
+    last_message_id = models.IntegerField(
+        verbose_name='最后消息id',
+        default=0,
     )
 
-    award_item = models.CharField(
+    last_read_id = models.IntegerField(
+        verbose_name='已读水位',
+        default=0,
+        help_text='id 大于此值的消息为未读，追踪和动态互动会话不使用',
+    )
+
+    last_broadcast_id = models.IntegerField(
+        verbose_name='推送拉取水位',
+        default=0,
+        help_text='活动、系统会话已拉取到的阅读时拉取推送 id',
+    )
+
+    class Meta:
+        verbose_name = '会话摘要'
+        verbose_name_plural = '会话摘要'
+        db_table = 'core_conversation'
+        unique_together = [('owner', 'key')]
+        index_together = [('owner', 'date_last')]
+
+    CHUNK_SIZE = 1000
+
+    @staticmethod
+    def get_key(type, peer_id=None, family_id=None):
+        if type == Conversation.TYPE_CHAT:
+            return 'chat:{}'.format(peer_id)
+        if type == Conversation.TYPE_FAMILY:
+            return 'family:{}'.format(family_id)
+        return type
+
+    @staticmethod
+    def get_preview(message):
+        return '[禮物表情]' if message.type == Message.TYPE_IMAGE else message.content
+
+    @staticmethod
+    def get_broadcast_type(target):
+        """ 推送对应的会话类型，直播间推送不进入会话 """
+        if target == Broadcast.TARGET_ACTIVITY:
+            return Conversation.TYPE_ACTIVITY
+        if target in (Broadcast.TARGET_SYSTEM, Broadcast.TARGET_SYSTEM_FAMILYS, Broadcast.TARGET_SYSTEM_NOT_FAMILYS):
+            return Conversation.TYPE_SYSTEM
+        return None
+
+    @staticmethod
+    def get_broadcast_targets(type):
+        return [target for target, label in Broadcast.TARGET_CHOICES
+                if Conversation.get_broadcast_type(target) == type]
+
+    @staticmethod
+    def touch(owner_ids, type, content, date_last, unread_owner_ids=None, peer_id=None, family_id=None,
+              message_id=0):
+        """ 批量更新一组用户的同一会话，不存在的会话自动创建
+        :param owner_ids: 会话所属用户 id 列表
+        :param type: 会话类型
+        :param content: 最后一条消息预览
+        :param date_last: 最后消息时间
+        :param unread_owner_ids: 未读数加一的用户，默认为全部，其余用户（发送者）的水位直接推进
+        :param message_id: 消息 id，消息类会话需要传入
+        :return:
+        """
+        key = Conversation.get_key(type, peer_id, family_id)
+        owner_ids = list(set(owner_ids))
+        unread_owner_ids = set(owner_ids if unread_owner_ids is None else unread_owner_ids)
+        for i in range(0, len(owner_ids), Conversation.CHUNK_SIZE):
+            chunk = owner_ids[i:i + Conversation.CHUNK_SIZE]
+            existing = set(Conversation.objects.filter(
+                key=key,
+                owner_id__in=chunk,
+            ).values_list('owner_id', flat=True))
+            missing = [owner_id for owner_id in chunk if owner_id not in existing]
+            try:
+                with transaction.atomic():
+                    Conversation.objects.bulk_create([Conversation(
+                        owner_id=owner_id,
+                        type=type,
+                        key=key,
+                        peer_id=peer_id,
+                        family_id=family_id,
+                        content=content,
+                        date_last=date_last,
+                        unread_count=1 if owner_id in unread_owner_ids else 0,
+                        last_message_id=message_id,
+                        last_read_id=0 if owner_id in unread_owner_ids else message_id,
+                    ) for owner_id in missing])
+            except IntegrityError:
+                # 并发情况下其他请求已经创建，全部按更新处理
+                existing = set(chunk)
+            for is_unread in (True, False):
+                ids = [owner_id for owner_id in existing if (owner_id in unread_owner_ids) == is_unread]
+                if not ids:
+                    continue
+                fields = dict(content=content, date_last=date_last)
+                if message_id:
+                    fields['last_message_id'] = message_id
+                if is_unread:
+                    fields['unread_count'] = models.F('unread_count') + 1
+                elif message_id:
+                    fields['last_read_id'] = message_id
+                Conversation.objects.filter(key=key, owner_id__in=ids).update(**fields)
+        UnreadCounter.incr(unread_owner_ids, type)
+
+    @staticmethod
+    def on_message(message):
+        """ 私聊或家族消息写入后更新相关会话 """
+        content = Conversation.get_preview(message)
+        if message.sender_id and message.receiver_id:
+            Conversation.touch([message.sender_id], Conversation.TYPE_CHAT, content, message.date_created,
+                               unread_owner_ids=[], peer_id=message.receiver_id, message_id=message.id)
+            Conversation.touch([message.receiver_id], Conversation.TYPE_CHAT, content, message.date_created,
+                               peer_id=message.sender_id, message_id=message.id)
+        for family in message.families.all():
+            member_ids = list(FamilyMember.objects.filter(
+                family=family,
+                status=FamilyMember.STATUS_APPROVED,
+            ).values_list('author_id', flat=True))
+            Conversation.touch(
+                member_ids, Conversation.TYPE_FAMILY, content, message.date_created,
+                unread_owner_ids=[user_id for user_id in member_ids if user_id != message.sender_id],
+                family_id=family.id,
+                message_id=message.id,
+            )
+
+    @staticmethod
+    def on_broadcast(broadcast, user_ids):
+        """ 系统、活动推送送达后更新接收者的会话 """
+        type = Conversation.get_broadcast_type(broadcast.target)
+        if type:
+            message_id = broadcast.messages.aggregate(models.Max('id'))['id__max'] or 0
+            Conversation.touch(user_ids, type, broadcast.content, broadcast.date_sent or datetime.now(),
+                               message_id=message_id)
+
+    @staticmethod
+    def deliver_broadcasts(user):
+        """ 把用户尚未拉取的全体推送写入其收件箱，读取消息、会话和未读数之前调用
+        只拉取注册之后发送的推送，家族成员推送按读取时是否在家族中判断
+        :param user: 用户
+        :return: 写入的消息数
+        """
+        broadcasts = Broadcast.objects.filter(
+            delivery=Broadcast.DELIVERY_PULL,
+            status=Broadcast.STATUS_DONE,
+            date_sent__gte=user.date_joined,
+        )
+        latest = dict(broadcasts.values('target').annotate(
+            max_id=models.Max('id'),
+        ).values_list('target', 'max_id'))
+        if not latest:
+            return 0
+        watermarks = dict(Conversation.objects.filter(
+            owner=user,
+            type__in=[Conversation.TYPE_ACTIVITY, Conversation.TYPE_SYSTEM],
+        ).values_list('type', 'last_broadcast_id'))
+        count = 0
+        for type in (Conversation.TYPE_ACTIVITY, Conversation.TYPE_SYSTEM):
+            targets = Conversation.get_broadcast_targets(type)
+            if max([latest.get(target, 0) for target in targets]) > watermarks.get(type, 0):
+                count += Conversation.deliver_broadcasts_of_type(user, type, broadcasts.filter(target__in=targets))
+        return count
+
+    @staticmethod
+    def deliver_broadcasts_of_type(user, type, broadcasts):
+        with transaction.atomic():
+            # 锁住会话行，避免并发读取重复写入
+            conversation = Conversation.objects.select_for_update().filter(owner=user, key=type).first()
+            if not conversation:
+                try:
+                    with transaction.atomic():
+                        conversation = Conversation.objects.create(
+                            owner=user,
+                            type=type,
+                            key=type,
+                            date_last=user.date_joined,
+                        )
+                except IntegrityError:
+                    conversation = Conversation.objects.select_for_update().get(owner=user, key=type)
+            broadcasts = list(broadcasts.filter(id__gt=conversation.last_broadcast_id).order_by('id'))
+            if not broadcasts:
+                return 0
+            last_broadcast_id = broadcasts[-1].id
+            if any(broadcast.target in (Broadcast.TARGET_SYSTEM_FAMILYS, Broadcast.TARGET_SYSTEM_NOT_FAMILYS)
+                   for broadcast in broadcasts):
+                in_family = FamilyMember.objects.filter(author=user, status=FamilyMember.STATUS_APPROVED).exists()
+                broadcasts = [
+                    broadcast for broadcast in broadcasts
+                    if broadcast.target != (Broadcast.TARGET_SYSTEM_NOT_FAMILYS if in_family
+                                            else Broadcast.TARGET_SYSTEM_FAMILYS)
+                ]
+            if not broadcasts:
+                Conversation.objects.filter(pk=conversation.pk).update(last_broadcast_id=last_broadcast_id)
+                return 0
+            Message.objects.bulk_create([Message(
+                broadcast=broadcast,
+                receiver=user,
+                content=broadcast.content,
+                params=broadcast.params,
+            ) for broadcast in broadcasts])
+            messages = Message.objects.filter(
+                receiver=user,
+                broadcast_id__in=[broadcast.id for broadcast in broadcasts],
+            )
+            # 消息时间取推送时间，而不是拉取的时间
+            messages.update(date_created=models.Subquery(Broadcast.objects.filter(
+                pk=models.OuterRef('broadcast_id'),
+            ).values('date_sent')[:1]))
+            Conversation.objects.filter(pk=conversation.pk).update(
+                content=broadcasts[-1].content,
+                date_last=broadcasts[-1].date_sent,
+                last_message_id=messages.aggregate(models.Max('id'))['id__max'],
+                unread_count=models.F('unread_count') + len(broadcasts),
+                last_broadcast_id=last_broadcast_id,
+            )
+            UnreadCounter.incr([user.id], type, len(broadcasts))
+        return len(broadcasts)
+
+    @staticmethod
+    def on_follow(user, member):
+        """ user 追踪了 member """
+        Conversation.touch([member.user_id], Conversation.TYPE_FOLLOW,
+                           '{} 追蹤了你'.format(user.member.nickname), datetime.now())
+
+    @staticmethod
+    def on_activeevent_like(user, activeevent):
+        if user.id != activeevent.author_id:
+            Conversation.touch([activeevent.author_id], Conversation.TYPE_ACTIVEEVENT,
+                               '{} 給你點了一個讃'.format(user.member.nickname), datetime.now())
+
+    @staticmethod
+    def on_activeevent_comment(comment, activeevent):
+        """ 动态被评论，或者自己的评论被回复 """
+        owner_ids = {activeevent.author_id}
+        if comment.parent_id:
+            owner_ids.add(comment.parent.author_id)
+        owner_ids.discard(comment.author_id)
+        if owner_ids:
+            Conversation.touch(owner_ids, Conversation.TYPE_ACTIVEEVENT, comment.content, comment.date_created)
+
+    def get_messages(self):
+        """ 消息类会话中别人发来的消息 """
+        if self.type == Conversation.TYPE_CHAT:
+            qs = Message.objects.filter(sender_id=self.peer_id, receiver_id=self.owner_id)
+        elif self.type == Conversation.TYPE_FAMILY:
+            qs = Message.objects.filter(families__id=self.family_id).exclude(sender_id=self.owner_id)
+            family_member = FamilyMember.objects.filter(
+                family_id=self.family_id,
+                author_id=self.owner_id,
+            ).first()
+            if family_member and family_member.date_approved:
+                qs = qs.filter(date_created__gt=family_member.date_approved)
+        elif self.type in (Conversation.TYPE_ACTIVITY, Conversation.TYPE_SYSTEM):
+            qs = Message.objects.filter(
+                sender=None,
+                receiver_id=self.owner_id,
+                broadcast__target__in=Conversation.get_broadcast_targets(self.type),
+            )
+        else:
+            return Message.objects.none()
+        return qs
+
+    def get_unread_messages(self):
+        """ 未读的消息为 id 大于水位的部分 """
+        return self.get_messages().filter(id__gt=self.last_read_id)
+
+    @staticmethod
+    def get_read_message_ids(owner, messages):
+        """ 按已读水位判断一组消息中哪些已被 owner 读过，读消息时不再逐条记录 is_read、users_read
+        自己发出的私聊按对方的水位判断，自己发出的家族消息视为已读
+        :param owner: 查看消息的用户
+        :param messages: 消息列表
+        :return: 已读的消息 id 集合
+        """
+        messages = list(messages)
+        if not messages:
+            return set()
+        watermarks = dict(Conversation.objects.filter(owner=owner).values_list('key', 'last_read_id'))
+        peer_watermarks = dict(Conversation.objects.filter(
+            owner_id__in={message.receiver_id for message in messages if message.sender_id == owner.id},
+            key=Conversation.get_key(Conversation.TYPE_CHAT, owner.id),
+        ).values_list('owner_id', 'last_read_id'))
+        families = defaultdict(list)
+        for message_id, family_id in Family.messages.through.objects.filter(
+                message_id__in=[message.id for message in messages],
+        ).values_list('message_id', 'family_id'):
+            families[message_id].append(family_id)
+        targets = dict(Broadcast.objects.filter(
+            id__in={message.broadcast_id for message in messages if message.broadcast_id},
+        ).values_list('id', 'target'))
+        read_ids = set()
+        for message in messages:
+            if families[message.id]:
+                if message.sender_id == owner.id:
+                    read_ids.add(message.id)
+                    continue
+                keys = [Conversation.get_key(Conversation.TYPE_FAMILY, family_id=family_id)
+                        for family_id in families[message.id]]
+            elif message.sender_id == owner.id:
+                if peer_watermarks.get(message.receiver_id, 0) >= message.id:
+                    read_ids.add(message.id)
+                continue
+            elif message.sender_id:
+                keys = [Conversation.get_key(Conversation.TYPE_CHAT, message.sender_id)]
+            elif message.broadcast_id:
+                keys = [Conversation.get_broadcast_type(targets.get(message.broadcast_id))]
+            else:
+                # 不属于任何会话的旧系统消息仍以自身的标记为准
+                if message.is_read:
+                    read_ids.add(message.id)
+                continue
+            if any(watermarks.get(key, 0) >= message.id for key in keys if key):
+                read_ids.add(message.id)
+        return read_ids
+
+    @staticmethod
+    def mark_read(owner, type, peer_id=None, family_id=None, message_id=None):
+        """ 推进已读水位，并从用户的未读数中扣除
+        :param message_id: 读到的消息 id，默认读到最后一条
+        """
+        with transaction.atomic():
+            conversation = Conversation.objects.select_for_update().filter(
+                owner=owner,
+                key=Conversation.get_key(type, peer_id, family_id),
+            ).first()
+            if not conversation:
+                return
+            if message_id is None or message_id >= conversation.last_message_id:
+                last_read_id = max(conversation.last_read_id, conversation.last_message_id)
+                unread_count = 0
+            elif message_id > conversation.last_read_id:
+                conversation.last_read_id = last_read_id = message_id
+                unread_count = conversation.get_unread_messages().count()
+            else:
+                return
+            Conversation.objects.filter(pk=conversation.pk).update(
+                last_read_id=last_read_id,
+                unread_count=unread_count,
+            )
+            UnreadCounter.incr([owner.id], type, unread_count - conversation.unread_count)
+
+    @staticmethod
+    def rebuild(user):
+        """ 从消息、标记和评论重新生成用户的全部会话
+        :param user: 用户
+        :return: 会话数
+        """
+        conversations = []
+        # 保留已有的已读水位，没有水位的会话按旧的已读标记计算未读数
+        watermarks = dict(Conversation.objects.filter(
+            owner=user,
+            last_read_id__gt=0,
+        ).values_list('key', 'last_read_id'))
+        broadcast_watermarks = dict(Conversation.objects.filter(
+            owner=user,
+            last_broadcast_id__gt=0,
+        ).values_list('key', 'last_broadcast_id'))
+
+        def add(type, content, date_last, unread_count, peer_id=None, family_id=None, message_id=0):
+            conversation = Conversation(
+                owner=user,
+                type=type,
+                key=Conversation.get_key(type, peer_id, family_id),
+                peer_id=peer_id,
+                family_id=family_id,
+                content=content,
+                date_last=date_last,
+                unread_count=unread_count,
+                last_message_id=message_id,
+                last_broadcast_id=broadcast_watermarks.get(Conversation.get_key(type, peer_id, family_id), 0),
+            )
+            if conversation.key in watermarks:
+                conversation.last_read_id = watermarks[conversation.key]
+                conversation.unread_count = conversation.get_unread_messages().count()
+            elif message_id and not unread_count:
+                conversation.last_read_id = message_id
+            conversations.append(conversation)
+
+        # 私聊：每个对方取最后一条消息
+        last_ids = dict()
+        for peer_field, my_field in (('receiver', 'sender'), ('sender', 'receiver')):
+            rows = Message.objects.filter(**{
+                my_field: user,
+                peer_field + '__isnull': False,
+            }).values(peer_field).annotate(last_id=models.Max('id'))
+            for row in rows:
+                last_ids[row[peer_field]] = max(last_ids.get(row[peer_field], 0), row['last_id'])
+        unread = dict(Message.objects.filter(
+            receiver=user,
+            sender__isnull=False,
+            is_read=False,
+        ).values_list('sender').annotate(count=models.Count('id')))
+        messages = Message.objects.in_bulk(list(last_ids.values()))
+        for peer_id, last_id in last_ids.items():
+            message = messages[last_id]
+            add(Conversation.TYPE_CHAT, Conversation.get_preview(message), message.date_created,
+                unread.get(peer_id, 0), peer_id=peer_id, message_id=message.id)
+
+        # 家族
+        for family_member in FamilyMember.objects.filter(
+                author=user,
+                status=FamilyMember.STATUS_APPROVED,
+        ).select_related('family'):
+            family_messages = family_member.family.messages.filter(
+                date_created__gt=family_member.date_approved,
+            )
+            message = family_messages.order_by('-date_created').first()
+            if message:
+                add(Conversation.TYPE_FAMILY, Conversation.get_preview(message), message.date_created,
+                    family_messages.exclude(users_read=user).exclude(sender=user).count(),
+                    family_id=family_member.family_id, message_id=message.id)
+
+        # 追踪
+        follow_marks = UserMark.objects.filter(
+            object_id=user.id,
+            subject='follow',
+            content_type=ContentType.objects.get(model='member'),
+        )
+        mark = follow_marks.select_related('author__member').order_by('-date_created').first()
+        if mark:
+            add(Conversation.TYPE_FOLLOW, '{} 追蹤了你'.format(mark.author.member.nickname), mark.date_created,
+                follow_marks.filter(is_read=False).count())
+
+        # 动态的点赞和评论
+        activeevent_ids = list(user.activeevents_owned.values_list('id', flat=True))
+        like_marks = UserMark.objects.filter(
+            object_id__in=activeevent_ids,
+            subject='like',
+            content_type=ContentType.objects.get(model='activeevent'),
+        )
+        comments = Comment.objects.filter(
+            models.Q(activeevents__id__in=activeevent_ids) |
+            models.Q(activeevents__id__gt=0, parent__author=user)
+        ).exclude(author=user)
+        mark = like_marks.select_related('author__member').order_by('-date_created').first()
+        comment = comments.order_by('-date_created').first()
+        if mark or comment:
+            unread_count = like_marks.filter(is_read=False).count() + comments.filter(is_read=False).count()
+            if mark and (not comment or mark.date_created > comment.date_created):
+                add(Conversation.TYPE_ACTIVEEVENT, '{} 給你點了一個讃'.format(mark.author.member.nickname),
+                    mark.date_created, unread_count)
+            else:
+                add(Conversation.TYPE_ACTIVEEVENT, comment.content, comment.date_created, unread_count)
+
+        # 活动和系统推送
+        for type, targets in (
+                (Conversation.TYPE_ACTIVITY, [Broadcast.TARGET_ACTIVITY]),
+                (Conversation.TYPE_SYSTEM, [Broadcast.TARGET_SYSTEM, Broadcast.TARGET_SYSTEM_FAMILYS,
+                                            Broadcast.TARGET_SYSTEM_NOT_FAMILYS]),
+        ):
+            broadcast_messages = Message.objects.filter(
+                sender=None,
+                receiver=user,
+                broadcast__target__in=targets,
+            )
+            message = broadcast_messages.order_by('-date_created').first()
+            if message:
+                add(type, message.content, message.date_created,
+                    broadcast_messages.filter(is_read=False).count(), message_id=message.id)
+            elif type in broadcast_watermarks:
+                # 只有拉取水位、还没有消息的会话也要保留，否则会重复拉取
+                add(type, '', user.date_joined, 0)
+
+        with transaction.atomic():
+            Conversation.objects.filter(owner=user).delete()
+            Conversation.objects.bulk_create(conversations)
+            counts = dict()
+            for conversation in conversations:
+                counts[conversation.type] = counts.get(conversation.type, 0) + conversation.unread_count
+            UnreadCounter.objects.update_or_create(user=user, defaults={
+                field: counts.get(field, 0) for field in UnreadCounter.FIELDS
+            })
+        return len(conversations)
+
+
+class UnreadCounter(models.Model):
+    """ 未读数
+    每个用户一行，按会话类型分别累计，小红点直接读取这一行
+    与 Conversation 的未读数同步增减，可以通过 rebuild_unread_counters 命令对账
+    """
+    user = models.OneToOneField(
+        verbose_name='用户',
+        to=User,
+        related_name='unread_counter',
+        primary_key=True,
+    )
+
+    chat = models.IntegerField(
+        verbose_name='私聊未读',
+        default=0,
+    )
+
+    family = models.IntegerField(
+        verbose_name='家族消息未读',
+        default=0,
+    )
+
+    follow = models.IntegerField(
+        verbose_name='追踪未读',
+        default=0,
+    )
+
+    activeevent = models.IntegerField(
+        verbose_name='动态互动未读',
+        default=0,
+    )
+
+    activity = models.IntegerField(
+        verbose_name='活动消息未读',
+        default=0,
+    )
+
+    system = models.IntegerField(
+        verbose_name='系统消息未读',
+        default=0,
+    )
+
+    class Meta:
+        verbose_name = '未读数'
+        verbose_name_plural = '未读数'
+        db_table = 'core_unread_counter'
+
+    # 字段名与 Conversation 的会话类型一致
+    FIELDS = ('chat', 'family', 'follow', 'activeevent', 'activity', 'system')
+
+    @staticmethod
+    def incr(user_ids, field, amount=1):
+        """ 批量增减一组用户某一类的未读数，不存在的计数自动创建
+        :param user_ids: 用户 id 列表
+        :param field: 会话类型
+        :param amount: 变动值，减少时不会低于 0
+        """
+        user_ids = list(set(user_ids))
+        if not user_ids or not amount:
+            return
+        for i in range(0, len(user_ids), Conversation.CHUNK_SIZE):
+            chunk = user_ids[i:i + Conversation.CHUNK_SIZE]
+            if amount > 0:
+                existing = set(UnreadCounter.objects.filter(
+                    user_id__in=chunk,
+                ).values_list('user_id', flat=True))
+                missing = [user_id for user_id in chunk if user_id not in existing]
+                try:
+                    with transaction.atomic():
+                        UnreadCounter.objects.bulk_create([
+                            UnreadCounter(user_id=user_id, **{field: amount}) for user_id in missing
+                        ])
+                    chunk = list(existing)
+                except IntegrityError:
+                    # 并发情况下其他请求已经创建，全部按更新处理
+                    pass
+                UnreadCounter.objects.filter(user_id__in=chunk).update(**{
+                    field: models.F(field) + amount,
+                })
+            else:
+                UnreadCounter.objects.filter(user_id__in=chunk).update(**{
+                    field: Greatest(models.F(field) + amount, 0),
+                })
+
+    @staticmethod
+    def get(user):
+        """ 用户的未读数，没有记录时返回全 0 的计数 """
+        return UnreadCounter.objects.filter(user=user).first() or UnreadCounter(user=user)
+
+    def get_total(self):
+        return sum(getattr(self, field) for field in UnreadCounter.FIELDS)
+
+    @staticmethod
+    def compute(user_ids=None):
+        """ 按会话摘要汇总未读数
+        :return: {user_id: {field: count}}
+        """
+        qs = Conversation.objects.filter(unread_count__gt=0)
+        if user_ids:
+            qs = qs.filter(owner_id__in=user_ids)
+        counts = defaultdict(dict)
+        for owner_id, type, count in qs.values_list('owner_id', 'type').annotate(
+                count=models.Sum('unread_count')):
+            counts[owner_id][type] = count
+        return counts
+
+
+class FamilyArticle(UserOwnedModel,
+                    EntityModel):
+    family = models.ForeignKey(
+        verbose_name='家族',
+        to='Family',
+        related_name='articles',
+    )
+
+    content = models.TextField(
+        verbose_name='内容',
+        blank=True,
+        default='',
+    )
+
+    class Meta:
+        verbose_name = '家族文章'
+        verbose_name_plural = '家族文章'
+        db_table = 'core_family_article'
+
+    def get_author_role(self):
+        """ 返回公告作者的家族角色"""
+        return FamilyMember.objects.filter(
+            family=self.family,
+            author=self.author,
+        ).first().role
+
+
+class FamilyMission(UserOwnedModel,
+                    EntityModel):
+    family = models.ForeignKey(
+        verbose_name='家族',
+        to='Family',
+        related_name='missions',
+    )
+
+    ITEM_WATCH_MASTER_PRIZE = 'WATCH_MASTER_PRIZE'
+    ITEM_WATCH_MASTER_DURATION = 'WATCH_MASTER_DURATION'
+    ITEM_COUNT_WATCH_LOG = 'COUNT_WATCH_LOG'
+    ITEM_COUNT_FOLLOWED = 'COUNT_FOLLOWED'
+    ITEM_COUNT_FRIEND = 'COUNT_FRIEND'
+    ITEM_COUNT_LOGIN = 'COUNT_LOGIN'
+    ITEM_COUNT_INVITE = 'COUNT_INVITE'
+    ITEM_COUNT_SHARE_MASTER_LIVE = 'COUNT_SHARE_MASTER_LIVE'
+    ITEM_COUNT_WATCH_MASTER_LIVE = 'COUNT_WATCH_MASTER_LIVE'
+    ITEM_COUNT_LIVE = 'COUNT_LIVE'
+    ITEM_COUNT_RECEIVE_DIAMOND = 'COUNT_RECEIVE_DIAMOND'
+    ITEM_CHOICES = (
+        (ITEM_WATCH_MASTER_PRIZE, '送家族长礼物额度'),
+        (ITEM_WATCH_MASTER_DURATION, '观看家族长直播时长'),
+        (ITEM_COUNT_WATCH_LOG, '累计观看数'),
+        (ITEM_COUNT_FOLLOWED, '陌生人追踪你的个数'),
+        (ITEM_COUNT_FRIEND, '拥有的好友数'),
+        (ITEM_COUNT_LOGIN, '连续登录天数'),
+        (ITEM_COUNT_INVITE, '邀请好友注册数'),
+        (ITEM_COUNT_SHARE_MASTER_LIVE, '分享家族长直播的分享数'),
+        (ITEM_COUNT_WATCH_MASTER_LIVE, '在家族长直播间的访谈数'),
+        (ITEM_COUNT_LIVE, '连续开播的天数'),
+        (ITEM_COUNT_RECEIVE_DIAMOND, '收到钻石额度'),
+    )
+
+    mission_item = models.CharField(
+        verbose_name='任务元件',
+        max_length=50,
+        default=ITEM_WATCH_MASTER_PRIZE,
+        choices=ITEM_CHOICES,
+    )
+
+    mission_item_value = models.IntegerField(
+        verbose_name='任务元件数值',
+        blank=True,
+        default=0,
+        help_text='指定条件达到所需的数值'
+    )
+
+    AWARD_EXPERIENCE_POINTS = 'EXPERIENCE_POINTS'
+    AWARD_ICOIN = 'ICOIN'
+    AWARD_COIN = 'COIN'
+    AWARD_PRIZE = 'PRIZE'
+    AWARD_CONTRIBUTION = 'CONTRIBUTION'
+    AWARD_BADGE = 'BADGE'
+    AWARD_MARQUEE_CONTENT = 'MARQUEE_CONTENT'
+    AWARD_STAR = 'STAR'
+    AWARD_CHOICES = (
+        (AWARD_EXPERIENCE_POINTS, '经验值'),
+        (AWARD_ICOIN, 'i币'),
+        (AWARD_COIN, '金币'),
+        (AWARD_PRIZE, '礼物'),
+        (AWARD_CONTRIBUTION, '贡献值'),
+        (AWARD_BADGE, '勋章'),
+        (AWARD_MARQUEE_CONTENT, '跑马灯内容'),
+        (AWARD_STAR, '元气'),
+    )
+
+    award_item = models.CharField(
         verbose_name='奖励元件',
         max_length=50,
         default=AWARD_EXPERIENCE_POINTS,
@@ -2667,6 +3655,7 @@ class Live(UserOwnedModel,
         verbose_name = '直播'
         verbose_name_plural = '直播'
         db_table = 'core_live'
+        index_together = (('date_end', 'date_response'),)
 
     def save(self, *args, **kwargs):
         from django_base.middleware import get_request
@@ -2701,14 +3690,23 @@ class Live(UserOwnedModel,
     def get_comment_count(self):
         return self.comments.count()
 
+    @staticmethod
+    def close_stale(date_limit):
+        """ 批量结束超时未响应的直播
+        :param date_limit: 最后响应时间早于此时间的直播视为已结束
+        :return: 结束的直播数
+        """
+        return Live.objects.filter(
+            models.Q(date_end=None, date_response=None, date_created__lt=date_limit) |
+            models.Q(date_end=None, date_response__lt=date_limit)
+        ).update(date_end=datetime.now())
+
     def get_view_count(self):
         # return LiveWatchLog.objects.filter(
         #     live=self.id
         # ).count()
-        return LiveWatchLog.objects.filter(
-            models.Q(live=self.id, date_leave=None) |
-            models.Q(live=self.id, date_leave__lt=models.F('date_enter'))
-        ).count()
+        from . import presence
+        return presence.count(self.id)
 
     def get_prize_count(self):
         return PrizeOrder.objects.filter(
@@ -2867,58 +3865,227 @@ class Live(UserOwnedModel,
         self.author.member.live_extend = (duration + live_extend) % 30
         self.author.member.save()
 
-    def update_hot_rating(self):
+    def update_hot_rating(self, weights=None):
+        """
+        更新直播间的热门排行分数
+        分数由 LiveCounter 中增量维护的计数计算，不再扫描观看记录
+        :param weights: LiveCounter.get_weights() 的结果，批量更新时由调用方读取一次
+        """
+        # todo: 直播分享数
+        counter = LiveCounter.get(self)
+        self.hot_rating = int(counter.get_hot_rating(weights or LiveCounter.get_weights()))
+        # 只更新热度字段，避免 save() 重复调用 WebIM 建群
+        Live.objects.filter(pk=self.pk).update(hot_rating=self.hot_rating)
+
+
+class LiveCounter(models.Model):
+    """ 直播间热度计数
+    进入/离开直播间、弹幕、评论、送礼时增量更新，
+    定时任务只根据计数重算进行中直播的热度，计算量与历史记录数量无关
+    """
+    live = models.OneToOneField(
+        verbose_name='直播',
+        to='Live',
+        related_name='counter',
+        primary_key=True,
+    )
+
+    viewer_count = models.IntegerField(
+        verbose_name='当前观看人数',
+        default=0,
+    )
+
+    barrage_count = models.IntegerField(
+        verbose_name='弹幕数',
+        default=0,
+    )
+
+    comment_count = models.IntegerField(
+        verbose_name='评论数',
+        default=0,
+    )
+
+    diamond_amount = models.DecimalField(
+        verbose_name='获得钻石数',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    tier4_count = models.IntegerField(
+        verbose_name='VIP4/2级观众数',
+        default=0,
+    )
+
+    tier5_count = models.IntegerField(
+        verbose_name='VIP5/3级观众数',
+        default=0,
+    )
+
+    tier6_count = models.IntegerField(
+        verbose_name='VIP6/4级观众数',
+        default=0,
+    )
+
+    tier7_count = models.IntegerField(
+        verbose_name='VIP7/5级观众数',
+        default=0,
+    )
+
+    tier8_count = models.IntegerField(
+        verbose_name='VIP8/6级观众数',
+        default=0,
+    )
+
+    tier9_count = models.IntegerField(
+        verbose_name='VIP9/7级观众数',
+        default=0,
+    )
+
+    date_updated = models.DateTimeField(
+        verbose_name='更新时间',
+        auto_now=True,
+    )
+
+    # 高等级观众分档，VIP 等级为 n 或大等级为 n - 2 的观众计入第 n 档
+    TIERS = (4, 5, 6, 7, 8, 9)
+
+    class Meta:
+        verbose_name = '直播热度计数'
+        verbose_name_plural = '直播热度计数'
+        db_table = 'core_live_counter'
+
+    @staticmethod
+    def get_tiers(member):
+        """ 观众所在的高等级分档，VIP 等级和大等级可能分别命中两档
+        :param member: 观众会员
+        :return: [tier, ...]
+        """
+        return LiveCounter.get_level_tiers(member.vip_level, member.large_level)
+
+    @staticmethod
+    def get_level_tiers(vip_level, large_level):
+        return [tier for tier in LiveCounter.TIERS if vip_level == tier or large_level == tier - 2]
+
+    @staticmethod
+    def on_first_enter(live, member):
+        """ 观众第一次进入直播间，观看记录写入之后调用 """
+        deltas = dict(viewer_count=1)
+        for tier in LiveCounter.get_tiers(member):
+            deltas['tier{}_count'.format(tier)] = 1
+        LiveCounter.incr(live, **deltas)
+
+    @staticmethod
+    def on_levels_changed(user_id, old_tiers, new_tiers):
+        """ 观众的 VIP 等级或大等级变化后，调整其看过的进行中直播的分档计数
+        与 rebuild 一致，分档按观众当前的等级统计；已结束的直播不再参与热度计算，不调整
+        :param user_id: 观众用户 id
+        :param old_tiers: 变化前的分档
+        :param new_tiers: 变化后的分档
+        """
+        deltas = dict()
+        for tier in set(old_tiers) - set(new_tiers):
+            deltas['tier{}_count'.format(tier)] = -1
+        for tier in set(new_tiers) - set(old_tiers):
+            deltas['tier{}_count'.format(tier)] = 1
+        if not deltas:
+            return
+        live_ids = list(LiveWatchLog.objects.filter(
+            author_id=user_id,
+            live__date_end=None,
+        ).values_list('live_id', flat=True))
+        if live_ids:
+            LiveCounter.objects.filter(live_id__in=live_ids).update(**{
+                field: models.F(field) + value for field, value in deltas.items()
+            })
+
+    @staticmethod
+    def get(live):
+        """ 获取直播间计数，不存在时从历史记录初始化
+        :param live: 直播
+        :return: LiveCounter
+        """
+        return LiveCounter.get_or_rebuild(live)[0]
+
+    @staticmethod
+    def get_or_rebuild(live):
+        """
+        :param live: 直播
+        :return: (LiveCounter, 是否刚从历史记录初始化)
+        """
+        try:
+            return live.counter, False
+        except LiveCounter.DoesNotExist:
+            pass
+        try:
+            with transaction.atomic():
+                return LiveCounter.rebuild(live), True
+        except IntegrityError:
+            # 并发情况下其他请求已经创建
+            return LiveCounter.objects.get(live=live), False
+
+    @staticmethod
+    def incr(live, **deltas):
+        """ 增量更新直播间计数，需在事件对应的记录写入之后调用
+        :param live: 直播
+        :param deltas: 字段名 => 变动值
+        """
+        deltas = {field: value for field, value in deltas.items() if value}
+        if not deltas:
+            return
+        counter, rebuilt = LiveCounter.get_or_rebuild(live)
+        if rebuilt:
+            # 刚初始化的计数已经包含本次事件
+            return
+        LiveCounter.objects.filter(live=live).update(**{
+            field: models.F(field) + value for field, value in deltas.items()
+        })
+
+    @staticmethod
+    def rebuild(live):
+        """ 从观看记录、弹幕、评论、礼物订单重新统计直播间计数
+        :param live: 直播
+        :return: LiveCounter
+        """
+        counter = LiveCounter.objects.filter(live=live).first() or LiveCounter(live=live)
+        counter.viewer_count = live.watch_logs.filter(is_online=True).count()
+        counter.barrage_count = live.barrages.count()
+        counter.comment_count = Comment.objects.filter(livewatchlogs__live=live).count()
+        counter.diamond_amount = live.get_live_diamond()
+        for tier in LiveCounter.TIERS:
+            setattr(counter, 'tier{}_count'.format(tier), live.watch_logs.filter(
+                models.Q(author__member__vip_level=tier) |
+                models.Q(author__member__large_level=tier - 2)
+            ).count())
+        counter.save()
+        return counter
+
+    @staticmethod
+    def get_weights():
+        """ 读取热度计算的系统参数
+        :return: dict
         """
-        更新直播间的热门排行分数
-        每15分钟更新一次
+        level_red = float(Option.get('level_red') or 10)
+        weights = dict(
+            viewer=float(Option.get('count_live_watch') or 1),
+            comment=float(Option.get('count_comment') or 0.2),
+            diamond=float(Option.get('count_receive_diamond') or 1),
+        )
+        for tier in LiveCounter.TIERS:
+            weights['tier{}'.format(tier)] = level_red + (tier - 4) * 5
+        return weights
+
+    def get_hot_rating(self, weights):
+        """ 根据计数计算热度分数
+        :param weights: LiveCounter.get_weights()
+        :return: float
         """
-        # if self.date_end:
-        #     return
-        # todo: 直播分享数
-        watchlog_count = self.watch_logs.filter(
-            models.Q(date_leave=None) |
-            models.Q(date_leave__lt=models.F('date_enter'))
-        ).count() * float(Option.get('count_live_watch') or 1)
-        barrage_count = self.barrages.count() * float(Option.get('count_comment') or 0.2)
-        comment_count = Comment.objects.filter(livewatchlogs__live=self, ).count() * \
-                        float(Option.get('count_comment') or 0.2)
-
-        vip4_member_count = self.watch_logs.filter(
-            models.Q(author__member__vip_level=4) |
-            models.Q(author__member__large_level=2)
-        ).count() * float(Option.get('level_red') or 10)
-
-        vip5_member_count = self.watch_logs.filter(
-            models.Q(author__member__vip_level=5) |
-            models.Q(author__member__large_level=3)
-        ).count() * (float(Option.get('level_red') or 10) + 5)
-
-        vip6_member_count = self.watch_logs.filter(
-            models.Q(author__member__vip_level=6) |
-            models.Q(author__member__large_level=4)
-        ).count() * (float(Option.get('level_red') or 10) + 10)
-
-        vip7_member_count = self.watch_logs.filter(
-            models.Q(author__member__vip_level=7) |
-            models.Q(author__member__large_level=5)
-        ).count() * (float(Option.get('level_red') or 10) + 15)
-
-        vip8_member_count = self.watch_logs.filter(
-            models.Q(author__member__vip_level=8) |
-            models.Q(author__member__large_level=6)
-        ).count() * (float(Option.get('level_red') or 10) + 20)
-
-        vip9_member_count = self.watch_logs.filter(
-            models.Q(author__member__vip_level=9) |
-            models.Q(author__member__large_level=7)
-        ).count() * (float(Option.get('level_red') or 10) + 25)
-
-        diamond_count = float(self.get_live_diamond()) * float(Option.get('count_receive_diamond') or 1)
-        self.hot_rating = watchlog_count + barrage_count + comment_count \
-                          + vip4_member_count + vip5_member_count + vip6_member_count \
-                          + vip7_member_count + vip8_member_count + vip9_member_count \
-                          + diamond_count
-        self.save()
+        rating = self.viewer_count * weights['viewer'] \
+                 + (self.barrage_count + self.comment_count) * weights['comment'] \
+                 + float(self.diamond_amount) * weights['diamond']
+        for tier in LiveCounter.TIERS:
+            rating += getattr(self, 'tier{}_count'.format(tier)) * weights['tier{}'.format(tier)]
+        return rating
 
 
 class LiveBarrage(UserOwnedModel,
@@ -2967,7 +4134,10 @@ class LiveBarrage(UserOwnedModel,
                 amount=price,
                 remark='在直播#{}中發送彈幕'.format(self.live.id),
             )
+        is_new = not self.pk
         super().save(*args, **kwargs)
+        if is_new:
+            LiveCounter.incr(self.live, barrage_count=1)
 
 
 class LiveWatchLog(UserOwnedModel,
@@ -3029,10 +4199,17 @@ class LiveWatchLog(UserOwnedModel,
         blank=True,
     )
 
+    is_online = models.BooleanField(
+        verbose_name='是否观看中',
+        default=True,
+        help_text='保存时根据进入、离开时间自动维护',
+    )
+
     class Meta:
         verbose_name = '直播观看记录'
         verbose_name_plural = '直播观看记录'
         db_table = 'core_live_watch_log'
+        index_together = (('is_online', 'date_response'),)
 
     def __str__(self):
         return '{} - {}'.format(
@@ -3047,6 +4224,7 @@ class LiveWatchLog(UserOwnedModel,
         :param kwargs:
         :return:
         """
+        self.is_online = self.is_watching()
         super().save(*args, **kwargs)
         from tencent.webim import WebIM
         webim = WebIM(settings.TENCENT_WEBIM_APPID)
@@ -3087,21 +4265,48 @@ class LiveWatchLog(UserOwnedModel,
                 date_enter=datetime.now(),
                 coin_transaction=coin_transaction,
             )
+            LiveCounter.on_first_enter(live, user.member)
         else:
+            is_watching = live_watch_log.is_watching()
             live_watch_log.date_enter = datetime.now()
             live_watch_log.save()
+            if not is_watching:
+                LiveCounter.incr(live, viewer_count=1)
+        from . import presence
+        presence.enter(live.id, user.id)
+
+    def is_watching(self):
+        """ 是否仍在直播间内（未离开或离开后再次进入）
+        :return:
+        """
+        return not self.date_leave or self.date_leave < self.date_enter
+
+    def make_comment(self, author, content):
+        """ 在直播间发表评论，同时累加直播间的评论计数
+        :return: Comment
+        """
+        comment = self.comments.create(
+            author=author,
+            content=content,
+        )
+        LiveCounter.incr(self.live, comment_count=1)
+        return comment
 
     def leave_live(self):
         """
         用戶離開某直播間時執行
         :return:
         """
+        is_watching = self.is_watching()
         self.date_leave = datetime.now()
-        duration_this_time = int((self.date_leave - self.date_enter).seconds / 60) + \
-                             (self.date_leave - self.date_enter).days * 1440 or 1
+        duration_this_time = LiveWatchLog.get_minutes(self.date_enter, self.date_leave)
         self.duration += duration_this_time
 
         self.save()
+        from . import presence
+        presence.leave(self.live_id, self.author_id)
+        if is_watching:
+            LiveCounter.incr(self.live, viewer_count=-1)
         # 计算经验值
         self.watch_live_experience(duration_this_time)
 
@@ -3156,6 +4361,100 @@ class LiveWatchLog(UserOwnedModel,
         self.author.member.watch_live_extend = (duration + watch_live_extend) % 30
         self.author.member.save()
 
+    @staticmethod
+    def get_minutes(date_enter, date_leave):
+        """ 一次观看的停留分钟数，不足一分钟按一分钟计
+        :return:
+        """
+        return int((date_leave - date_enter).seconds / 60) + \
+               (date_leave - date_enter).days * 1440 or 1
+
+    @staticmethod
+    def credit_watch_experience(minutes):
+        """ 批量累计观看时长并发放观看经验，规则与 watch_live_experience 相同
+        由定时任务调用，不经过 Member.save()：剩余分钟数和等级都按相同的值分组写回
+        :param minutes: {user_id: 本次观看分钟数}
+        :return:
+        """
+        rule = int(Option.get('experience_points_watch') or 0)
+        if not rule or not minutes:
+            return
+        extends = defaultdict(list)
+        experienced = []
+        with transaction.atomic():
+            for member in Member.objects.select_related('user').filter(user_id__in=list(minutes.keys())):
+                total = member.watch_live_extend + minutes[member.user_id]
+                extends[total % 30].append(member.user_id)
+                if total < 30:
+                    continue
+                member.user.member = member
+                ExperienceTransaction.make(member.user, int(total / 30) * rule, ExperienceTransaction.TYPE_WATCH)
+                experienced.append(member.user_id)
+            for extend, user_ids in extends.items():
+                Member.objects.filter(user_id__in=user_ids).update(watch_live_extend=extend)
+            curve = LevelCurve.get()
+            if not curve or not experienced:
+                return
+            user_ids_by_level = defaultdict(list)
+            for user_id, total_experience, vip_level, large_level in Member.objects.filter(
+                    user_id__in=experienced,
+            ).values_list('user_id', 'total_experience', 'vip_level', 'large_level'):
+                level = curve.get_level(total_experience)
+                user_ids_by_level[level].append(user_id)
+                if level[0] != large_level:
+                    LiveCounter.on_levels_changed(user_id, LiveCounter.get_level_tiers(vip_level, large_level),
+                                                  LiveCounter.get_level_tiers(vip_level, level[0]))
+            for (large_level, small_level, current_level_experience), user_ids in user_ids_by_level.items():
+                Member.objects.filter(user_id__in=user_ids).update(
+                    large_level=large_level,
+                    small_level=small_level,
+                    current_level_experience=current_level_experience,
+                )
+
+    @staticmethod
+    def close_stale(date_limit, chunk_size=1000):
+        """ 批量关闭超时未响应的观看记录
+        观看截止到最后一次响应（没有响应时为进入时间），按停留分钟数分组更新 duration，
+        按直播间分组扣减观看人数，提交后统一发放观看经验
+        :param date_limit: 最后响应时间早于此时间的记录视为已离开
+        :param chunk_size: 每条 UPDATE 最多包含的记录数
+        :return: 关闭的记录数
+        """
+        # 最后响应时间可能是上一次进入时留下的，早于本次进入时间
+        date_last = Greatest(Coalesce(models.F('date_response'), models.F('date_enter')), models.F('date_enter'))
+        with transaction.atomic():
+            rows = list(LiveWatchLog.objects.select_for_update().filter(
+                models.Q(date_response=None, date_enter__lt=date_limit) |
+                models.Q(date_response__lt=date_limit),
+                is_online=True,
+            ).values_list('id', 'live_id', 'author_id', 'date_enter', 'date_response'))
+            if not rows:
+                return 0
+            ids_by_minutes = defaultdict(list)
+            viewers_by_live = defaultdict(int)
+            minutes_by_user = defaultdict(int)
+            for pk, live_id, author_id, date_enter, date_response in rows:
+                minutes = LiveWatchLog.get_minutes(date_enter, max(date_response or date_enter, date_enter))
+                ids_by_minutes[minutes].append(pk)
+                viewers_by_live[live_id] += 1
+                minutes_by_user[author_id] += minutes
+            for minutes, ids in ids_by_minutes.items():
+                for i in range(0, len(ids), chunk_size):
+                    LiveWatchLog.objects.filter(pk__in=ids[i:i + chunk_size]).update(
+                        date_leave=date_last,
+                        is_online=False,
+                        duration=models.F('duration') + minutes,
+                    )
+            lives_by_count = defaultdict(list)
+            for live_id, count in viewers_by_live.items():
+                lives_by_count[count].append(live_id)
+            for count, live_ids in lives_by_count.items():
+                LiveCounter.objects.filter(live_id__in=live_ids).update(
+                    viewer_count=models.F('viewer_count') - count,
+                )
+        LiveWatchLog.credit_watch_experience(minutes_by_user)
+        return len(rows)
+
 
 class LiveRecordLog(UserOwnedModel, models.Model):
     appid = models.IntegerField(
@@ -3292,7 +4591,8 @@ class ActiveEvent(UserOwnedModel,
 
     # 標記一個點贊
     def set_like_by(self, user, is_like=True):
-        self.set_marked_by(user, 'like', is_like)
+        if self.set_marked_by(user, 'like', is_like):
+            Conversation.on_activeevent_like(user, self)
 
     def is_liked_by_current_user(self):
         from django_base.middleware import get_request
@@ -3719,106 +5019,128 @@ class PrizeOrder(UserOwnedModel):
         :param user:
         :return:
         """
+        order = PrizeOrder.buy_prize_batch(live, [(prize, count)], user)[0]
+
+        # todo
+        # 檢測當日購買這個禮物類型夠不夠送桌布
+
+        return order
+
+    @staticmethod
+    def buy_prize_batch(live, items, user):
+        """ 在直播中連續購買多個禮物並且送出（連擊）
+        整個送禮過程在一個事務內完成，送禮用戶的錢包在提交前保持鎖定，
+        併發送禮時餘額校驗和扣費不會交錯；相同禮物合併爲一張訂單，
+        所有流水合併後一次計入錢包，送禮經驗按整批鑽石數只結算一次
+        :param live:
+        :param items: [(prize, count), ...]
+        :param user:
+        :return: 訂單列表
+        """
         # 獲取直播記錄
         watch_log = live.watch_logs.filter(author=user).first()
         assert watch_log, '用戶還沒有進入直播觀看，不能購買禮物贈送'
+        assert items, '請選擇要贈送的禮物'
+
+        # 合併相同的禮物
+        prizes = []
+        counts = dict()
+        for prize, count in items:
+            assert count > 0, '禮物數量不正確'
+            assert prize.price_type in (Prize.PRICE_TYPE_COIN, Prize.PRICE_TYPE_STAR), '不正確的禮物支付類型'
+            if prize.id not in counts:
+                prizes.append(prize)
+                counts[prize.id] = 0
+            counts[prize.id] += count
+
+        total_coin = sum(counts[prize.id] * prize.price
+                         for prize in prizes if prize.price_type == Prize.PRICE_TYPE_COIN)
+        total_star = sum(counts[prize.id] * prize.price
+                         for prize in prizes if prize.price_type == Prize.PRICE_TYPE_STAR)
+
+        with transaction.atomic():
+            # 鎖定錢包後校驗餘額是否充足
+            wallet = Wallet.lock(user, live.author)
+            assert wallet.coin >= total_coin, '赠送失败,金幣余额不足'
+            assert wallet.star >= total_star, '赠送失败,元氣不足'
+            orders = PrizeOrder.create_orders(live, user, watch_log, [
+                (prize, PrizeOrder.make_buy_transactions(live, prize, counts[prize.id], user))
+                for prize in prizes
+            ])
+
+        return orders
 
+    @staticmethod
+    def make_buy_transactions(live, prize, count, user):
+        """ 生成直接購買禮物所需的流水（未保存）
+        :return: 訂單上的流水字段名 => 流水對象
+        """
         total_price = count * prize.price
 
-        # 校驗餘額是否充足
-        if prize.price_type == Prize.PRICE_TYPE_COIN:
-            assert user.member.get_coin_balance() >= total_price, '赠送失败,金幣余额不足'
-        elif prize.price_type == Prize.PRICE_TYPE_STAR:
-            assert user.member.get_star_balance() >= total_price, '赠送失败,元氣不足'
-        else:
-            raise AssertionError('不正確的禮物支付類型')
-
         # 礼物流水
-        receiver_prize_transaction = PrizeTransaction.objects.create(
-            amount=count,
-            user_debit=live.author,
-            user_credit=live.author,
-            remark='收到用戶贈送的禮物(直播#{}-直接購買)'.format(live.id),
-            prize=prize,
-            type=PrizeTransaction.TYPE_LIVE_RECEIVE,
-            source_tag=PrizeTransaction.SOURCE_TAG_SHOP,
-        )
-        sender_prize_transaction = PrizeTransaction.objects.create(
-            amount=count,
-            user_debit=user,
-            user_credit=user,
-            remark='贈送禮物給主播(直播#{}-直接購買)'.format(live.id),
-            prize=prize,
-            type=PrizeTransaction.TYPE_LIVE_SEND_BUY,
-            source_tag=PrizeTransaction.SOURCE_TAG_SHOP,
+        transactions = dict(
+            receiver_prize_transaction=PrizeTransaction(
+                amount=count,
+                user_debit=live.author,
+                user_credit=live.author,
+                remark='收到用戶贈送的禮物(直播#{}-直接購買)'.format(live.id),
+                prize=prize,
+                type=PrizeTransaction.TYPE_LIVE_RECEIVE,
+                source_tag=PrizeTransaction.SOURCE_TAG_SHOP,
+            ),
+            sender_prize_transaction=PrizeTransaction(
+                amount=count,
+                user_debit=user,
+                user_credit=user,
+                remark='贈送禮物給主播(直播#{}-直接購買)'.format(live.id),
+                prize=prize,
+                type=PrizeTransaction.TYPE_LIVE_SEND_BUY,
+                source_tag=PrizeTransaction.SOURCE_TAG_SHOP,
+            ),
         )
 
-        coin_transaction = None
-        diamond_transaction = None
         if prize.price_type == Prize.PRICE_TYPE_COIN:
             # 金币流水
-            coin_transaction = CreditCoinTransaction.objects.create(
+            transactions['coin_transaction'] = CreditCoinTransaction(
                 user_credit=user,
                 amount=total_price,
                 type=CreditCoinTransaction.TYPE_LIVE_GIFT,
                 remark='購買禮物',
             )
             # 钻石流水
-            diamond_transaction = CreditDiamondTransaction.objects.create(
+            transactions['diamond_transaction'] = CreditDiamondTransaction(
                 user_debit=live.author,
                 amount=total_price,
                 remark='禮物兌換',
                 type=CreditDiamondTransaction.TYPE_LIVE_GIFT,
             )
 
-        star_transaction = None
-        receiver_star_index_transaction = None
-        sender_star_index_transaction = None
         if prize.price_type == Prize.PRICE_TYPE_STAR:
-            star_transaction = CreditStarTransaction.objects.create(
+            transactions['star_transaction'] = CreditStarTransaction(
                 user_credit=user,
                 amount=total_price,
                 remark='購買禮物',
                 type=CreditStarTransaction.TYPE_LIVE_GIFT,
             )
-            receiver_star_index_transaction = CreditStarIndexReceiverTransaction.objects.create(
+            transactions['receiver_star_index_transaction'] = CreditStarIndexReceiverTransaction(
                 user_debit=user,
                 amount=total_price,
                 remark='直播贈送禮物產生',
                 type=CreditStarIndexReceiverTransaction.TYPE_GENERATE,
             )
-            sender_star_index_transaction = CreditStarIndexSenderTransaction.objects.create(
+            transactions['sender_star_index_transaction'] = CreditStarIndexSenderTransaction(
                 user_debit=user,
                 amount=total_price,
                 remark='直播贈送禮物產生',
                 type=CreditStarIndexSenderTransaction.TYPE_GENERATE,
             )
 
-        # 礼物订单
-        order = PrizeOrder.objects.create(
-            author=user,
-            prize=prize,
-            live_watch_log=watch_log,
-            receiver_prize_transaction=receiver_prize_transaction,
-            sender_prize_transaction=sender_prize_transaction,
-            coin_transaction=coin_transaction,
-            diamond_transaction=diamond_transaction,
-            star_transaction=star_transaction,
-            receiver_star_index_transaction=receiver_star_index_transaction,
-            sender_star_index_transaction=sender_star_index_transaction,
-        )
-
-        # 更新主播徽章
-        live.author.member.add_diamond_badge()
-
-        # todo
-        # 檢測當日購買這個禮物類型夠不夠送桌布
-
-        return order
+        return transactions
 
     @staticmethod
     def send_active_prize(live, prize, count, user, source_tag):
         """ 在直播中送出揹包中的禮物
+        與 buy_prize 相同，在事務內鎖定送禮用戶錢包後再校驗揹包餘額
         :param live:
         :param prize:
         :param count:
@@ -3831,123 +5153,171 @@ class PrizeOrder(UserOwnedModel):
         assert watch_log, '用戶還沒有進入直播觀看，不能購買禮物贈送'
 
         total_price = count * prize.price
-        assert int(prize.get_balance(user, source_tag)) >= count, '贈送失敗，禮物剩餘不足'
-        # 礼物流水
-        receiver_prize_transaction = PrizeTransaction.objects.create(
-            amount=count,
-            user_debit=live.author,
-            user_credit=live.author,
-            remark='收到用戶贈送的禮物(直播#{}-揹包贈送)'.format(live.id),
-            prize=prize,
-            type=PrizeTransaction.TYPE_LIVE_RECEIVE,
-            source_tag=source_tag,
-        )
-        sender_prize_transaction = PrizeTransaction.objects.create(
-            amount=count,
-            user_debit=None,
-            user_credit=user,
-            remark='贈送禮物給主播(直播#{}-揹包贈送)'.format(live.id),
-            prize=prize,
-            type=PrizeTransaction.TYPE_LIVE_SEND_BAG,
-            source_tag=source_tag,
-        )
 
-        diamond_transaction = None
-        if prize.price_type == Prize.PRICE_TYPE_COIN:
-            # 钻石流水
-            diamond_transaction = CreditDiamondTransaction.objects.create(
-                user_debit=live.author,
-                amount=total_price,
-                remark='禮物兌換',
-                type=CreditDiamondTransaction.TYPE_LIVE_GIFT,
-            )
+        with transaction.atomic():
+            Wallet.lock(user, live.author)
+            assert int(prize.get_balance(user, source_tag)) >= count, '贈送失敗，禮物剩餘不足'
 
-        receiver_star_index_transaction = None
-        sender_star_index_transaction = None
-        if prize.price_type == Prize.PRICE_TYPE_STAR:
-            receiver_star_index_transaction = CreditStarIndexReceiverTransaction.objects.create(
-                user_credit=user,
-                amount=total_price,
-                remark='直播贈送禮物產生',
-                type=CreditStarIndexReceiverTransaction.TYPE_GENERATE,
+            # 礼物流水
+            transactions = dict(
+                receiver_prize_transaction=PrizeTransaction(
+                    amount=count,
+                    user_debit=live.author,
+                    user_credit=live.author,
+                    remark='收到用戶贈送的禮物(直播#{}-揹包贈送)'.format(live.id),
+                    prize=prize,
+                    type=PrizeTransaction.TYPE_LIVE_RECEIVE,
+                    source_tag=source_tag,
+                ),
+                sender_prize_transaction=PrizeTransaction(
+                    amount=count,
+                    user_debit=None,
+                    user_credit=user,
+                    remark='贈送禮物給主播(直播#{}-揹包贈送)'.format(live.id),
+                    prize=prize,
+                    type=PrizeTransaction.TYPE_LIVE_SEND_BAG,
+                    source_tag=source_tag,
+                ),
             )
-            sender_star_index_transaction = CreditStarIndexSenderTransaction.objects.create(
-                user_credit=user,
-                amount=total_price,
-                remark='直播贈送禮物產生',
-                type=CreditStarIndexSenderTransaction.TYPE_GENERATE,
+
+            if prize.price_type == Prize.PRICE_TYPE_COIN:
+                # 钻石流水
+                transactions['diamond_transaction'] = CreditDiamondTransaction(
+                    user_debit=live.author,
+                    amount=total_price,
+                    remark='禮物兌換',
+                    type=CreditDiamondTransaction.TYPE_LIVE_GIFT,
+                )
+
+            if prize.price_type == Prize.PRICE_TYPE_STAR:
+                transactions['receiver_star_index_transaction'] = CreditStarIndexReceiverTransaction(
+                    user_credit=user,
+                    amount=total_price,
+                    remark='直播贈送禮物產生',
+                    type=CreditStarIndexReceiverTransaction.TYPE_GENERATE,
+                )
+                transactions['sender_star_index_transaction'] = CreditStarIndexSenderTransaction(
+                    user_credit=user,
+                    amount=total_price,
+                    remark='直播贈送禮物產生',
+                    type=CreditStarIndexSenderTransaction.TYPE_GENERATE,
+                )
+
+            order = PrizeOrder.create_orders(live, user, watch_log, [(prize, transactions)])[0]
+
+        return order
+
+    @staticmethod
+    def create_orders(live, user, watch_log, lines):
+        """ 寫入禮物訂單及其關聯流水，需在事務內、鎖定相關錢包後調用
+        流水以未保存的對象傳入，錢包變動合併後一次計入；
+        主播徽章和送禮經驗在事務提交後按整批只處理一次，不佔用錢包鎖
+        :param lines: [(prize, transactions), ...]，transactions 爲訂單上的流水字段名 => 未保存的流水對象
+        :return: 訂單列表
+        """
+        orders = []
+        ledger = []
+        for prize, transactions in lines:
+            for item in transactions.values():
+                if isinstance(item, WalletTransactionModel):
+                    item.save(apply_wallet=False)
+                    ledger.append(item)
+                else:
+                    item.save()
+
+            # 礼物订单
+            order = PrizeOrder(
+                author=user,
+                prize=prize,
+                live_watch_log=watch_log,
+                **transactions
             )
+            order.save(settle=False)
+            orders.append(order)
 
-        # 礼物订单
-        order = PrizeOrder.objects.create(
-            author=user,
-            prize=prize,
-            live_watch_log=watch_log,
-            receiver_prize_transaction=receiver_prize_transaction,
-            sender_prize_transaction=sender_prize_transaction,
-            coin_transaction=None,
-            diamond_transaction=diamond_transaction,
-            star_transaction=None,
-            receiver_star_index_transaction=receiver_star_index_transaction,
-            sender_star_index_transaction=sender_star_index_transaction,
-        )
+        Wallet.apply_transactions(ledger)
+
+        diamond_amount = sum(order.diamond_transaction.amount
+                             for order in orders if order.diamond_transaction)
 
+        def settle():
+            from .leaderboard import record_prize_orders
+            record_prize_orders(orders)
+            LiveCounter.incr(live, diamond_amount=diamond_amount)
+            PrizeOrder.settle_first_prize(user)
+            PrizeOrder.settle_prize_experience(user, live.author, diamond_amount)
+
+        transaction.on_commit(settle)
         # 更新主播徽章
-        live.author.member.add_diamond_badge()
+        transaction.on_commit(live.author.member.add_diamond_badge)
 
-        return order
+        return orders
 
-    def save(self, *args, **kwargs):
+    def save(self, *args, settle=True, **kwargs):
+        is_new = not self.pk
         super().save(*args, **kwargs)
-        # 如果首次送礼，则享受新人福利
-        if not self.author.member.is_first_prize or not Option.get('level_rules'):
+        if is_new and settle:
+            # 新人福利和送禮經驗在事務提交後處理
+            transaction.on_commit(self.settle_experience)
+
+    def settle_experience(self):
+        """ 處理訂單產生的新人福利和送禮、收禮經驗
+        """
+        PrizeOrder.settle_first_prize(self.author)
+        if self.diamond_transaction:
+            PrizeOrder.settle_prize_experience(
+                self.author,
+                self.diamond_transaction.user_debit,
+                self.diamond_transaction.amount,
+            )
+
+    @staticmethod
+    def settle_first_prize(user):
+        """ 如果首次送礼，则享受新人福利
+        :param user: 送禮用戶
+        """
+        if not user.member.is_first_prize or not Option.get('level_rules'):
             return
-        level_rules = json.loads(Option.get('level_rules'))
-        self.author.member.is_first_prize = False
-        self.author.member.save()
-        if self.author.member.large_level == 1 and self.author.member.small_level < 10:
+        level_rules = Option.get_json('level_rules')
+        member = user.member
+        member.is_first_prize = False
+        member.save()
+        if member.large_level == 1 and member.small_level < 10:
             total_exp = level_rules.get('level_1')[0].get('value') * 10
-            first_prize_exp_transaction = ExperienceTransaction.make(self.author,
-                                                                     total_exp - self.author.member.total_experience,
-                                                                     ExperienceTransaction.TYPE_OTHER)
-            self.author.member.small_level = 10
-            self.author.member.total_experience = total_exp
-            self.author.member.current_level_experience = 0
-            self.author.member.save()
+            ExperienceTransaction.make(user,
+                                       total_exp - member.total_experience,
+                                       ExperienceTransaction.TYPE_OTHER,
+                                       is_vip_double=False)
+            member.small_level = 10
+            member.total_experience = total_exp
+            member.current_level_experience = 0
+            member.save()
 
+    @staticmethod
+    def settle_prize_experience(sender, receiver, diamond_amount):
+        """ 处理送礼、收礼所产生的经验，每累计 150 钻石计一次
+        :param sender: 送禮用戶
+        :param receiver: 主播
+        :param diamond_amount: 本次送出的鑽石數
+        """
         rule_send = int(Option.get('experience_points_prize_send') or 0)
         rule_receive = int(Option.get('experience_points_prize_receive') or 0)
-        if not rule_send or not rule_receive:
+        if not rule_send or not rule_receive or not diamond_amount:
             return
-        if self.diamond_transaction:
-            # 处理送礼、收礼　所产生的经验
-            sender = self.author
-            receiver = self.diamond_transaction.user_debit
-            sender_debit_diamond_extend = sender.member.debit_diamond_extend
-            receiver_credit_diamond_extend = receiver.member.credit_diamond_extend
-            if self.diamond_transaction.amount + sender_debit_diamond_extend < 150:
-                sender.member.debit_diamond_extend += self.diamond_transaction.amount
-            else:
-                sender.member.debit_diamond_extend = (
-                                                         self.diamond_transaction.amount + sender_debit_diamond_extend) % 150
-                sender_experience = ExperienceTransaction.make(sender,
-                                                               rule_send * int(
-                                                                   (
-                                                                       self.diamond_transaction.amount + sender_debit_diamond_extend) / 150),
-                                                               ExperienceTransaction.TYPE_SEND)
-                sender_experience.update_level()
-            sender.member.save()
-            if self.diamond_transaction.amount + receiver_credit_diamond_extend < 150:
-                receiver.member.credit_diamond_extend += self.diamond_transaction.amount
-            else:
-                receiver.member.credit_diamond_extend = (
-                                                            self.diamond_transaction.amount + receiver_credit_diamond_extend) % 150
-                receiver_experience = ExperienceTransaction.make(receiver,
-                                                                 rule_receive * int((
-                                                                                        self.diamond_transaction.amount + receiver_credit_diamond_extend) / 150),
-                                                                 ExperienceTransaction.TYPE_RECEIVE)
-                receiver_experience.update_level()
-            receiver.member.save()
+        for user, field, rule, experience_type in (
+                (sender, 'debit_diamond_extend', rule_send, ExperienceTransaction.TYPE_SEND),
+                (receiver, 'credit_diamond_extend', rule_receive, ExperienceTransaction.TYPE_RECEIVE),
+        ):
+            with transaction.atomic():
+                # 鎖定會員行，避免併發送禮時累計值被覆蓋
+                member = Member.objects.select_for_update().get(user=user)
+                user.member = member
+                total = getattr(member, field) + diamond_amount
+                setattr(member, field, total % 150)
+                if total >= 150:
+                    experience = ExperienceTransaction.make(user, rule * int(total / 150), experience_type)
+                    experience.update_level()
+                member.save()
 
 
 class RankRecord(UserOwnedModel):
@@ -3992,102 +5362,125 @@ class RankRecord(UserOwnedModel):
     def __str__(self):
         return '{}:{}'.format(self.author, self.get_duration_display())
 
-    def update(self):
-        now = datetime.now()
+    @staticmethod
+    def get_periods(now=None):
+        """ 日榜、周榜的統計區間，每日 5 點重置，周榜於週一 5 點重置
+        :return: {duration: (date_begin, date_end)}
+        """
+        now = now or datetime.now()
         am5 = datetime(now.year, now.month, now.day, 5, 0)
-        tomorrow_am5 = am5 + timedelta(days=1)
-        weekday = now.weekday()
-        monday = am5 - timedelta(days=weekday)
-        sunday = am5 + timedelta(days=7 - weekday)
-        # 日榜重置
-        if self.duration == self.DURATION_DATE and (now - am5).total_seconds() > 0 and (
-                    now - am5).total_seconds() < 900:
-            self.receive_diamond_amount = 0
-            self.send_diamond_amount = 0
-            self.star_index_amount = 0
-            self.save()
-        # 周榜重置
-        elif self.duration == self.DURATION_WEEK and weekday == 0 and (now - am5).total_seconds() > 0 and (
-                    now - am5).total_seconds() < 900:
-            self.receive_diamond_amount = 0
-            self.send_diamond_amount = 0
-            self.star_index_amount = 0
-            self.save()
-        elif self.duration == self.DURATION_TOTAL:
-            self.receive_diamond_amount = PrizeOrder.objects.filter(
-                diamond_transaction__user_debit=self.author,
-            ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
-
-            self.send_diamond_amount = PrizeOrder.objects.filter(
-                author=self.author,
-                diamond_transaction__id__gt=0,
-            ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
-
-            credit = self.author.creditstarindexreceivertransactions_credit.aggregate(
-                amount=models.Sum('amount')).get('amount') or 0
-            debit = self.author.creditstarindexreceivertransactions_debit.aggregate(
-                amount=models.Sum('amount')).get('amount') or 0
-            self.star_index_amount = debit - credit
-            self.save()
-        elif self.duration == self.DURATION_DATE:
-            self.receive_diamond_amount = PrizeOrder.objects.filter(
-                diamond_transaction__user_debit=self.author,
-                date_created__gt=am5,
-                date_created__lt=tomorrow_am5,
-            ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
-
-            self.send_diamond_amount = PrizeOrder.objects.filter(
-                author=self.author,
-                diamond_transaction__id__gt=0,
-                date_created__gt=am5,
-                date_created__lt=tomorrow_am5,
-            ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
-
-            credit = PrizeOrder.objects.filter(
-                author=self.author,
-                sender_star_index_transaction__id__gt=0,
-                date_created__gt=am5,
-                date_created__lt=tomorrow_am5,
-            ).aggregate(amount=models.Sum('sender_star_index_transaction__amount')).get('amount') or 0
-
-            debit = PrizeOrder.objects.filter(
-                author=self.author,
-                receiver_star_index_transaction__id__gt=0,
-                date_created__gt=am5,
-                date_created__lt=tomorrow_am5,
-            ).aggregate(amount=models.Sum('receiver_star_index_transaction__amount')).get('amount') or 0
-            self.star_index_amount = debit - credit
-            self.save()
+        if now < am5:
+            # 5 點前仍屬於前一天的榜單
+            am5 -= timedelta(days=1)
+        monday = am5 - timedelta(days=am5.weekday())
+        return {
+            RankRecord.DURATION_DATE: (am5, am5 + timedelta(days=1)),
+            RankRecord.DURATION_WEEK: (monday, monday + timedelta(days=7)),
+        }
 
-        elif self.duration == self.DURATION_WEEK:
-            self.receive_diamond_amount = PrizeOrder.objects.filter(
-                diamond_transaction__user_debit=self.author,
-                date_created__gt=monday,
-                date_created__lt=sunday,
-            ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
+    @staticmethod
+    def compute_amounts(duration, authors=None, now=None):
+        """ 用分組查詢統計某個區間內所有用戶的榜單數值
+        :param duration: 統計區間
+        :param authors: 只統計這些用戶 id，None 爲全部
+        :return: {user_id: [receive_diamond_amount, send_diamond_amount, star_index_amount]}
+        """
+        amounts = dict()
+
+        def add(user_id, index, amount):
+            amounts.setdefault(user_id, [0, 0, 0])[index] += amount or 0
+
+        orders = PrizeOrder.objects.all()
+        if duration != RankRecord.DURATION_TOTAL:
+            date_begin, date_end = RankRecord.get_periods(now)[duration]
+            orders = orders.filter(date_created__gt=date_begin, date_created__lt=date_end)
+
+        # 收到的鑽石
+        receive = orders.filter(diamond_transaction__isnull=False)
+        if authors is not None:
+            receive = receive.filter(diamond_transaction__user_debit__in=authors)
+        for row in receive.values('diamond_transaction__user_debit').annotate(
+                amount=models.Sum('diamond_transaction__amount')):
+            add(row['diamond_transaction__user_debit'], 0, row['amount'])
+
+        if authors is not None:
+            orders = orders.filter(author__in=authors)
+
+        # 送出的鑽石
+        for row in orders.filter(diamond_transaction__isnull=False).values('author').annotate(
+                amount=models.Sum('diamond_transaction__amount')):
+            add(row['author'], 1, row['amount'])
+
+        # 元氣指數
+        if duration == RankRecord.DURATION_TOTAL:
+            wallets = Wallet.objects.exclude(star_index_receiver=0)
+            if authors is not None:
+                wallets = wallets.filter(user__in=authors)
+            for user_id, amount in wallets.values_list('user', 'star_index_receiver'):
+                add(user_id, 2, amount)
+        else:
+            for row in orders.filter(
+                    models.Q(receiver_star_index_transaction__isnull=False) |
+                    models.Q(sender_star_index_transaction__isnull=False)
+            ).values('author').annotate(
+                debit=models.Sum('receiver_star_index_transaction__amount'),
+                credit=models.Sum('sender_star_index_transaction__amount'),
+            ):
+                add(row['author'], 2, (row['debit'] or 0) - (row['credit'] or 0))
 
-            self.send_diamond_amount = PrizeOrder.objects.filter(
-                author=self.author,
-                diamond_transaction__id__gt=0,
-                date_created__gt=monday,
-                date_created__lt=sunday,
-            ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
+        return amounts
 
-            credit = PrizeOrder.objects.filter(
-                author=self.author,
-                sender_star_index_transaction__id__gt=0,
-                date_created__gt=monday,
-                date_created__lt=sunday,
-            ).aggregate(amount=models.Sum('sender_star_index_transaction__amount')).get('amount') or 0
+    @staticmethod
+    def update_all(authors=None, now=None):
+        """ 批量重算排行榜記錄
+        每個區間用幾條分組查詢得到所有用戶的數值，缺少的記錄批量創建，
+        只有數值變化的記錄纔會寫回
+        :param authors: 只更新這些用戶 id，None 爲全部會員
+        :return: dict(created=創建數, updated=更新數)
+        """
+        if authors is None:
+            authors_all = list(Member.objects.values_list('user_id', flat=True))
+        else:
+            authors_all = list(authors)
+        fields = ('receive_diamond_amount', 'send_diamond_amount', 'star_index_amount')
+        created = 0
+        updated = 0
+        for duration, duration_name in RankRecord.DURATION_CHOICES:
+            amounts = RankRecord.compute_amounts(duration, authors, now)
+            records = RankRecord.objects.filter(duration=duration)
+            if authors is not None:
+                records = records.filter(author__in=authors)
+            existing = dict()
+            for row in records.values('id', 'author', *fields):
+                existing[row['author']] = row
+
+            # 缺少的記錄批量創建
+            missing = [RankRecord(
+                author_id=author_id,
+                duration=duration,
+                receive_diamond_amount=amounts.get(author_id, [0, 0, 0])[0],
+                send_diamond_amount=amounts.get(author_id, [0, 0, 0])[1],
+                star_index_amount=amounts.get(author_id, [0, 0, 0])[2],
+            ) for author_id in authors_all if author_id not in existing]
+            RankRecord.objects.bulk_create(missing, batch_size=1000)
+            created += len(missing)
+
+            # 有變化的記錄按數值分組，每組一條 UPDATE；
+            # 換期歸零的記錄和相同金額的小額送禮佔大多數，語句數遠少於記錄數
+            groups = dict()
+            for author_id, row in existing.items():
+                values = tuple(amounts.get(author_id, [0, 0, 0]))
+                if tuple(row[field] for field in fields) == values:
+                    continue
+                groups.setdefault(values, []).append(row['id'])
+                updated += 1
+            for values, ids in groups.items():
+                for i in range(0, len(ids), 1000):
+                    RankRecord.objects.filter(id__in=ids[i:i + 1000]).update(**dict(zip(fields, values)))
+        return dict(created=created, updated=updated)
 
-            debit = PrizeOrder.objects.filter(
-                author=self.author,
-                receiver_star_index_transaction__id__gt=0,
-                date_created__gt=monday,
-                date_created__lt=sunday,
-            ).aggregate(amount=models.Sum('receiver_star_index_transaction__amount')).get('amount') or 0
-            self.star_index_amount = debit - credit
-            self.save()
+    def update(self):
+        RankRecord.update_all(authors=[self.author_id])
 
     @staticmethod
     def make(member):
@@ -4114,6 +5507,246 @@ class RankRecord(UserOwnedModel):
         )
 
 
+class LeaderboardScore(models.Model):
+    """ 排行榜分數（SQL 排行榜後端）
+    每個榜單、每個統計週期、每個用戶一行，送禮時增量累加，
+    週期以日期標識（日榜爲當日 5 點所屬日期，周榜爲週一日期），換期即自然重置
+    """
+    board = models.CharField(
+        verbose_name='榜單',
+        max_length=30,
+    )
+
+    period = models.CharField(
+        verbose_name='統計週期',
+        max_length=20,
+    )
+
+    user = models.ForeignKey(
+        verbose_name='用戶',
+        to=User,
+        related_name='leaderboard_scores',
+    )
+
+    score = models.DecimalField(
+        verbose_name='分數',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    class Meta:
+        verbose_name = '排行榜分數'
+        verbose_name_plural = '排行榜分數'
+        db_table = 'core_leaderboard_score'
+        unique_together = [('board', 'period', 'user')]
+        index_together = [('board', 'period', 'score')]
+
+
+class DailyStatistic(models.Model):
+    """ 平台每日统计
+    每天一行，由周期任务 update_daily_statistic 维护：已经过去的日期只统计一次并标记为已结算，
+    之后每次只重新统计当天的记录；后台图表和累计充值直接读取此表
+    """
+    date = models.DateField(
+        verbose_name='统计日期',
+        unique=True,
+    )
+
+    active_count = models.IntegerField(
+        verbose_name='活跃用户数',
+        default=0,
+        help_text='当天有登录记录的用户数',
+    )
+
+    login_count = models.IntegerField(
+        verbose_name='登录次数',
+        default=0,
+    )
+
+    new_member_count = models.IntegerField(
+        verbose_name='新增会员数',
+        default=0,
+    )
+
+    recharge_count = models.IntegerField(
+        verbose_name='充值笔数',
+        default=0,
+    )
+
+    recharge_amount = models.DecimalField(
+        verbose_name='充值金额',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    withdraw_amount = models.DecimalField(
+        verbose_name='提现金额',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+        help_text='当天审批通过的提现',
+    )
+
+    gift_count = models.IntegerField(
+        verbose_name='送礼次数',
+        default=0,
+    )
+
+    gift_diamond_amount = models.DecimalField(
+        verbose_name='礼物钻石数',
+        max_digits=18,
+        decimal_places=2,
+        default=0,
+    )
+
+    live_count = models.IntegerField(
+        verbose_name='开播场数',
+        default=0,
+    )
+
+    live_minutes = models.IntegerField(
+        verbose_name='直播分钟数',
+        default=0,
+        help_text='当天处于直播中的总时长，跨天的直播按每天的部分分别计入',
+    )
+
+    peak_viewer_count = models.IntegerField(
+        verbose_name='最高同时观看人数',
+        default=0,
+        help_text='按观看记录的进入、离开时间计算',
+    )
+
+    is_closed = models.BooleanField(
+        verbose_name='是否已结算',
+        default=False,
+    )
+
+    date_updated = models.DateTimeField(
+        verbose_name='更新时间',
+        auto_now=True,
+    )
+
+    # 补算历史日期时每次统计的天数
+    CHUNK_DAYS = 31
+
+    class Meta:
+        verbose_name = '每日统计'
+        verbose_name_plural = '每日统计'
+        db_table = 'core_daily_statistic'
+
+    @staticmethod
+    def compute(begin, end, now=None):
+        """ 统计 [begin, end) 内每天的数据
+        计数和金额每项一次按日分组的查询，直播时长和同时观看人数取出区间内的记录后在内存中计算
+        :param begin: 开始日期
+        :param end: 结束日期（不包含）
+        :param now: 当前时间，尚未结束的直播和观看记录截止到此时
+        :return: {date: dict(field=value)}
+        """
+        from django_base import timeseries
+        now = now or datetime.now()
+        begin = datetime(begin.year, begin.month, begin.day)
+        end = datetime(end.year, end.month, end.day)
+        days = [begin + timedelta(days=i) for i in range((end - begin).days)]
+        stats = {day.date(): dict() for day in days}
+
+        def series(field, queryset, date_field, value=None):
+            for start, stop, amount in timeseries.aggregate_series(
+                    queryset, date_field, begin, end, timeseries.GRANULARITY_DAY, value):
+                stats[start.date()][field] = amount
+
+        recharges = AccountTransaction.objects.filter(type=AccountTransaction.TYPE_RECHARGE)
+        series('active_count', LoginRecord.objects.all(), 'date_login', models.Count('author', distinct=True))
+        series('login_count', LoginRecord.objects.all(), 'date_login')
+        series('new_member_count', Member.objects.all(), 'date_created')
+        series('recharge_count', recharges, 'date_created')
+        series('recharge_amount', recharges, 'date_created', models.Sum('amount'))
+        series('withdraw_amount', AccountTransaction.objects.filter(
+            type=AccountTransaction.TYPE_WITHDRAW,
+        ), 'date_created', models.Sum('amount'))
+        series('gift_count', PrizeOrder.objects.all(), 'date_created')
+        series('gift_diamond_amount', PrizeOrder.objects.exclude(
+            diamond_transaction=None,
+        ), 'date_created', models.Sum('diamond_transaction__amount'))
+        series('live_count', Live.objects.all(), 'date_created')
+
+        # 直播时长，按天切分与区间重叠的部分
+        minutes = defaultdict(float)
+        for date_begin, date_end in Live.objects.filter(
+                models.Q(date_end=None) | models.Q(date_end__gt=begin),
+                date_created__lt=end,
+        ).values_list('date_created', 'date_end'):
+            start = max(date_begin, begin)
+            date_end = min(date_end or now, end)
+            while start < date_end:
+                stop = min(datetime(start.year, start.month, start.day) + timedelta(days=1), date_end)
+                minutes[start.date()] += (stop - start).total_seconds() / 60
+                start = stop
+
+        # 同时观看人数，按时间顺序扫描进入（+1）、离开（-1）事件，
+        # 每天开始时加入一个 0 事件，使跨天观看的人数计入新的一天
+        events = [(day, 0) for day in days]
+        for date_enter, date_leave in LiveWatchLog.objects.filter(
+                models.Q(date_leave=None) | models.Q(date_leave__gt=begin),
+                date_enter__lt=end,
+        ).values_list('date_enter', 'date_leave'):
+            if not date_leave or date_leave < date_enter:
+                # 仍在观看（或离开后再次进入）
+                date_leave = now
+            date_leave = min(date_leave, end)
+            if date_leave <= begin:
+                continue
+            events.append((max(date_enter, begin), 1))
+            events.append((date_leave, -1))
+        events.sort()
+        peaks = defaultdict(int)
+        current = 0
+        for moment, delta in events:
+            current += delta
+            peaks[moment.date()] = max(peaks[moment.date()], current)
+
+        for day, values in stats.items():
+            values['live_minutes'] = int(minutes[day])
+            values['peak_viewer_count'] = peaks[day]
+        return stats
+
+    @staticmethod
+    def save_days(stats, is_closed):
+        with transaction.atomic():
+            DailyStatistic.objects.filter(date__in=list(stats.keys())).delete()
+            DailyStatistic.objects.bulk_create([
+                DailyStatistic(date=date, is_closed=is_closed, **values)
+                for date, values in sorted(stats.items())
+            ])
+
+    @staticmethod
+    def update(now=None):
+        """ 结算最后一次结算之后已经过去的日期，并重新统计当天
+        第一次运行时从最早的会员注册日期开始，按 CHUNK_DAYS 天一批补算
+        :param now: 当前时间
+        :return: 本次统计的天数
+        """
+        now = now or datetime.now()
+        today = now.date()
+        begin = DailyStatistic.objects.filter(is_closed=True).aggregate(
+            date=models.Max('date')).get('date')
+        if begin:
+            begin += timedelta(days=1)
+        else:
+            first = Member.objects.aggregate(date=models.Min('date_created')).get('date')
+            begin = min(first.date(), today) if first else today
+        count = 0
+        while begin < today:
+            end = min(begin + timedelta(days=DailyStatistic.CHUNK_DAYS), today)
+            DailyStatistic.save_days(DailyStatistic.compute(begin, end, now), is_closed=True)
+            count += (end - begin).days
+            begin = end
+        DailyStatistic.save_days(DailyStatistic.compute(today, today + timedelta(days=1), now), is_closed=False)
+        return count + 1
+
+
 class ExtraPrize(EntityModel):
     """ 赠送礼物
     购买礼物包超过N个金币，赠送给对应的用户一张壁纸
@@ -0,0 +1,113 @@
+""" 根据序列化器字段自动生成 select_related / prefetch_related
+
+遍历序列化器实际输出的字段（已经按 QueryFieldsMixin 的 ?fields= 筛选），
+沿每个字段的 source 在模型上逐级查找关系：
+    - 外键、一对一（包括反向一对一）加入 select_related
+    - 多对多、反向外键以及其后的路径加入 prefetch_related
+    - 遇到普通字段、方法或属性即停止，方法内部的查询不在此列，
+      需要时在序列化器 Meta.select_related_hints 中按字段名声明额外的 select_related 路径
+嵌套序列化器按相同规则递归。只输出主键的外键字段不需要关联查询，不会加入。
+"""
+from django.core.exceptions import FieldDoesNotExist
+from django.db.models.query import ModelIterable, QuerySet
+from rest_framework import serializers
+from rest_framework.relations import ManyRelatedField, PrimaryKeyRelatedField
+
+_plans = dict()
+
+
+def get_related_field(model, name):
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return None
+    if not field.is_relation or field.related_model is None:
+        return None
+    return field
+
+
+def walk(serializer, model, prefix, select, prefetch, many=False):
+    for field in serializer.fields.values():
+        walk_field(serializer, field, model, prefix, select, prefetch, many)
+
+
+def walk_field(serializer, field, model, prefix, select, prefetch, many=False):
+    if field.write_only:
+        return
+    hints = getattr(getattr(serializer, 'Meta', None), 'select_related_hints', dict())
+    if field.field_name in hints:
+        path = '{}__{}'.format(prefix, hints[field.field_name]) if prefix else hints[field.field_name]
+        (prefetch if many else select).add(path)
+    if isinstance(field, serializers.ListSerializer):
+        child, field_many = field.child, True
+    else:
+        child, field_many = field, False
+    if field.source == '*':
+        if isinstance(child, serializers.BaseSerializer):
+            walk(child, model, prefix, select, prefetch, many or field_many)
+        return
+    current, path, is_many = model, prefix, many
+    attrs = field.source_attrs
+    for i, attr in enumerate(attrs):
+        related_field = get_related_field(current, attr)
+        if related_field is None:
+            break
+        is_many = is_many or related_field.many_to_many or related_field.one_to_many
+        if i == len(attrs) - 1 and not is_many and isinstance(child, PrimaryKeyRelatedField):
+            # 只输出外键的值，不需要关联
+            break
+        path = '{}__{}'.format(path, attr) if path else attr
+        (prefetch if is_many else select).add(path)
+        current = related_field.related_model
+    else:
+        if isinstance(child, serializers.BaseSerializer) and not isinstance(field, ManyRelatedField):
+            walk(child, current, path, select, prefetch, is_many or field_many)
+
+
+def minimize(paths):
+    """ 去掉被更长路径覆盖的前缀路径 """
+    return sorted(
+        path for path in paths
+        if not any(other.startswith(path + '__') for other in paths)
+    )
+
+
+def get_plan(serializer, model=None):
+    """ 序列化器需要的关联查询
+    :param serializer: 序列化器实例
+    :param model: 查询集的模型，默认为序列化器的 Meta.model
+    :return: (select_related 路径列表, prefetch_related 路径列表)
+    """
+    model = model or serializer.Meta.model
+    # 按顶层字段分别缓存，?fields= 的任意组合都只是取其中一部分，缓存大小以序列化器声明的字段为限
+    fields = _plans.setdefault((type(serializer), model), dict())
+    select, prefetch = set(), set()
+    for name, field in serializer.fields.items():
+        if name not in fields:
+            plan = (set(), set())
+            walk_field(serializer, field, model, '', *plan)
+            fields[name] = plan
+        select |= fields[name][0]
+        prefetch |= fields[name][1]
+    return minimize(select), minimize(prefetch)
+
+
+def plan_queryset(queryset, serializer):
+    """ 按序列化器字段给查询集加上 select_related / prefetch_related """
+    if not isinstance(queryset, QuerySet) or queryset._iterable_class is not ModelIterable \
+            or getattr(queryset.query, 'combinator', None):
+        return queryset
+    select, prefetch = get_plan(serializer, queryset.model)
+    if select:
+        queryset = queryset.select_related(*select)
+    if prefetch:
+        queryset = queryset.prefetch_related(*prefetch)
+    return queryset
+
+
+class PrefetchPlannerMixin:
+    """ ViewSet 混入类，列表和详情查询自动按序列化器字段加上关联查询 """
+
+    def filter_queryset(self, queryset):
+        queryset = super().filter_queryset(queryset)
+        return plan_queryset(queryset, self.get_serializer())
@@ -0,0 +1,227 @@
+""" 直播间在线状态
+
+在进程内按直播间记录观众最后一次心跳，观看人数直接取在线集合的大小，
+不再每次轮询都扫描 LiveWatchLog。
+
+- 观众超过 PRESENCE_TTL 秒没有心跳即视为离开，在下一次刷新时执行离开逻辑；
+  执行前再检查数据库中的心跳时间，观众可能正通过其他进程心跳
+- 心跳时间先保存在内存中，每 PRESENCE_FLUSH_INTERVAL 秒批量写回
+  LiveWatchLog.date_response 和 Live.date_response
+- 多个进程各自维护状态，每 PRESENCE_SYNC_INTERVAL 秒从数据库合并一次，
+  进出房间仍然同步写数据库，所以数据库是在线名单的准绳
+"""
+from collections import OrderedDict
+from datetime import datetime
+from threading import RLock
+from time import time
+
+from django.conf import settings
+from django.db import models
+
+
+def get_ttl():
+    return getattr(settings, 'PRESENCE_TTL', 360)
+
+
+class LivePresence:
+    """ 直播间在线观众登记表 """
+
+    def __init__(self, ttl=None, flush_interval=None, sync_interval=None, loader=None):
+        self.ttl = ttl or get_ttl()
+        self.flush_interval = flush_interval or getattr(settings, 'PRESENCE_FLUSH_INTERVAL', 60)
+        self.sync_interval = sync_interval or getattr(settings, 'PRESENCE_SYNC_INTERVAL', 60)
+        self.loader = loader or self.load
+        self.lock = RLock()
+        # live_id => OrderedDict(user_id => 最后心跳时间)，按心跳时间先后排列
+        self.viewers = dict()
+        self.date_synced = dict()
+        # 等待写回数据库的心跳和超时离开的观众
+        self.pending_viewers = dict()
+        self.pending_owners = dict()
+        self.expired = []
+        self.date_flushed = time()
+
+    @staticmethod
+    def load(live_id):
+        """ 从数据库读取直播间内仍在观看的观众
+        :param live_id: 直播 id
+        :return: {user_id: 最后心跳时间戳}
+        """
+        from .models import LiveWatchLog
+        rows = LiveWatchLog.objects.filter(
+            live_id=live_id,
+            is_online=True,
+        ).values_list('author_id', 'date_enter', 'date_response')
+        return {
+            user_id: max(date_enter, date_response or date_enter).timestamp()
+            for user_id, date_enter, date_response in rows
+        }
+
+    def get_viewers(self, live_id, now):
+        """ 取直播间的在线集合，首次访问或到期时与数据库合并 """
+        viewers = self.viewers.get(live_id)
+        if viewers is not None and now - self.date_synced[live_id] < self.sync_interval:
+            return viewers
+        loaded = self.loader(live_id)
+        viewers = viewers or dict()
+        merged = {
+            user_id: max(last_seen, viewers.get(user_id, 0))
+            for user_id, last_seen in loaded.items()
+        }
+        self.viewers[live_id] = OrderedDict(sorted(merged.items(), key=lambda item: item[1]))
+        self.date_synced[live_id] = now
+        return self.viewers[live_id]
+
+    def expire(self, live_id, now):
+        """ 移除超时的观众，集合按心跳时间排列，只需从头部弹出 """
+        viewers = self.viewers.get(live_id)
+        while viewers:
+            user_id, last_seen = next(iter(viewers.items()))
+            if now - last_seen < self.ttl:
+                break
+            viewers.popitem(last=False)
+            self.pending_viewers.pop((live_id, user_id), None)
+            self.expired.append((live_id, user_id))
+
+    def touch(self, live_id, user_id, now):
+        viewers = self.get_viewers(live_id, now)
+        viewers.pop(user_id, None)
+        viewers[user_id] = now
+
+    def enter(self, live_id, user_id):
+        """ 观众进入直播间 """
+        now = time()
+        with self.lock:
+            self.touch(live_id, user_id, now)
+
+    def leave(self, live_id, user_id):
+        """ 观众离开直播间 """
+        with self.lock:
+            viewers = self.viewers.get(live_id)
+            if viewers is not None:
+                viewers.pop(user_id, None)
+            self.pending_viewers.pop((live_id, user_id), None)
+
+    def heartbeat(self, live_id, user_id):
+        """ 观众心跳
+        :return: 观众是否在直播间内，不在的心跳不会被记录
+        """
+        now = time()
+        with self.lock:
+            if user_id not in self.get_viewers(live_id, now):
+                return False
+            self.touch(live_id, user_id, now)
+            self.pending_viewers[(live_id, user_id)] = now
+        self.flush_if_due(now)
+        return True
+
+    def owner_heartbeat(self, live_id):
+        """ 主播心跳 """
+        now = time()
+        with self.lock:
+            self.pending_owners[live_id] = now
+        self.flush_if_due(now)
+
+    def count(self, live_id):
+        """ 直播间当前观看人数 """
+        now = time()
+        with self.lock:
+            viewers = self.get_viewers(live_id, now)
+            self.expire(live_id, now)
+            return len(viewers)
+
+    def flush_if_due(self, now):
+        if now - self.date_flushed >= self.flush_interval:
+            self.flush(now)
+
+    def flush(self, now=None):
+        """ 批量写回心跳时间，并对超时的观众执行离开逻辑
+        每个直播间的观众一条 UPDATE，每行写入各自的心跳时间
+        """
+        from .models import Live, LiveWatchLog
+        now = now or time()
+        with self.lock:
+            for live_id in list(self.viewers.keys()):
+                self.expire(live_id, now)
+                if not self.viewers[live_id]:
+                    # 空房间不再占用内存，下次访问时重新从数据库读取
+                    del self.viewers[live_id]
+                    del self.date_synced[live_id]
+            pending_viewers, self.pending_viewers = self.pending_viewers, dict()
+            pending_owners, self.pending_owners = self.pending_owners, dict()
+            expired, self.expired = self.expired, []
+            self.date_flushed = now
+
+        lives = dict()
+        for (live_id, user_id), last_seen in pending_viewers.items():
+            lives.setdefault(live_id, dict())[user_id] = last_seen
+        for live_id, viewers in lives.items():
+            LiveWatchLog.objects.filter(
+                live_id=live_id,
+                author_id__in=list(viewers.keys()),
+            ).update(date_response=get_case('author_id', viewers))
+
+        if pending_owners:
+            Live.objects.filter(
+                pk__in=list(pending_owners.keys()),
+            ).update(date_response=get_case('pk', pending_owners))
+
+        for live_id, user_id in expired:
+            log = LiveWatchLog.objects.filter(live_id=live_id, author_id=user_id).first()
+            if not log or not log.is_watching():
+                continue
+            # 本进程的在线集合可能已经过时，观众仍在通过其他进程心跳时不离开
+            last_seen = max(log.date_enter, log.date_response or log.date_enter).timestamp()
+            if now - last_seen < self.ttl:
+                continue
+            log.leave_live()
+
+
+def get_case(field, values):
+    """ 按 field 取各行自己的心跳时间
+    :param values: {field 值: 时间戳}
+    """
+    return models.Case(*[
+        models.When(**{field: key, 'then': models.Value(datetime.fromtimestamp(last_seen))})
+        for key, last_seen in values.items()
+    ], output_field=models.DateTimeField())
+
+
+_tracker = None
+
+
+def get_tracker():
+    global _tracker
+    if _tracker is None:
+        _tracker = LivePresence()
+    return _tracker
+
+
+def set_tracker(tracker):
+    """ 替换在线状态登记表，例如测试时传入自定义 loader 的 LivePresence """
+    global _tracker
+    _tracker = tracker
+
+
+def enter(live_id, user_id):
+    get_tracker().enter(live_id, user_id)
+
+
+def leave(live_id, user_id):
+    get_tracker().leave(live_id, user_id)
+
+
+def heartbeat(live_id, user_id):
+    return get_tracker().heartbeat(live_id, user_id)
+
+
+def owner_heartbeat(live_id):
+    get_tracker().owner_heartbeat(live_id)
+
+
+def count(live_id):
+    return get_tracker().count(live_id)
+
+
+def flush():
+    get_tracker().flush()
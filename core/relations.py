@@ -0,0 +1,84 @@
+""" 当前用户与一页用户的关系
+
+列表序列化时，追踪、联系人、黑名单、免打扰等字段原本逐行各查询一次数据库，
+一页 N 个会员需要约 5N 次查询。这里按页收集用户 id，每种关系只查询一次，
+序列化字段从集合中取值，未覆盖的对象仍回退到模型上的逐个查询。
+关系在第一次被读取时才查询，?fields= 没有选中的字段不会产生查询。
+"""
+from django.contrib.contenttypes.models import ContentType
+
+
+class ViewerRelations:
+    """ 当前用户与一组用户（及一组对象）的关系 """
+
+    def __init__(self, viewer, user_ids, object_ids=()):
+        """
+        :param viewer: 当前用户，未登录时所有关系都为空
+        :param user_ids: 本页涉及的用户 id
+        :param object_ids: 本页对象的 id，用于查询当前用户对这些对象的标记
+        """
+        self.viewer = viewer if viewer is not None and viewer.is_authenticated else None
+        self.user_ids = set(user_id for user_id in user_ids if user_id)
+        self.object_ids = set(object_ids)
+        self.cache = dict()
+
+    def covers(self, user_id):
+        return user_id in self.user_ids
+
+    def get(self, name, loader):
+        if name not in self.cache:
+            self.cache[name] = set(loader()) if self.viewer else set()
+        return self.cache[name]
+
+    def get_following_ids(self):
+        """ 当前用户追踪的用户 """
+        from .models import Follow
+        return self.get('following', lambda: Follow.get_following_ids(self.viewer, self.user_ids))
+
+    def get_contact_ids(self):
+        """ 当前用户的联系人 """
+        from .models import Contact
+        return self.get('contact', lambda: Contact.objects.filter(
+            author=self.viewer,
+            user_id__in=self.user_ids,
+        ).values_list('user_id', flat=True))
+
+    def get_contact_me_ids(self):
+        """ 联系人中有当前用户的用户 """
+        from .models import Contact
+        return self.get('contact_me', lambda: Contact.objects.filter(
+            author_id__in=self.user_ids,
+            user=self.viewer,
+        ).values_list('author_id', flat=True))
+
+    def get_blacklist_ids(self):
+        """ 被当前用户标记为黑名单的用户 """
+        from .models import Member, UserMark
+        return self.get('blacklist', lambda: UserMark.objects.filter(
+            author=self.viewer,
+            subject='blacklist',
+            content_type=ContentType.objects.get_for_model(Member),
+            object_id__in=self.user_ids,
+        ).values_list('object_id', flat=True))
+
+    def get_not_disturb_ids(self):
+        """ 被当前用户设为免打扰的联系人 """
+        from .models import ContactSetting
+        return self.get('not_disturb', lambda: ContactSetting.objects.filter(
+            contact__author=self.viewer,
+            contact__user_id__in=self.user_ids,
+            key='is_not_disturb',
+            value='1',
+        ).values_list('contact__user_id', flat=True))
+
+    def get_marked_object_ids(self, model, subject):
+        """ 本页对象中被当前用户以 subject 标记的对象，例如点赞的动态 """
+        from .models import UserMark
+        if not self.object_ids:
+            return set()
+        return self.get('mark:{}:{}'.format(model._meta.label_lower, subject), lambda: UserMark.objects.filter(
+            author=self.viewer,
+            subject=subject,
+            content_type=ContentType.objects.get_for_model(model),
+            object_id__in=self.object_ids,
+        ).values_list('object_id', flat=True))
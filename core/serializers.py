@@ -6,6 +6,7 @@ from drf_extra_fields.fields import Base64ImageField
 from drf_queryfields import QueryFieldsMixin
 
 from . import models as m
+from .relations import ViewerRelations
 
 
 class AllowNestedWriteMixin:
@@ -103,6 +104,51 @@ class UserOwndedMixinSerializer(serializers.Serializer):
         source='author.shop.name')
 
 
+class ViewerRelationsListSerializer(serializers.ListSerializer):
+    """ 列表序列化前一次查出当前用户与本页全部用户的关系，供 ViewerRelationsMixin 的字段使用
+    """
+
+    def to_representation(self, data):
+        items = list(data.all() if isinstance(data, m.models.Manager) else data)
+        request = self.context.get('request')
+        if request is not None:
+            self.context['viewer_relations'] = ViewerRelations(
+                request.user,
+                [self.child.get_relation_user_id(item) for item in items],
+                [item.pk for item in items],
+            )
+        return super().to_representation(items)
+
+
+class ViewerRelationsMixin:
+    """ 与当前用户关系有关的字段
+    列表时从 ViewerRelations 批量结果中取值，单个对象或不在本页的对象回退到模型方法
+    需要在 Meta 中设置 list_serializer_class = ViewerRelationsListSerializer
+    """
+    # 对象对应的用户 id 字段
+    relation_user_field = 'author_id'
+
+    def get_relation_user_id(self, instance):
+        return getattr(instance, self.relation_user_field)
+
+    def get_user_relation(self, instance, name, fallback):
+        relations = self.context.get('viewer_relations')
+        user_id = self.get_relation_user_id(instance)
+        if relations is None or not relations.covers(user_id):
+            return fallback()
+        return user_id in getattr(relations, name)()
+
+    def get_object_mark(self, instance, subject, fallback):
+        relations = self.context.get('viewer_relations')
+        if relations is None or instance.pk not in relations.object_ids:
+            return fallback()
+        return instance.pk in relations.get_marked_object_ids(type(instance), subject)
+
+    def get_author_is_following(self, obj):
+        return self.get_user_relation(obj, 'get_following_ids',
+                                      lambda: obj.author.member.is_followed_by_current_user())
+
+
 class UserVotableMixinSerializer(serializers.Serializer):
     count_upvote = serializers.ReadOnlyField()
     count_downvote = serializers.ReadOnlyField()
@@ -168,6 +214,18 @@ class OptionSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
+class RecurringJobSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = m.RecurringJob
+        fields = '__all__'
+
+
+class DailyStatisticSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+    class Meta:
+        model = m.DailyStatistic
+        fields = '__all__'
+
+
 class AudioSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = m.AudioModel
@@ -419,10 +477,28 @@ class MessageSerializer(AllowNestedWriteMixin,
         required=False,
     )
 
+    is_read = serializers.SerializerMethodField()
+
     class Meta:
         model = m.Message
         fields = '__all__'
 
+    def get_is_read(self, obj):
+        """ 由当前用户会话的已读水位得出，列表中的消息一次判断 """
+        request = self.context.get('request')
+        if not request or request.user.is_anonymous:
+            return obj.is_read
+        cache = self.context.setdefault('read_message_ids', dict())
+        if obj.id not in cache:
+            messages = []
+            if isinstance(self.parent, serializers.ListSerializer) and self.parent.instance is not None:
+                messages = list(self.parent.instance)
+            if obj.id not in {message.id for message in messages}:
+                messages = [obj]
+            read_ids = m.Conversation.get_read_message_ids(request.user, messages)
+            cache.update({message.id: message.id in read_ids for message in messages})
+        return cache[obj.id]
+
 
 class PaymentRecordSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     # payment_url = serializers.ReadOnlyField(source='get_payment_url')
@@ -473,7 +549,7 @@ class InfomableSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
-class MemberSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+class MemberSerializer(ViewerRelationsMixin, QueryFieldsMixin, serializers.ModelSerializer):
     user = serializers.PrimaryKeyRelatedField(queryset=m.User.objects.all(), )
     avatar_url = serializers.ReadOnlyField(source='avatar.image.url', )
     avatar_item = ImageSerializer(source='avatar', read_only=True)
@@ -483,7 +559,7 @@ class MemberSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     count_friend = serializers.ReadOnlyField(source='get_friend_count')
     count_live = serializers.ReadOnlyField(source='get_live_count')
     last_live_end = serializers.ReadOnlyField(source='get_last_live_end')
-    is_following = serializers.BooleanField(source='is_followed_by_current_user', read_only=True)
+    is_following = serializers.SerializerMethodField()
 
     # following_start_date = serializers.ReadOnlyField(source='get_following_start_date')
     # age = serializers.ReadOnlyField(source='get_age')
@@ -504,22 +580,48 @@ class MemberSerializer(QueryFieldsMixin, serializers.ModelSerializer):
 
     is_living = serializers.ReadOnlyField()
 
-    contact_form_me = serializers.BooleanField(read_only=True)
+    contact_form_me = serializers.SerializerMethodField()
 
-    contact_to_me = serializers.BooleanField(read_only=True)
+    contact_to_me = serializers.SerializerMethodField()
 
     first_live_date = serializers.ReadOnlyField(source='get_first_live_date')
 
     username = serializers.ReadOnlyField(source='user.username')
 
-    is_not_disturb = serializers.ReadOnlyField()
+    is_not_disturb = serializers.SerializerMethodField()
 
-    is_blacklist = serializers.ReadOnlyField()
+    is_blacklist = serializers.SerializerMethodField()
+
+    relation_user_field = 'user_id'
 
     class Meta:
         model = m.Member
         # fields = '__all__'
         exclude = ['session_key', 'tencent_sig', 'tencent_sig_expire']
+        list_serializer_class = ViewerRelationsListSerializer
+        # 余额字段读取 Member.get_wallet()，列表中随会员一并查询钱包
+        select_related_hints = dict(
+            diamond_balance='user__wallet',
+            coin_balance='user__wallet',
+            star_balance='user__wallet',
+            star_index_sender_balance='user__wallet',
+            star_index_receiver_balance='user__wallet',
+        )
+
+    def get_is_following(self, obj):
+        return self.get_user_relation(obj, 'get_following_ids', obj.is_followed_by_current_user)
+
+    def get_contact_form_me(self, obj):
+        return self.get_user_relation(obj, 'get_contact_ids', obj.contact_form_me)
+
+    def get_contact_to_me(self, obj):
+        return self.get_user_relation(obj, 'get_contact_me_ids', obj.contact_to_me)
+
+    def get_is_not_disturb(self, obj):
+        return self.get_user_relation(obj, 'get_not_disturb_ids', obj.is_not_disturb)
+
+    def get_is_blacklist(self, obj):
+        return self.get_user_relation(obj, 'get_blacklist_ids', obj.is_blacklist)
 
 
 class RobotSerializer(QueryFieldsMixin, serializers.ModelSerializer):
@@ -743,7 +845,7 @@ class LiveCategorySerializer(QueryFieldsMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
-class LiveSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+class LiveSerializer(ViewerRelationsMixin, QueryFieldsMixin, serializers.ModelSerializer):
     category = serializers.ReadOnlyField(source='category.name')
     author_id = serializers.ReadOnlyField(source='author.id')
     nickname = serializers.ReadOnlyField(source='author.member.nickname')
@@ -753,10 +855,7 @@ class LiveSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     constellation = serializers.ReadOnlyField(source='author.member.constellation')
     signature = serializers.ReadOnlyField(source='author.member.signature')
     age = serializers.ReadOnlyField(source='author.member.age')
-    author_is_following = serializers.ReadOnlyField(
-        source='author.member.is_followed_by_current_user',
-        read_only=True,
-    )
+    author_is_following = serializers.SerializerMethodField()
 
     count_comment = serializers.ReadOnlyField(source='get_comment_count')
     count_view = serializers.ReadOnlyField(source='get_view_count')
@@ -776,10 +875,7 @@ class LiveSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     duration = serializers.ReadOnlyField(source='get_duration')
     live_status = serializers.ReadOnlyField(source='get_live_status')
 
-    is_following = serializers.BooleanField(
-        source='is_followed_by_current_user',
-        read_only=True,
-    )
+    is_following = serializers.SerializerMethodField()
 
     push_url = serializers.ReadOnlyField(source='get_push_url')
     play_url = serializers.ReadOnlyField(source='get_play_url')
@@ -791,6 +887,10 @@ class LiveSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = m.Live
         exclude = ['comments', 'informs']
+        list_serializer_class = ViewerRelationsListSerializer
+
+    def get_is_following(self, obj):
+        return self.get_object_mark(obj, 'follow', obj.is_followed_by_current_user)
 
 
 class LiveBarrageSerializer(QueryFieldsMixin, serializers.ModelSerializer):
@@ -879,7 +979,7 @@ class LiveWatchLogSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
-class ActiveEventSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+class ActiveEventSerializer(ViewerRelationsMixin, QueryFieldsMixin, serializers.ModelSerializer):
     images_item = ImageSerializer(
         source='images',
         many=True,
@@ -923,13 +1023,9 @@ class ActiveEventSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         source='author.member.constellation',
     )
 
-    author_is_following = serializers.ReadOnlyField(
-        source='author.member.is_followed_by_current_user',
-    )
+    author_is_following = serializers.SerializerMethodField()
 
-    is_like = serializers.ReadOnlyField(
-        source='is_liked_by_current_user'
-    )
+    is_like = serializers.SerializerMethodField()
 
     author_level = serializers.ReadOnlyField(
         source='author.member.get_level'
@@ -946,6 +1042,10 @@ class ActiveEventSerializer(QueryFieldsMixin, serializers.ModelSerializer):
     class Meta:
         model = m.ActiveEvent
         fields = '__all__'
+        list_serializer_class = ViewerRelationsListSerializer
+
+    def get_is_like(self, obj):
+        return self.get_object_mark(obj, 'like', obj.is_liked_by_current_user)
 
 
 class PrizeCategorySerializer(QueryFieldsMixin, serializers.ModelSerializer):
@@ -1306,7 +1406,7 @@ class CommentSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
-class UserMarkSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+class UserMarkSerializer(ViewerRelationsMixin, QueryFieldsMixin, serializers.ModelSerializer):
     author_avatar = serializers.ReadOnlyField(
         source='author.member.avatar.image.url',
     )
@@ -1319,11 +1419,15 @@ class UserMarkSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         source='get_activeevent_img'
     )
 
-    is_following = serializers.BooleanField(source='author.member.is_followed_by_current_user', read_only=True)
+    is_following = serializers.SerializerMethodField()
 
     class Meta:
         model = m.UserMark
         fields = '__all__'
+        list_serializer_class = ViewerRelationsListSerializer
+
+    def get_is_following(self, obj):
+        return self.get_author_is_following(obj)
 
 
 class ContactSerializer(QueryFieldsMixin, serializers.ModelSerializer):
@@ -1332,7 +1436,7 @@ class ContactSerializer(QueryFieldsMixin, serializers.ModelSerializer):
         fields = '__all__'
 
 
-class RankRecordSerializer(QueryFieldsMixin, serializers.ModelSerializer):
+class RankRecordSerializer(ViewerRelationsMixin, QueryFieldsMixin, serializers.ModelSerializer):
     author_nickname = serializers.ReadOnlyField(source='author.member.nickname')
 
     author_mobile = serializers.ReadOnlyField(source='author.member.mobile')
@@ -1351,11 +1455,15 @@ class RankRecordSerializer(QueryFieldsMixin, serializers.ModelSerializer):
 
     author_avatar = serializers.ReadOnlyField(source='author.member.avatar.image.url')
 
-    is_following = serializers.BooleanField(source='author.member.is_followed_by_current_user', read_only=True)
+    is_following = serializers.SerializerMethodField()
 
     class Meta:
         model = m.RankRecord
         fields = '__all__'
+        list_serializer_class = ViewerRelationsListSerializer
+
+    def get_is_following(self, obj):
+        return self.get_author_is_following(obj)
 
 
 class AdminLogSerializer(QueryFieldsMixin, serializers.ModelSerializer):
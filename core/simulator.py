@@ -0,0 +1,292 @@
+""" 直播间流量模拟
+
+用机器人账号模拟一群观众进入本地的直播间，按泊松过程随机地心跳、发弹幕、送礼、追踪主播和换房间，
+记录每个接口的吞吐量、延迟分位数和错误率，用于在真实的大主播开播之前找出
+在线人数、送礼和弹幕链路在多大的房间规模下开始变慢或出错。
+
+请求通过 django.test.Client 在当前进程内发出，经过完整的中间件和视图，
+在线人数（presence）与模拟器共享同一个进程内的状态；会写入当前配置的数据库，只应在本地或测试环境中运行。
+
+各行为的频率（每个机器人每分钟的次数）默认取 RATES，可以在 robot_rules 选项中按同名键覆盖，例如：
+    {"heartbeat": 1, "barrage": 2, "gift": 0.5, "follow": 0.05, "switch": 0.1}
+"""
+import random
+from bisect import bisect
+from heapq import heappop, heappush
+from itertools import accumulate
+from threading import Condition, Lock, Thread
+from time import time
+
+from django.db import connection
+from django.test import Client
+
+from . import models as m
+from .benchmark import percentile
+
+USERNAME_PREFIX = 'robot_'
+
+# 每个机器人每分钟的行为次数
+RATES = dict(
+    # 观看心跳，客户端每分钟一次
+    heartbeat=1,
+    # 发送弹幕
+    barrage=2,
+    # 送礼
+    gift=0.5,
+    # 追踪主播
+    follow=0.05,
+    # 离开当前直播间并进入另一个
+    switch=0.1,
+)
+
+# 机器人金币低于该值时在模拟开始前补足
+COIN_RESERVE = 100000
+
+
+def weighted_choice(rng, items, weights):
+    cumulative = list(accumulate(weights))
+    return items[bisect(cumulative, rng.random() * cumulative[-1])]
+
+
+def get_rates(overrides=None):
+    """ 行为频率，依次以 robot_rules 选项和 overrides 覆盖默认值 """
+    rates = dict(RATES)
+    rules = m.Option.get_json('robot_rules', dict())
+    if isinstance(rules, dict):
+        rates.update({key: float(value) for key, value in rules.items() if key in RATES})
+    rates.update(overrides or dict())
+    return rates
+
+
+def prepare_robots(count):
+    """ 准备 count 个机器人账号，不足时创建，金币不足时补足
+    :return: 用户列表
+    """
+    users = list(m.User.objects.filter(robot__isnull=False).order_by('id')[:count])
+    missing = count - len(users)
+    if missing > 0:
+        start = m.User.objects.filter(username__startswith=USERNAME_PREFIX).count()
+        names = ['{}{:06d}'.format(USERNAME_PREFIX, start + i) for i in range(missing)]
+        # bulk_create 绕过 Member、Robot save() 中的后台日志和腾讯云通讯调用
+        m.User.objects.bulk_create([m.User(username=name) for name in names])
+        created = list(m.User.objects.filter(username__in=names).order_by('id'))
+        m.Member.objects.bulk_create([
+            m.Member(user=user, nickname='機器人{}'.format(user.id), mobile=user.username)
+            for user in created
+        ])
+        m.Robot.objects.bulk_create([m.Robot(user=user) for user in created])
+        users += created
+    for user in users:
+        coin = m.Wallet.get(user).coin
+        if coin < COIN_RESERVE:
+            m.CreditCoinTransaction.objects.create(
+                user_debit=user,
+                amount=COIN_RESERVE - coin,
+                type=m.CreditCoinTransaction.TYPE_ADMIN,
+                remark='流量模拟补充金币',
+            )
+    return users
+
+
+class EndpointStats:
+    """ 单个接口的请求统计 """
+
+    def __init__(self):
+        self.latencies = []
+        self.errors = dict()
+
+    def record(self, milliseconds, error=None):
+        self.latencies.append(milliseconds)
+        if error:
+            self.errors[error] = self.errors.get(error, 0) + 1
+
+    def as_dict(self, seconds):
+        latencies = sorted(self.latencies)
+        count = len(latencies)
+        errors = sum(self.errors.values())
+        return dict(
+            count=count,
+            errors=errors,
+            error_rate=round(errors / count, 4) if count else 0,
+            throughput=round(count / seconds, 2) if seconds else 0,
+            p50=round(percentile(latencies, 0.5), 2),
+            p95=round(percentile(latencies, 0.95), 2),
+            p99=round(percentile(latencies, 0.99), 2),
+            max=round(latencies[-1], 2) if latencies else 0,
+            error_samples=sorted(self.errors.items(), key=lambda item: -item[1])[:5],
+        )
+
+
+class RobotViewer:
+    """ 一个机器人观众，同一时间只由一个工作线程驱动 """
+
+    def __init__(self, swarm, user, rng):
+        self.swarm = swarm
+        self.user = user
+        self.random = rng
+        self.client = Client()
+        self.client.force_login(user)
+        self.live = None
+
+    def next_delay(self):
+        """ 距下一个行为的秒数，各行为合并为一个泊松过程 """
+        return self.random.expovariate(self.swarm.total_rate / 60)
+
+    def request(self, name, path, data=None):
+        time_start = time()
+        error = None
+        try:
+            response = self.client.post(path, data or dict())
+            if response.status_code >= 400:
+                error = 'HTTP {}'.format(response.status_code)
+        except Exception as ex:
+            error = '{}: {}'.format(type(ex).__name__, ex)
+        self.swarm.record(name, time_start, (time() - time_start) * 1000, error)
+        return error is None
+
+    def enter(self):
+        self.live = self.swarm.choose_live(self.random)
+        if not self.request('enter', '/api/live_watch_log/start_watch_log/', dict(live=self.live.id)):
+            self.live = None
+
+    def leave(self):
+        self.request('leave', '/api/live_watch_log/leave_live/', dict(live=self.live.id))
+        self.live = None
+
+    def step(self):
+        if self.live is None:
+            return self.enter()
+        action = self.swarm.choose_action(self.random)
+        if action == 'heartbeat':
+            self.request('heartbeat', '/api/live_watch_log/viewer_log_response/', dict(live=self.live.id))
+        elif action == 'barrage':
+            self.request('barrage', '/api/live/{}/make_barrage/'.format(self.live.id), dict(content='666'))
+        elif action == 'gift':
+            self.request('gift', '/api/live/{}/buy_prize/'.format(self.live.id), dict(
+                prize=self.swarm.prize.id,
+                count=self.random.randint(1, 10),
+            ))
+        elif action == 'follow':
+            self.request('follow', '/api/member/{}/follow/'.format(self.live.author_id), dict(is_follow='1'))
+        elif action == 'switch':
+            self.leave()
+            self.enter()
+
+
+class RobotSwarm:
+    """ 机器人观众群
+    所有机器人的下一次行为按时间放在一个堆中，由 workers 个工作线程依次取出执行，
+    机器人数量可以远多于数据库连接数
+    """
+
+    def __init__(self, users, lives, prize, rates=None, skew=1.0, seed=0):
+        """
+        :param users: 机器人用户
+        :param lives: 目标直播间，靠前的直播间分到更多观众
+        :param prize: 送出的礼物
+        :param rates: 每分钟的行为次数，见 RATES
+        :param skew: 直播间热度的倾斜程度，第 i 个直播间的权重为 1 / i ** skew，0 为平均分配
+        :param seed: 随机种子
+        """
+        assert users, '沒有可用的機器人'
+        assert lives, '沒有可用的直播間'
+        self.lives = lives
+        self.prize = prize
+        self.rates = {key: value for key, value in (rates or get_rates()).items() if value > 0}
+        self.actions = sorted(self.rates.keys())
+        self.total_rate = sum(self.rates.values())
+        assert self.total_rate > 0, '機器人行爲頻率不能全部爲 0'
+        self.live_weights = [1 / (i + 1) ** skew for i in range(len(lives))]
+        rng = random.Random(seed)
+        self.robots = [RobotViewer(self, user, random.Random(rng.random())) for user in users]
+        self.stats = dict()
+        self.lock = Lock()
+        self.condition = Condition()
+        self.heap = []
+        # 已从堆中取出、正在执行的机器人数
+        self.running = 0
+        self.deadline = None
+        # 统计窗口（开始到截止）的秒数，吞吐量按此计算
+        self.seconds = 0
+        # 包括截止后机器人离开直播间的总耗时
+        self.total_seconds = 0
+
+    def choose_live(self, rng):
+        return weighted_choice(rng, self.lives, self.live_weights)
+
+    def choose_action(self, rng):
+        return weighted_choice(rng, self.actions, [self.rates[action] for action in self.actions])
+
+    def record(self, name, time_start, milliseconds, error=None):
+        """ 记录一次请求，截止之后才发出的请求（离开直播间）不计入统计窗口 """
+        if self.deadline and time_start >= self.deadline:
+            return
+        with self.lock:
+            if name not in self.stats:
+                self.stats[name] = EndpointStats()
+            self.stats[name].record(milliseconds, error)
+
+    def work(self, deadline):
+        try:
+            while True:
+                with self.condition:
+                    while True:
+                        if not self.heap:
+                            if not self.running:
+                                return
+                            # 其他线程执行完后会把机器人放回堆中
+                            self.condition.wait()
+                            continue
+                        date_next, index = self.heap[0]
+                        now = time()
+                        # 截止之后不再等待各机器人的下一次行为，立即取出
+                        if date_next <= now or now >= deadline:
+                            heappop(self.heap)
+                            self.running += 1
+                            break
+                        self.condition.wait(min(date_next, deadline) - now)
+                robot = self.robots[index]
+                is_over = date_next > deadline or time() >= deadline
+                if is_over:
+                    # 模拟结束，离开直播间后不再排队
+                    robot.live and robot.leave()
+                else:
+                    robot.step()
+                with self.condition:
+                    self.running -= 1
+                    if not is_over:
+                        heappush(self.heap, (time() + robot.next_delay(), index))
+                    self.condition.notify_all()
+        finally:
+            connection.close()
+
+    def run(self, duration, workers=20, ramp=0):
+        """ 运行模拟
+        :param duration: 持续秒数
+        :param workers: 工作线程数
+        :param ramp: 机器人在开始后的 ramp 秒内陆续进入
+        :return: 报告
+        """
+        time_start = time()
+        for i, robot in enumerate(self.robots):
+            self.heap.append((time_start + ramp * i / len(self.robots), i))
+        self.heap.sort()
+        deadline = self.deadline = time_start + duration
+        threads = [Thread(target=self.work, args=(deadline,)) for i in range(workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.seconds = duration
+        self.total_seconds = time() - time_start
+        return self.report()
+
+    def report(self):
+        return dict(
+            robots=len(self.robots),
+            lives=[live.id for live in self.lives],
+            rates=self.rates,
+            seconds=round(self.seconds, 2),
+            total_seconds=round(self.total_seconds, 2),
+            endpoints={name: stats.as_dict(self.seconds) for name, stats in sorted(self.stats.items())},
+        )
@@ -1,4 +1,11 @@
-from django.test import TestCase
+import json
+from datetime import datetime, timedelta
+from threading import Thread
+from time import time
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, skipUnlessDBFeature
+from django_base.testing import QueryBudgetMixin
 from core.models import *
 
 
@@ -38,4 +45,935 @@ class MemberTests(TestCase):
             'get_objects_marked_by 返回结果不正确'
         )
 
+    def test_002_follow_graph(self):
+        amy = User.objects.get(username='amy')
+        bob = User.objects.get(username='bob')
+        amy.member.set_followed_by(bob)
+        amy.member.set_followed_by(bob)
+        self.assertTrue(amy.member.is_followed_by(bob))
+        self.assertEqual(Member.objects.get(user=amy).followed_count, 1)
+        self.assertEqual(Member.objects.get(user=bob).follow_count, 1)
+        self.assertEqual(Follow.get_following_ids(bob, [amy.id, bob.id]), {amy.id})
+        self.assertEqual(list(bob.member.get_follow()), [amy.member])
+        amy.member.set_followed_by(bob, False)
+        Follow.rebuild_counts()
+        self.assertEqual(Member.objects.get(user=amy).followed_count, 0)
+
+    def test_003_viewer_relations(self):
+        from core.relations import ViewerRelations
+        amy = User.objects.get(username='amy')
+        bob = User.objects.get(username='bob')
+        amy.member.set_followed_by(bob)
+        Contact.objects.create(author=bob, user=amy, type=Contact.TYPE_OPEN)
+        relations = ViewerRelations(bob, [amy.id, bob.id])
+        with self.assertNumQueries(2):
+            self.assertEqual(relations.get_following_ids(), {amy.id})
+            self.assertEqual(relations.get_contact_ids(), {amy.id})
+            self.assertEqual(relations.get_following_ids(), {amy.id})
+        self.assertFalse(relations.covers(0))
+
+
+class WalletTests(TestCase):
+    def setUp(self):
+        self.amy = User.objects.create(username='amy')
+        self.bob = User.objects.create(username='bob')
+
+    def test_001_wallet_follows_ledger(self):
+        CreditCoinTransaction.objects.create(
+            user_debit=self.amy,
+            amount=100,
+            type=CreditCoinTransaction.TYPE_ADMIN,
+        )
+        transaction = CreditCoinTransaction.objects.create(
+            user_debit=self.bob,
+            user_credit=self.amy,
+            amount=30,
+            type=CreditCoinTransaction.TYPE_LIVE_GIFT,
+        )
+        self.assertEqual(Wallet.get(self.amy).coin, 70)
+        self.assertEqual(Wallet.get(self.bob).coin, 30)
+        transaction.amount = 40
+        transaction.save()
+        self.assertEqual(Wallet.get(self.amy).coin, 60)
+        transaction.delete()
+        self.assertEqual(Wallet.get(self.amy).coin, 100)
+        self.assertEqual(Wallet.get(self.bob).coin, 0)
+        self.assertEqual(Wallet.get(self.amy).reconcile(), {})
+
+    def test_002_wallet_initialized_from_ledger(self):
+        CreditDiamondTransaction.objects.create(
+            user_debit=self.amy,
+            amount=50,
+            type=CreditDiamondTransaction.TYPE_ADMIN,
+        )
+        Wallet.objects.filter(user=self.amy).delete()
+        self.assertEqual(Wallet.get(self.amy).diamond, 50)
+
+    def test_003_queryset_keeps_wallet_in_sync(self):
+        Wallet.get(self.amy)
+        Wallet.get(self.bob)
+        CreditCoinTransaction.objects.bulk_create([
+            CreditCoinTransaction(user_debit=self.amy, amount=100, type=CreditCoinTransaction.TYPE_ADMIN),
+            CreditCoinTransaction(user_debit=self.bob, user_credit=self.amy, amount=30,
+                                  type=CreditCoinTransaction.TYPE_LIVE_GIFT),
+        ])
+        self.assertEqual((Wallet.get(self.amy).coin, Wallet.get(self.bob).coin), (70, 30))
+        CreditCoinTransaction.objects.filter(type=CreditCoinTransaction.TYPE_LIVE_GIFT).update(amount=40)
+        self.assertEqual((Wallet.get(self.amy).coin, Wallet.get(self.bob).coin), (60, 40))
+        CreditCoinTransaction.objects.filter(user_credit=self.amy).delete()
+        self.assertEqual((Wallet.get(self.amy).coin, Wallet.get(self.bob).coin), (100, 0))
+        self.assertEqual(Wallet.get(self.amy).reconcile(), {})
+        self.assertEqual(Wallet.get(self.bob).reconcile(), {})
+
+    def test_004_member_balances_read_wallet_once(self):
+        CreditCoinTransaction.objects.create(user_debit=self.amy, amount=100, type=CreditCoinTransaction.TYPE_ADMIN)
+        Member.objects.bulk_create([Member(user=self.amy, mobile='13533808431')])
+        member = Member.objects.select_related('user__wallet').get(user=self.amy)
+        with self.assertNumQueries(0):
+            self.assertEqual(member.get_coin_balance(), 100)
+            self.assertEqual(member.get_diamond_balance(), 0)
+            self.assertEqual(member.get_star_balance(), 0)
+
+
+class PrizeOrderConcurrencyTests(TransactionTestCase):
+    def setUp(self):
+        self.anchor = User.objects.create(username='anchor')
+        self.viewer = User.objects.create(username='viewer')
+        # bulk_create 绕过 save() 中的 AdminLog 和 WebIM 调用
+        Member.objects.bulk_create([
+            Member(user=self.anchor, mobile='13533808431'),
+            Member(user=self.viewer, mobile='13533808430'),
+        ])
+        Live.objects.bulk_create([Live(author=self.anchor, name='live')])
+        self.live = Live.objects.get(author=self.anchor)
+        LiveWatchLog.objects.bulk_create([LiveWatchLog(author=self.viewer, live=self.live)])
+        Prize.objects.bulk_create([Prize(name='prize', price=10, price_type=Prize.PRICE_TYPE_COIN)])
+        self.prize = Prize.objects.get(name='prize')
+        CreditCoinTransaction.objects.create(
+            user_debit=self.viewer,
+            amount=50,
+            type=CreditCoinTransaction.TYPE_ADMIN,
+        )
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_001_parallel_buy_prize(self):
+        results = []
+
+        def send():
+            try:
+                PrizeOrder.buy_prize(self.live, self.prize, 1, self.viewer)
+                results.append(True)
+            except AssertionError:
+                results.append(False)
+            finally:
+                connection.close()
+
+        threads = [Thread(target=send) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # 余额只够送 5 次，其余请求在锁内校验余额时失败
+        self.assertEqual(results.count(True), 5)
+        self.assertEqual(PrizeOrder.objects.count(), 5)
+        self.assertEqual(Wallet.get(self.viewer).coin, 0)
+        self.assertEqual(Wallet.get(self.anchor).diamond, 50)
+        self.assertEqual(Wallet.get(self.viewer).reconcile(), {})
+        self.assertEqual(Wallet.get(self.anchor).reconcile(), {})
+
+    def test_002_overspend_guard(self):
+        for i in range(5):
+            PrizeOrder.buy_prize(self.live, self.prize, 1, self.viewer)
+        with self.assertRaises(AssertionError):
+            PrizeOrder.buy_prize(self.live, self.prize, 1, self.viewer)
+        self.assertEqual(PrizeOrder.objects.count(), 5)
+        self.assertEqual(Wallet.get(self.viewer).coin, 0)
+        self.assertEqual(Wallet.get(self.anchor).diamond, 50)
+
+    def test_003_balance_checked_after_lock(self):
+        lock = Wallet.lock
+
+        def spend_then_lock(user, *others):
+            # 模拟另一请求在本请求等待锁期间先完成扣费，余额须在取得锁之后读取才能发现不足
+            CreditCoinTransaction.objects.create(
+                user_credit=self.viewer,
+                amount=45,
+                type=CreditCoinTransaction.TYPE_LIVE_GIFT,
+            )
+            return lock(user, *others)
+
+        with mock.patch.object(Wallet, 'lock', side_effect=spend_then_lock) as patched:
+            with self.assertRaises(AssertionError):
+                PrizeOrder.buy_prize(self.live, self.prize, 1, self.viewer)
+        patched.assert_called_once_with(self.viewer, self.anchor)
+        # 模拟的扣费与送礼在同一事务中一并回滚
+        self.assertEqual(PrizeOrder.objects.count(), 0)
+        self.assertEqual(Wallet.get(self.viewer).coin, 50)
+        self.assertEqual(Wallet.get(self.anchor).diamond, 0)
+
+    def test_004_lock_in_user_order(self):
+        from django.test.utils import CaptureQueriesContext
+        for users in ((self.viewer, self.anchor), (self.anchor, self.viewer)):
+            with CaptureQueriesContext(connection) as context:
+                wallet = Wallet.lock(*users)
+            self.assertEqual(wallet.user_id, users[0].pk)
+            sql = context.captured_queries[-1]['sql']
+            self.assertIn('ORDER BY', sql)
+            self.assertIn('user_id', sql[sql.index('ORDER BY'):])
+
+
+class BuyPrizeBatchTests(TransactionTestCase):
+    def setUp(self):
+        self.anchor = User.objects.create(username='anchor')
+        self.viewer = User.objects.create(username='viewer')
+        Member.objects.bulk_create([
+            Member(user=self.anchor, mobile='13533808431'),
+            Member(user=self.viewer, mobile='13533808430'),
+        ])
+        Live.objects.bulk_create([Live(author=self.anchor, name='live')])
+        self.live = Live.objects.get(author=self.anchor)
+        LiveWatchLog.objects.bulk_create([LiveWatchLog(author=self.viewer, live=self.live)])
+        Prize.objects.bulk_create([
+            Prize(name='coin', price=10, price_type=Prize.PRICE_TYPE_COIN),
+            Prize(name='star', price=10, price_type=Prize.PRICE_TYPE_STAR),
+        ])
+        self.coin_prize = Prize.objects.get(name='coin')
+        self.star_prize = Prize.objects.get(name='star')
+        CreditCoinTransaction.objects.create(user_debit=self.viewer, amount=50, type=CreditCoinTransaction.TYPE_ADMIN)
+
+    def test_001_merge_repeated_prizes(self):
+        orders = PrizeOrder.buy_prize_batch(self.live, [(self.coin_prize, 2), (self.coin_prize, 3)], self.viewer)
+        self.assertEqual(len(orders), 1)
+        self.assertEqual(orders[0].sender_prize_transaction.amount, 5)
+        self.assertEqual(Wallet.get(self.viewer).coin, 0)
+        self.assertEqual(Wallet.get(self.anchor).diamond, 50)
+
+    def test_002_insufficient_balance_rolls_back(self):
+        for items in ([(self.coin_prize, 2), (self.star_prize, 1)], [(self.coin_prize, 6)]):
+            with self.assertRaises(AssertionError):
+                PrizeOrder.buy_prize_batch(self.live, items, self.viewer)
+        self.assertFalse(PrizeOrder.objects.exists())
+        self.assertFalse(PrizeTransaction.objects.exists())
+        self.assertEqual(Wallet.get(self.viewer).coin, 50)
+        self.assertEqual(Wallet.get(self.viewer).reconcile(), {})
+
+    def test_003_experience_settled_once(self):
+        from unittest import mock
+        with mock.patch.object(PrizeOrder, 'settle_prize_experience') as settle:
+            PrizeOrder.buy_prize_batch(self.live, [(self.coin_prize, 1), (self.coin_prize, 2)], self.viewer)
+        settle.assert_called_once_with(self.viewer, self.anchor, 30)
+
+    def test_004_mixed_coin_and_star(self):
+        CreditStarTransaction.objects.create(user_debit=self.viewer, amount=30, type=CreditStarTransaction.TYPE_ADMIN)
+        orders = PrizeOrder.buy_prize_batch(self.live, [(self.coin_prize, 2), (self.star_prize, 1)], self.viewer)
+        self.assertEqual(len(orders), 2)
+        wallet = Wallet.get(self.viewer)
+        self.assertEqual((wallet.coin, wallet.star), (30, 20))
+        self.assertEqual(Wallet.get(self.anchor).diamond, 20)
+        self.assertEqual(wallet.reconcile(), {})
+
+    def test_005_reject_incomplete_items(self):
+        self.client.force_login(self.viewer)
+        response = self.client.post(
+            '/api/live/{}/buy_prize_batch/'.format(self.live.id),
+            json.dumps(dict(prizes=[dict(prize=self.coin_prize.id)])),
+            content_type='application/json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json()['msg'], '請選擇要贈送的禮物和數量')
+        self.assertFalse(PrizeOrder.objects.exists())
+
+
+def legacy_rank_amounts(author, duration, now):
+    """ 旧版 RankRecord.update 的逐用户统计（不含 5 点后 15 分钟内的重置分支），用于对照 update_all """
+    am5 = datetime(now.year, now.month, now.day, 5, 0)
+    tomorrow_am5 = am5 + timedelta(days=1)
+    weekday = now.weekday()
+    monday = am5 - timedelta(days=weekday)
+    sunday = am5 + timedelta(days=7 - weekday)
+    orders = PrizeOrder.objects.all()
+    if duration == RankRecord.DURATION_DATE:
+        orders = orders.filter(date_created__gt=am5, date_created__lt=tomorrow_am5)
+    elif duration == RankRecord.DURATION_WEEK:
+        orders = orders.filter(date_created__gt=monday, date_created__lt=sunday)
+    receive = orders.filter(
+        diamond_transaction__user_debit=author,
+    ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
+    send = orders.filter(
+        author=author,
+        diamond_transaction__id__gt=0,
+    ).aggregate(amount=models.Sum('diamond_transaction__amount')).get('amount') or 0
+    if duration == RankRecord.DURATION_TOTAL:
+        credit = author.creditstarindexreceivertransactions_credit.aggregate(
+            amount=models.Sum('amount')).get('amount') or 0
+        debit = author.creditstarindexreceivertransactions_debit.aggregate(
+            amount=models.Sum('amount')).get('amount') or 0
+    else:
+        credit = orders.filter(
+            author=author,
+            sender_star_index_transaction__id__gt=0,
+        ).aggregate(amount=models.Sum('sender_star_index_transaction__amount')).get('amount') or 0
+        debit = orders.filter(
+            author=author,
+            receiver_star_index_transaction__id__gt=0,
+        ).aggregate(amount=models.Sum('receiver_star_index_transaction__amount')).get('amount') or 0
+    return receive, send, debit - credit
+
+
+class RankRecordTests(TestCase):
+    def test_001_periods(self):
+        day, week = RankRecord.DURATION_DATE, RankRecord.DURATION_WEEK
+        # 2018-03-07 为周三，2018-03-05 为周一
+        periods = RankRecord.get_periods(datetime(2018, 3, 7, 4, 59))
+        self.assertEqual(periods[day], (datetime(2018, 3, 6, 5), datetime(2018, 3, 7, 5)))
+        self.assertEqual(periods[week], (datetime(2018, 3, 5, 5), datetime(2018, 3, 12, 5)))
+        periods = RankRecord.get_periods(datetime(2018, 3, 7, 5, 0))
+        self.assertEqual(periods[day], (datetime(2018, 3, 7, 5), datetime(2018, 3, 8, 5)))
+        # 周一 5 点前仍属于上一周
+        periods = RankRecord.get_periods(datetime(2018, 3, 5, 4, 0))
+        self.assertEqual(periods[day], (datetime(2018, 3, 4, 5), datetime(2018, 3, 5, 5)))
+        self.assertEqual(periods[week], (datetime(2018, 2, 26, 5), datetime(2018, 3, 5, 5)))
+        periods = RankRecord.get_periods(datetime(2018, 3, 5, 5, 30))
+        self.assertEqual(periods[week], (datetime(2018, 3, 5, 5), datetime(2018, 3, 12, 5)))
+
+    def test_002_update_all_matches_legacy(self):
+        now = datetime(2018, 3, 7, 12, 0)
+        anchor, amy, bob = users = [User.objects.create(username=name) for name in ('anchor', 'amy', 'bob')]
+        Member.objects.bulk_create([Member(user=user, nickname=user.username) for user in users])
+        Live.objects.bulk_create([Live(author=anchor, name='live')])
+        live = Live.objects.get(author=anchor)
+        LiveWatchLog.objects.bulk_create([LiveWatchLog(author=user, live=live) for user in (amy, bob)])
+        Prize.objects.bulk_create([
+            Prize(name='coin', price=10, price_type=Prize.PRICE_TYPE_COIN),
+            Prize(name='star', price=7, price_type=Prize.PRICE_TYPE_STAR),
+        ])
+        coin_prize = Prize.objects.get(name='coin')
+        star_prize = Prize.objects.get(name='star')
+        for user in (amy, bob):
+            CreditCoinTransaction.objects.create(user_debit=user, amount=1000, type=CreditCoinTransaction.TYPE_ADMIN)
+            CreditStarTransaction.objects.create(user_debit=user, amount=1000, type=CreditStarTransaction.TYPE_ADMIN)
+        for user, prize, count, date_created in (
+                (amy, coin_prize, 2, datetime(2018, 3, 7, 10)),
+                (bob, coin_prize, 3, datetime(2018, 3, 6, 20)),
+                (amy, star_prize, 1, datetime(2018, 2, 28, 9)),
+                (bob, star_prize, 2, datetime(2018, 3, 7, 4)),
+                (bob, coin_prize, 1, datetime(2018, 3, 7, 6)),
+        ):
+            order = PrizeOrder.buy_prize(live, prize, count, user)
+            PrizeOrder.objects.filter(pk=order.pk).update(date_created=date_created)
+        # 已有记录走分组更新，缺少的记录批量创建
+        RankRecord.make(amy.member)
+        RankRecord.update_all(now=now)
+        for user in users:
+            for duration, duration_name in RankRecord.DURATION_CHOICES:
+                record = RankRecord.objects.get(author=user, duration=duration)
+                self.assertEqual(
+                    (record.receive_diamond_amount, record.send_diamond_amount, record.star_index_amount),
+                    legacy_rank_amounts(user, duration, now),
+                    '{} {} 的排行榜数值不一致'.format(user.username, duration_name),
+                )
+        self.assertEqual(RankRecord.update_all(now=now), dict(created=0, updated=0))
+
+
+def legacy_level(rules, total_experience, large_level=None, small_level=None, current_level_exp=None):
+    """ 旧版 Member.update_level 的等级换算，逐个分支照搬，用于对照 LevelCurve
+    没有命中任何分支时保留传入的原等级
+    """
+    level1 = rules.get('level_1')[0].get('value') * 20
+    level2 = rules.get('level_1')[1].get('value') * 20 + level1
+    level3 = rules.get('level_1')[2].get('value') * 20 + level2
+    level4 = rules.get('level_1')[3].get('value') * 20 + level3
+    level5 = rules.get('level_1')[4].get('value') * 19 + level4
+    level6 = rules.get('level_more')[0].get('value') * 99 + level5
+    level7 = rules.get('level_more')[1].get('value') * 99 + level6
+    level8 = rules.get('level_more')[2].get('value') * 99 + level7
+    level9 = rules.get('level_more')[3].get('value') * 99 + level8
+    total_exp_list = [0, level1, level2, level3, level4, level5, level6, level7, level8, level9]
+    for i in range(0, 9):
+        if total_exp_list[i] <= total_experience < total_exp_list[i + 1]:
+            if i == 0:
+                large_level = 1
+                small_level = 1 + int(total_experience / rules.get('level_1')[0].get('value'))
+                current_level_exp = total_experience % rules.get('level_1')[0].get('value')
+            if i == 1:
+                large_level = 1
+                small_level = 21 + int((total_experience - level1) / rules.get('level_1')[1].get('value'))
+                current_level_exp = (total_experience - level1) % rules.get('level_1')[1].get('value')
+            if i == 2:
+                large_level = 1
+                small_level = 41 + int((total_experience - level2) / rules.get('level_1')[2].get('value'))
+                current_level_exp = (total_experience - level2) % rules.get('level_1')[2].get('value')
+            if i == 3:
+                large_level = 1
+                small_level = 61 + int((total_experience - level3) / rules.get('level_1')[3].get('value'))
+                current_level_exp = (total_experience - level3) % rules.get('level_1')[3].get('value')
+            if i == 4:
+                large_level = 1
+                small_level = 81 + int((total_experience - level4) / rules.get('level_1')[4].get('value'))
+                current_level_exp = (total_experience - level4) % rules.get('level_1')[4].get('value')
+            if i == 5:
+                large_level = 2
+                small_level = 1 + int((total_experience - level5) / rules.get('level_more')[0].get('value'))
+                current_level_exp = (total_experience - level5) % rules.get('level_more')[0].get('value')
+            if i == 6:
+                large_level = 3
+                small_level = 1 + int((total_experience - level6) / rules.get('level_more')[1].get('value'))
+                current_level_exp = (total_experience - level6) % rules.get('level_more')[1].get('value')
+            if i == 6:
+                large_level = 4
+                small_level = 1 + int((total_experience - level7) / rules.get('level_more')[2].get('value'))
+                current_level_exp = (total_experience - level7) % rules.get('level_more')[2].get('value')
+            if i == 7:
+                large_level = 5
+                small_level = 1 + int((total_experience - level8) / rules.get('level_more')[3].get('value'))
+                current_level_exp = (total_experience - level8) % rules.get('level_more')[3].get('value')
+    return large_level, small_level, current_level_exp
+
+
+class LevelCurveTests(SimpleTestCase):
+    rules = dict(
+        level_1=[dict(value=value) for value in (3, 5, 7, 11, 13)],
+        level_more=[dict(value=value) for value in (17, 19, 23, 29)],
+    )
+
+    def test_001_level_curve_matches_legacy(self):
+        curve = LevelCurve(self.rules)
+        # 大等级 1、2 的旧版分支是正确的，逐点一致
+        level6 = (3 + 5 + 7 + 11) * 20 + 13 * 19 + 17 * 99
+        for total_experience in range(0, level6):
+            self.assertEqual(
+                curve.get_level(total_experience),
+                legacy_level(self.rules, total_experience),
+                '总经验 {} 的等级换算不一致'.format(total_experience),
+            )
+
+    def test_002_legacy_deviation(self):
+        """ 旧版从大等级 3 开始的分支有误：重复的 i == 6 把大等级 3 覆盖成了按大等级 4 计算的负数小等级，
+        后面的分支依次错位一级，最后一段没有分支，保持原等级；LevelCurve 按规则的本意计算 """
+        curve = LevelCurve(self.rules)
+        level6 = (3 + 5 + 7 + 11) * 20 + 13 * 19 + 17 * 99
+        level7 = level6 + 19 * 99
+        level8 = level7 + 23 * 99
+        level9 = level8 + 29 * 99
+        large_level, small_level, current_level_exp = legacy_level(self.rules, level6)
+        self.assertEqual(large_level, 4)
+        self.assertLess(small_level, 1)
+        self.assertEqual(curve.get_level(level6), (3, 1, 0))
+        self.assertEqual(curve.get_level(level6 + 19 * 5 + 2), (3, 6, 2))
+        self.assertEqual(curve.get_level(level7), (4, 1, 0))
+        self.assertEqual(curve.get_level(level8 - 1), (4, 99, 22))
+        self.assertEqual(curve.get_level(level8), (5, 1, 0))
+        self.assertEqual(curve.get_level(level9 - 1), (5, 99, 28))
+        # 超出最高等级时停留在 5-99
+        self.assertEqual(curve.get_level(level9 + 100), (5, 99, 129))
+
+
+def set_request(user=None):
+    """ Member.save 需要当前请求，测试中直接调用时设置一个 """
+    from django.contrib.auth.models import AnonymousUser
+    from django.test import RequestFactory
+    from django_base.middleware import _requests
+    from threading import currentThread
+    request = RequestFactory().get('/')
+    request.user = user or AnonymousUser()
+    _requests[currentThread()] = request
+
+
+def clear_request():
+    """ 模拟定时任务进程，当前线程没有请求 """
+    from django_base.middleware import _requests
+    from threading import currentThread
+    _requests.pop(currentThread(), None)
+
+
+class ExperienceTests(TestCase):
+    def setUp(self):
+        set_request()
+
+    def test_001_save_keeps_total_experience(self):
+        user = User.objects.create(username='exp')
+        Member.objects.create(user=user, mobile='13533808410')
+        member = Member.objects.get(user=user)
+        ExperienceTransaction.make(user, 30, ExperienceTransaction.TYPE_OTHER, is_vip_double=False)
+        # 其他请求持有的旧对象保存资料时不覆盖总经验
+        member.nickname = 'exp'
+        member.save()
+        self.assertEqual(Member.objects.get(user=user).total_experience, 30)
+
+
+class LeaderboardTests(SimpleTestCase):
+    def setUp(self):
+        from core import leaderboard
+        self.leaderboard = leaderboard
+        leaderboard.set_backend(leaderboard.MemoryBackend())
+
+    def tearDown(self):
+        self.leaderboard.set_backend(None)
+
+    def test_001_rank_and_reset(self):
+        leaderboard = self.leaderboard
+        board = leaderboard.BOARD_RECEIVE_DIAMOND
+        monday = datetime(2017, 10, 16, 12, 0)
+        leaderboard.incr(board, 1, 100, now=monday)
+        leaderboard.incr(board, 2, 300, now=monday)
+        leaderboard.incr(board, 3, 200, now=monday)
+        leaderboard.incr(board, 1, 250, now=monday)
+        self.assertEqual(
+            [(rank, user_id) for rank, user_id, score in leaderboard.top(board, 'DATE', now=monday)],
+            [(1, 1), (2, 2), (3, 3)],
+        )
+        self.assertEqual(leaderboard.rank(board, 'DATE', 3, now=monday), (3, 200))
+        # 次日 5 点前仍属于当日榜单
+        self.assertEqual(leaderboard.rank(board, 'DATE', 3, now=monday + timedelta(hours=16)), (3, 200))
+        # 次日 5 点后日榜重置，周榜和总榜保留
+        tuesday = monday + timedelta(hours=18)
+        self.assertEqual(leaderboard.rank(board, 'DATE', 3, now=tuesday), (None, 0))
+        self.assertEqual(leaderboard.rank(board, 'WEEK', 3, now=tuesday), (3, 200))
+        self.assertEqual(leaderboard.rank(board, 'TOTAL', 3, now=tuesday + timedelta(days=7)), (3, 200))
+
+    def test_002_bag_gift_star_index(self):
+        """ 揹包送禮的元氣指數流水沒有借方用戶，按送禮用戶計入 """
+        leaderboard = self.leaderboard
+        monday = datetime(2017, 10, 16, 12, 0)
+        leaderboard.record_prize_orders([
+            PrizeOrder(author_id=5, receiver_star_index_transaction=CreditStarIndexReceiverTransaction(
+                user_credit_id=5, amount=20)),
+            PrizeOrder(author_id=6, receiver_star_index_transaction=CreditStarIndexReceiverTransaction(
+                user_debit_id=6, amount=30)),
+        ], now=monday)
+        self.assertEqual(
+            [(user_id, score) for rank, user_id, score in leaderboard.top(
+                leaderboard.BOARD_STAR_INDEX, 'TOTAL', now=monday)],
+            [(6, 30), (5, 20)],
+        )
+
+    def test_003_prune_keeps_retention(self):
+        """ 换期后过去的周期在保留时间内仍可查询 """
+        leaderboard = self.leaderboard
+        board = leaderboard.BOARD_RECEIVE_DIAMOND
+        monday = datetime(2017, 10, 16, 12, 0)
+        leaderboard.incr(board, 1, 100, now=monday)
+        leaderboard.prune(now=monday + timedelta(days=2))
+        self.assertEqual(leaderboard.rank(board, 'DATE', 1, now=monday), (1, 100))
+        leaderboard.prune(now=monday + timedelta(days=5))
+        self.assertEqual(leaderboard.rank(board, 'DATE', 1, now=monday), (None, 0))
+        self.assertEqual(leaderboard.rank(board, 'WEEK', 1, now=monday), (1, 100))
+        leaderboard.prune(now=monday + timedelta(days=30))
+        self.assertEqual(leaderboard.rank(board, 'WEEK', 1, now=monday), (None, 0))
+        self.assertEqual(leaderboard.rank(board, 'TOTAL', 1, now=monday), (1, 100))
+
+
+class LivePresenceTests(SimpleTestCase):
+    def test_001_count_and_expire(self):
+        from core.presence import LivePresence
+        tracker = LivePresence(ttl=60, flush_interval=3600, sync_interval=3600, loader=lambda live_id: {
+            1: 1000.0,
+            2: 1030.0,
+        })
+        now = 1050.0
+        self.assertEqual(len(tracker.get_viewers(10, now)), 2)
+        tracker.touch(10, 1, now)
+        tracker.touch(10, 3, now)
+        tracker.expire(10, 1095.0)
+        self.assertEqual(list(tracker.viewers[10].keys()), [1, 3])
+        self.assertEqual(tracker.expired, [(10, 2)])
+        tracker.leave(10, 3)
+        self.assertEqual(len(tracker.viewers[10]), 1)
+
+
+class LivePresenceFlushTests(TestCase):
+    def test_001_flush(self):
+        from core.presence import LivePresence
+        anchor, amy, bob = [User.objects.create(username=name) for name in ('anchor', 'amy', 'bob')]
+        Live.objects.bulk_create([Live(author=anchor, name='live')])
+        live = Live.objects.get(author=anchor)
+        now = int(time())
+        LiveWatchLog.objects.bulk_create([
+            LiveWatchLog(author=user, live=live, date_enter=datetime.fromtimestamp(now - 600))
+            for user in (amy, bob)
+        ])
+        # bob 在本进程中已经超时，但正通过其他进程心跳
+        LiveWatchLog.objects.filter(author=bob).update(date_response=datetime.fromtimestamp(now - 10))
+        tracker = LivePresence(ttl=60, flush_interval=3600, sync_interval=3600, loader=lambda live_id: {
+            amy.id: now - 600,
+            bob.id: now - 600,
+        })
+        tracker.get_viewers(live.id, now)
+        tracker.touch(live.id, amy.id, now - 5)
+        tracker.pending_viewers[(live.id, amy.id)] = now - 5
+        tracker.pending_owners[live.id] = now - 3
+        tracker.flush(now)
+        self.assertEqual(tracker.count(live.id), 1)
+        # 每行写入各自的心跳时间
+        self.assertEqual(LiveWatchLog.objects.get(author=amy).date_response, datetime.fromtimestamp(now - 5))
+        self.assertEqual(Live.objects.get(pk=live.pk).date_response, datetime.fromtimestamp(now - 3))
+        bob_log = LiveWatchLog.objects.get(author=bob)
+        self.assertTrue(bob_log.is_watching())
+        self.assertEqual(bob_log.date_response, datetime.fromtimestamp(now - 10))
+
+    def test_002_owner_live_response_unknown_live(self):
+        user = User.objects.create(username='anchor')
+        self.client.force_login(user)
+        response = self.client.post('/api/live/0/owner_live_response/')
+        self.assertEqual(response.status_code, 404)
+
+
+class StaleSessionTests(TestCase):
+    def setUp(self):
+        clear_request()
+        OptionCache.clear()
+        Option.set('experience_points_watch', '10')
+        Option.set('level_rules', json.dumps(LevelCurveTests.rules))
+
+    def test_001_live_close_stale(self):
+        anchor = User.objects.create(username='anchor')
+        now = datetime.now().replace(microsecond=0)
+        Live.objects.bulk_create([Live(author=anchor, name=name) for name in ('silent', 'alive', 'ended')])
+        Live.objects.update(date_created=now - timedelta(hours=1))
+        Live.objects.filter(name='alive').update(date_response=now - timedelta(minutes=1))
+        Live.objects.filter(name='ended').update(date_end=now - timedelta(minutes=30))
+        self.assertEqual(Live.close_stale(now - timedelta(minutes=6)), 1)
+        self.assertIsNotNone(Live.objects.get(name='silent').date_end)
+        self.assertIsNone(Live.objects.get(name='alive').date_end)
+        self.assertEqual(Live.objects.get(name='ended').date_end, now - timedelta(minutes=30))
+
+    def test_002_watch_log_close_stale(self):
+        """ 观看截止到最后响应，剩余分钟数在 30 分钟以下和以上都写回，不需要当前请求 """
+        anchor, amy, bob, carol, dave = [
+            User.objects.create(username=name) for name in ('anchor', 'amy', 'bob', 'carol', 'dave')]
+        Member.objects.bulk_create([
+            Member(user=anchor, nickname='anchor'),
+            Member(user=amy, nickname='amy', watch_live_extend=10),
+            Member(user=bob, nickname='bob', watch_live_extend=20),
+            Member(user=carol, nickname='carol'),
+            Member(user=dave, nickname='dave'),
+        ])
+        Live.objects.bulk_create([Live(author=anchor, name='live')])
+        live = Live.objects.get()
+        now = datetime.now().replace(microsecond=0)
+        LiveWatchLog.objects.bulk_create([
+            LiveWatchLog(author=user, live=live, is_online=True,
+                         date_enter=now - timedelta(minutes=enter),
+                         date_response=now - timedelta(minutes=response))
+            for user, enter, response in [
+                (amy, 60, 50),
+                (bob, 60, 40),
+                (carol, 60, 1),
+                # 最后响应是上一次进入时留下的
+                (dave, 30, 120),
+            ]
+        ])
+        LiveCounter.rebuild(live)
+        self.assertEqual(LiveWatchLog.close_stale(now - timedelta(minutes=6)), 3)
+
+        logs = {log.author_id: log for log in LiveWatchLog.objects.all()}
+        self.assertEqual([(logs[user.id].is_online, logs[user.id].duration) for user in (amy, bob, dave)],
+                         [(False, 10), (False, 20), (False, 1)])
+        self.assertEqual(logs[amy.id].date_leave, now - timedelta(minutes=50))
+        self.assertEqual(logs[dave.id].date_leave, now - timedelta(minutes=30))
+        self.assertTrue(logs[carol.id].is_online)
+        self.assertEqual(LiveCounter.objects.get(live=live).viewer_count, 1)
+
+        members = {member.user_id: member for member in Member.objects.all()}
+        self.assertEqual((members[amy.id].watch_live_extend, members[amy.id].total_experience), (20, 0))
+        self.assertEqual((members[bob.id].watch_live_extend, members[bob.id].total_experience), (10, 10))
+        self.assertEqual(
+            (members[bob.id].large_level, members[bob.id].small_level, members[bob.id].current_level_experience),
+            LevelCurve(LevelCurveTests.rules).get_level(10),
+        )
+        self.assertEqual(ExperienceTransaction.objects.filter(author=bob).count(), 1)
+
+
+class LiveCounterTests(TransactionTestCase):
+    def test_001_incremental_matches_rebuild(self):
+        anchor, amy, bob, carol = [User.objects.create(username=name) for name in ('anchor', 'amy', 'bob', 'carol')]
+        Member.objects.bulk_create([
+            Member(user=anchor, nickname='anchor'),
+            Member(user=amy, nickname='amy', vip_level=4, date_vip_expire=datetime.now() - timedelta(days=1)),
+            Member(user=bob, nickname='bob', large_level=3),
+            Member(user=carol, nickname='carol'),
+        ])
+        Live.objects.bulk_create([Live(author=anchor, name='live')])
+        live = Live.objects.get(author=anchor)
+        Prize.objects.bulk_create([Prize(name='prize', price=10, price_type=Prize.PRICE_TYPE_COIN)])
+        LiveCounter.rebuild(live)
+        # bulk_create 绕过观看记录 save() 中的腾讯云通讯调用，计数与 enter_live 相同地累加
+        LiveWatchLog.objects.bulk_create([
+            LiveWatchLog(author=user, live=live, date_enter=datetime.now(), is_online=True)
+            for user in (amy, bob, carol)
+        ])
+        for user in (amy, bob, carol):
+            LiveCounter.on_first_enter(live, Member.objects.get(user=user))
+            CreditCoinTransaction.objects.create(user_debit=user, amount=100, type=CreditCoinTransaction.TYPE_ADMIN)
+        LiveBarrage.objects.create(author=amy, live=live, content='666')
+        LiveWatchLog.objects.get(author=bob).make_comment(bob, 'hi')
+        PrizeOrder.buy_prize(live, Prize.objects.get(name='prize'), 2, carol)
+        # 观看中的会员等级变化：VIP 到期降级，以及 Member.save 中的大等级变化
+        Member.expire_vip()
+        Member.objects.filter(user=bob).update(large_level=4)
+        LiveCounter.on_levels_changed(bob.id, LiveCounter.get_level_tiers(0, 3), LiveCounter.get_level_tiers(0, 4))
+
+        fields = ['viewer_count', 'barrage_count', 'comment_count', 'diamond_amount'] + [
+            'tier{}_count'.format(tier) for tier in LiveCounter.TIERS]
+        counter = LiveCounter.objects.get(live=live)
+        incremental = [getattr(counter, field) for field in fields]
+        rebuilt = LiveCounter.rebuild(live)
+        self.assertEqual(incremental, [getattr(rebuilt, field) for field in fields])
+        self.assertEqual((counter.comment_count, counter.tier4_count, counter.tier6_count), (1, 0, 1))
+
+
+class VipExpireTests(TestCase):
+    def test_001_expire_vip(self):
+        user = User.objects.create(username='vip')
+        date_expire = datetime(2017, 10, 1)
+        Member.objects.create(user=user, mobile='13533808400', vip_level=2, date_vip_expire=date_expire)
+        self.assertEqual(Member.expire_vip(datetime(2017, 10, 2)), 1)
+        member = Member.objects.get(user=user)
+        self.assertEqual(member.vip_level, 1)
+        self.assertEqual(member.date_vip_expire, date_expire + timedelta(days=30))
+        # 长时间未执行时一次降到底
+        self.assertEqual(Member.expire_vip(datetime(2018, 1, 1)), 1)
+        member = Member.objects.get(user=user)
+        self.assertEqual(member.vip_level, 0)
+        self.assertIsNone(member.date_vip_expire)
+
+
+class ConversationTests(TestCase):
+    def test_001_chat(self):
+        amy = User.objects.create(username='amy')
+        bob = User.objects.create(username='bob')
+        for i in range(3):
+            message = Message.objects.create(sender=amy, receiver=bob, content='hi {}'.format(i))
+            Conversation.on_message(message)
+        conversation = Conversation.objects.get(owner=bob, key=Conversation.get_key(Conversation.TYPE_CHAT, amy.id))
+        self.assertEqual((conversation.content, conversation.unread_count), ('hi 2', 3))
+        self.assertEqual(Conversation.objects.get(owner=amy).unread_count, 0)
+        self.assertEqual(UnreadCounter.get(bob).chat, 3)
+        Conversation.mark_read(bob, Conversation.TYPE_CHAT, peer_id=amy.id)
+        self.assertEqual(Conversation.objects.get(owner=bob).unread_count, 0)
+        self.assertEqual(UnreadCounter.get(bob).get_total(), 0)
+
+    def test_002_broadcast_pull(self):
+        amy = User.objects.create(username='amy')
+        broadcast = Broadcast.objects.create(target=Broadcast.TARGET_SYSTEM, content='hello')
+        broadcast.send()
+        self.assertEqual(broadcast.delivery, Broadcast.DELIVERY_PULL)
+        self.assertFalse(Message.objects.filter(broadcast=broadcast).exists())
+        Broadcast.objects.create(target=Broadcast.TARGET_SYSTEM_FAMILYS, content='family only').send()
+        self.assertEqual(Conversation.deliver_broadcasts(amy), 1)
+        self.assertEqual(Conversation.deliver_broadcasts(amy), 0)
+        conversation = Conversation.objects.get(owner=amy, key=Conversation.TYPE_SYSTEM)
+        self.assertEqual((conversation.content, conversation.unread_count), ('hello', 1))
+        self.assertEqual(UnreadCounter.get(amy).system, 1)
+
+    def test_003_read_message_after_last_id(self):
+        amy = User.objects.create(username='amy')
+        bob = User.objects.create(username='bob')
+        Member.objects.bulk_create([Member(user=user, nickname=user.username) for user in (amy, bob)])
+        messages = []
+        for i in range(4):
+            message = Message.objects.create(sender=amy, receiver=bob, content='hi {}'.format(i))
+            Conversation.on_message(message)
+            messages.append(message)
+        self.client.force_login(bob)
+        response = self.client.post('/api/message/read_message/', dict(sender=amy.id, last_id=messages[1].id))
+        self.assertEqual(response.status_code, 200)
+        # last_id 之后的消息也全部已读，只推进水位，不逐条写消息
+        conversation = Conversation.objects.get(owner=bob)
+        self.assertEqual((conversation.last_read_id, conversation.unread_count), (messages[-1].id, 0))
+        self.assertEqual(UnreadCounter.get(bob).chat, 0)
+        self.assertFalse(Message.objects.filter(is_read=True).exists())
+        # 接口返回的 is_read 由双方的水位得出
+        message = Message.objects.create(sender=amy, receiver=bob, content='new')
+        Conversation.on_message(message)
+        expected = {item.id: True for item in messages}
+        expected[message.id] = False
+        for user, peer in ((bob, amy), (amy, bob)):
+            self.client.force_login(user)
+            response = self.client.get('/api/message/', dict(chat=peer.id))
+            self.assertEqual({item['id']: item['is_read'] for item in response.data['results']}, expected)
+
+    def test_004_read_one_of_several_peers(self):
+        """ 读完一个会话只减去该会话的未读数，其他会话的未读仍然计入 """
+        amy, bob, carol = [User.objects.create(username=name) for name in ('amy', 'bob', 'carol')]
+        for sender, count in ((amy, 3), (carol, 2)):
+            for i in range(count):
+                Conversation.on_message(Message.objects.create(sender=sender, receiver=bob, content='hi'))
+        self.assertEqual(UnreadCounter.get(bob).chat, 5)
+        Conversation.mark_read(bob, Conversation.TYPE_CHAT, peer_id=amy.id)
+        self.assertEqual(UnreadCounter.get(bob).chat, 2)
+        UnreadCounter.incr([bob.id], 'chat', -3)
+        self.assertEqual(UnreadCounter.get(bob).chat, 0)
+
+
+class PrefetchPlannerTests(TestCase):
+    def test_001_plan_follows_serializer_sources(self):
+        from core.prefetch import get_plan
+        from core.serializers import LiveSerializer
+        select, prefetch = get_plan(LiveSerializer())
+        self.assertIn('author__member__avatar', select)
+        self.assertIn('category', select)
+        self.assertIn('end_scene_img', select)
+
+    def test_003_plan_cache_keyed_by_serializer(self):
+        from core.prefetch import _plans, get_plan
+        from core.serializers import LiveSerializer
+        get_plan(LiveSerializer())
+        serializer = LiveSerializer()
+        serializer.fields.pop('category')
+        select, prefetch = get_plan(serializer)
+        self.assertNotIn('category', select)
+        self.assertIn('author__member__avatar', select)
+        self.assertEqual(len([key for key in _plans if key[0] is LiveSerializer]), 1)
+
+    def test_002_member_list_constant_queries(self):
+        from django.test.utils import CaptureQueriesContext
+        viewer = User.objects.create(username='viewer')
+        users = [User.objects.create(username='user{}'.format(i)) for i in range(6)]
+        Member.objects.bulk_create([Member(user=user, nickname=user.username) for user in users + [viewer]])
+        self.client.force_login(viewer)
+        counts = []
+        for page_size in (2, 6):
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get('/api/member/', dict(
+                    page_size=page_size,
+                    fields='user,nickname,username,avatar_url,is_following,contact_form_me,is_blacklist',
+                ))
+            self.assertEqual(response.status_code, 200)
+            counts.append(len(context))
+        self.assertEqual(counts[0], counts[1])
+
+
+class QueryBudgetTests(QueryBudgetMixin, TestCase):
+    query_budgets = {
+        'MemberViewSet.list': 10,
+    }
+
+    def test_001_member_list(self):
+        viewer = User.objects.create(username='viewer')
+        users = [User.objects.create(username='user{}'.format(i)) for i in range(10)]
+        Member.objects.bulk_create([Member(user=user, nickname=user.username) for user in users + [viewer]])
+        self.client.force_login(viewer)
+        self.assertQueryBudget('/api/member/', dict(
+            fields='user,nickname,username,avatar_url,is_following,contact_form_me,contact_to_me,is_blacklist',
+        ))
+
+
+class BenchmarkTests(TestCase):
+    def test_001_synthetic_data(self):
+        from core.benchmark import Benchmark, SyntheticData
+        data = SyntheticData(members=30, years=1)
+        counts = data.generate()
+        self.assertEqual(counts['core_member'], 30)
+        self.assertEqual(counts['core_prize_order'], 60)
+        self.assertEqual(Wallet.get(User.objects.get(id=data.viewer_id)).reconcile(), {})
+        benchmark = Benchmark(data, repeat=2, warmup=0)
+        results = benchmark.run(['balance_read', 'member_list', 'gift_purchase'])
+        self.assertEqual(sorted(results.keys()), ['balance_read', 'gift_purchase', 'member_list'])
+        self.assertEqual(results['member_list']['runs'], 2)
+
+
+class RobotSimulatorTests(SimpleTestCase):
+    def test_001_endpoint_stats(self):
+        from core.simulator import EndpointStats
+        stats = EndpointStats()
+        for i in range(1, 101):
+            stats.record(i, 'HTTP 500' if i % 10 == 0 else None)
+        result = stats.as_dict(10)
+        self.assertEqual(result['count'], 100)
+        self.assertEqual(result['throughput'], 10)
+        self.assertEqual(result['error_rate'], 0.1)
+        self.assertEqual(result['p50'], 51)
+        self.assertEqual(result['p99'], 100)
+        self.assertEqual(result['error_samples'], [('HTTP 500', 10)])
+
+
+class DailyStatisticTests(TestCase):
+    def setUp(self):
+        set_request()
+
+    def test_001_update(self):
+        now = datetime.now()
+        amy = User.objects.create(username='amy')
+        bob = User.objects.create(username='bob')
+        Member.objects.create(user=amy, mobile='13533808401')
+        Member.objects.create(user=bob, mobile='13533808402')
+        Member.objects.filter(user=amy).update(date_created=now - timedelta(days=2))
+        for user, days in [(amy, 2), (amy, 2), (bob, 1), (amy, 0)]:
+            record = LoginRecord.make(user)
+            LoginRecord.objects.filter(pk=record.pk).update(date_login=now - timedelta(days=days))
+        self.assertEqual(DailyStatistic.update(now), 3)
+        day = (now - timedelta(days=2)).date()
+        stats = DailyStatistic.objects.get(date=day)
+        self.assertEqual((stats.active_count, stats.login_count, stats.new_member_count), (1, 2, 1))
+        self.assertTrue(stats.is_closed)
+        self.assertFalse(DailyStatistic.objects.get(date=now.date()).is_closed)
+        # 已结算的日期不再重新统计，只重新统计当天
+        record = LoginRecord.make(bob)
+        LoginRecord.objects.filter(pk=record.pk).update(date_login=now - timedelta(days=2))
+        self.assertEqual(DailyStatistic.update(now), 1)
+        self.assertEqual(DailyStatistic.objects.get(date=day).login_count, 2)
+        self.assertEqual(DailyStatistic.objects.get(date=now.date()).login_count, 1)
+
+    def test_002_compute_live(self):
+        """ 跨天的直播时长按天切分；同时观看人数在同一时刻先离开后进入，未离开及离开早于进入的记录观看到统计截止 """
+        day = datetime(2018, 3, 6)
+        anchor, amy, bob, carol, dave, eve = [
+            User.objects.create(username=name) for name in ('anchor', 'amy', 'bob', 'carol', 'dave', 'eve')]
+        Live.objects.bulk_create([Live(author=anchor, name='live{}'.format(i)) for i in range(2)])
+        live1, live2 = Live.objects.order_by('name')
+        Live.objects.filter(pk=live1.pk).update(
+            date_created=day + timedelta(hours=23, minutes=30),
+            date_end=day + timedelta(days=1, minutes=45),
+        )
+        Live.objects.filter(pk=live2.pk).update(date_created=day + timedelta(days=1, hours=23))
+        LiveWatchLog.objects.bulk_create([
+            LiveWatchLog(author=user, live=live1, date_enter=day + timedelta(**enter),
+                         date_leave=leave and day + timedelta(**leave))
+            for user, enter, leave in [
+                (amy, dict(hours=10), dict(hours=11)),
+                (bob, dict(hours=11), dict(hours=12)),
+                (carol, dict(days=1, hours=20), None),
+                (dave, dict(days=1, hours=21), dict(days=1, hours=20, minutes=30)),
+                (eve, dict(days=1, hours=22), dict(days=1, hours=23)),
+            ]
+        ])
+        stats = DailyStatistic.compute(day.date(), (day + timedelta(days=2)).date(),
+                                       now=day + timedelta(days=2, minutes=30))
+        self.assertEqual([stats[(day + timedelta(days=i)).date()]['live_minutes'] for i in range(2)], [30, 105])
+        self.assertEqual([stats[(day + timedelta(days=i)).date()]['peak_viewer_count'] for i in range(2)], [1, 3])
 
+    def test_003_compute_amounts(self):
+        """ 充值金额只统计充值流水，礼物钻石数只统计有钻石流水的送礼 """
+        from decimal import Decimal
+        from django_finance.models import AccountTransaction
+        day = datetime(2018, 3, 6)
+        amy = User.objects.create(username='amy')
+        for type, amount, days in [
+            (AccountTransaction.TYPE_RECHARGE, 100, 0),
+            (AccountTransaction.TYPE_RECHARGE, Decimal('50.5'), 0),
+            (AccountTransaction.TYPE_WITHDRAW, 30, 0),
+            (AccountTransaction.TYPE_RECHARGE, 20, 1),
+        ]:
+            record = AccountTransaction.objects.create(user_debit=amy, type=type, amount=amount)
+            AccountTransaction.objects.filter(pk=record.pk).update(date_created=day + timedelta(days=days, hours=1))
+        Live.objects.bulk_create([Live(author=amy, name='live')])
+        LiveWatchLog.objects.bulk_create([LiveWatchLog(author=amy, live=Live.objects.get(), date_enter=day)])
+        Prize.objects.bulk_create([Prize(name='prize', price=10, price_type=Prize.PRICE_TYPE_COIN)])
+        CreditDiamondTransaction.objects.bulk_create([
+            CreditDiamondTransaction(user_debit=amy, amount=amount, type=CreditDiamondTransaction.TYPE_LIVE_GIFT)
+            for amount in (30, 12)
+        ])
+        PrizeOrder.objects.bulk_create([
+            PrizeOrder(author=amy, prize=Prize.objects.get(), live_watch_log=LiveWatchLog.objects.get(),
+                       diamond_transaction=diamond_transaction)
+            for diamond_transaction in list(CreditDiamondTransaction.objects.all()) + [None]
+        ])
+        PrizeOrder.objects.update(date_created=day + timedelta(hours=2))
+        stats = DailyStatistic.compute(day.date(), (day + timedelta(days=2)).date(), now=day + timedelta(days=2))
+        first, second = stats[day.date()], stats[(day + timedelta(days=1)).date()]
+        self.assertEqual((first['recharge_count'], first['recharge_amount']), (2, Decimal('150.5')))
+        self.assertEqual((second['recharge_count'], second['recharge_amount']), (1, 20))
+        self.assertEqual(first['withdraw_amount'], 30)
+        self.assertEqual((first['gift_count'], first['gift_diamond_amount']), (3, 42))
@@ -23,7 +23,8 @@ for key, item in v.__dict__.items():
             routers.append((name, item))
 
 for name, item in sorted(routers):
-    router.register(name, item)
+    # 没有 queryset 的 ViewSet 需要指定 base_name
+    router.register(name, item, base_name=None if getattr(item, 'queryset', None) is not None else name)
 
 
 urlpatterns = [
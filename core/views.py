@@ -5,7 +5,7 @@ from time import time
 from datetime import datetime, timedelta
 
 from django.shortcuts import render
-from django.http import HttpResponse
+from django.http import Http404, HttpResponse
 from django.db import models
 from django.core.exceptions import ValidationError
 from django.conf import settings
@@ -14,15 +14,20 @@ from rest_framework import viewsets
 from rest_framework.decorators import list_route, detail_route
 from rest_framework.filters import SearchFilter
 from rest_framework.response import Response
+from rest_framework.utils.urls import replace_query_param
 from rest_framework.pagination import PageNumberPagination
 # import rest_framework_filters as filters
 import django_filters as filters
 from django_filters import filters, FilterSet
 
+from django_base import metrics, timeseries
+
+from . import leaderboard
 from . import models as m
 from . import serializers as s
 from . import utils as u
 from . import permissions as p
+from .prefetch import PrefetchPlannerMixin, plan_queryset
 from .utils import response_success, response_fail
 
 
@@ -66,6 +71,31 @@ def interceptor_get_queryset_kw_field(self):
     return qs
 
 
+def get_leaderboard_data(request, board, duration, page=1, page_size=10):
+    """ 实时排行榜的一页，附带当前用户的名次
+    :return: dict(count, results=[dict(rank, score, member)], my_rank, my_score)
+    """
+    rows = leaderboard.top(board, duration, (page - 1) * page_size, page_size)
+    members = m.Member.objects.select_related('user').in_bulk([user_id for rank, user_id, score in rows])
+    results = []
+    for rank, user_id, score in rows:
+        member = members.get(user_id)
+        if not member:
+            continue
+        results.append(dict(
+            rank=rank,
+            score=score,
+            member=s.MemberSerializer(member, context=dict(request=request)).data,
+        ))
+    data = dict(
+        count=leaderboard.count(board, duration),
+        results=results,
+    )
+    if not request.user.is_anonymous:
+        data['my_rank'], data['my_score'] = leaderboard.rank(board, duration, request.user.id)
+    return data
+
+
 class GroupViewSet(viewsets.ModelViewSet):
     queryset = m.Group.objects.all()
     serializer_class = s.GroupSerializer
@@ -159,7 +189,8 @@ class MessageViewSet(viewsets.ModelViewSet):
     # ordering = ['-pk']
 
     def perform_create(self, serializer):
-        serializer.save(sender=self.request.user)
+        message = serializer.save(sender=self.request.user)
+        m.Conversation.on_message(message)
 
     def get_queryset(self):
         qs = interceptor_get_queryset_kw_field(self)
@@ -192,6 +223,8 @@ class MessageViewSet(viewsets.ModelViewSet):
                 m.models.Q(sender__id=chat, receiver=self.request.user) |
                 m.models.Q(sender=self.request.user, receiver__id=chat)
             ).order_by('date_created')
+        if target in ('activity', 'system'):
+            m.Conversation.deliver_broadcasts(self.request.user)
         if target and target == 'activity':
             qs = qs.filter(
                 broadcast__target=m.Broadcast.TARGET_ACTIVITY,
@@ -218,51 +251,16 @@ class MessageViewSet(viewsets.ModelViewSet):
 
     @list_route(methods=['POST'])
     def read_message(self, request):
-        last_id = request.data.get('last_id')
+        """ 私聊已读，last_id 之后的消息全部已读，即推进与 sender 会话的已读水位到最后一条消息 """
         sender = m.User.objects.get(id=request.data.get('sender'))
-        messages = m.Message.objects.filter(
-            sender=sender,
-            receiver=self.request.user,
-            id__gt=last_id,
-            is_read=False,
-        ).all()
-        for message in messages:
-            message.is_read = True
-            message.save()
+        m.Conversation.mark_read(request.user, m.Conversation.TYPE_CHAT, peer_id=sender.id)
         return Response(data=True)
 
     @list_route(methods=['POST'])
     def read_system_message(self, request):
-        last_id = request.data.get('last_id')
         target = request.data.get('target')
-        messages = []
-        if target == 'system':
-            messages = m.Message.objects.filter(
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM,
-                           sender=None,
-                           receiver=self.request.user,
-                           is_read=False, ) |
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_NOT_FAMILYS,
-                           sender=None,
-                           receiver=self.request.user,
-                           is_read=False, ) |
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_FAMILYS,
-                           sender=None,
-                           receiver=self.request.user,
-                           is_read=False, )
-            )
-        elif target == 'activity':
-            messages = m.Message.objects.filter(
-                sender=None,
-                receiver=self.request.user,
-                is_read=False,
-                broadcast__target=m.Broadcast.TARGET_ACTIVITY,
-            )
-
-        for message in messages:
-            message.is_read = True
-            message.save()
-
+        if target in (m.Conversation.TYPE_SYSTEM, m.Conversation.TYPE_ACTIVITY):
+            m.Conversation.mark_read(request.user, target)
         return Response(data=True)
 
     @list_route(methods=['POST'])
@@ -270,26 +268,15 @@ class MessageViewSet(viewsets.ModelViewSet):
         """家族聊天更新当前用户已阅读信息
         """
         family = m.Family.objects.get(pk=request.data.get('family'))
-        family_member = m.FamilyMember.objects.filter(
-            family=family,
-            author=self.request.user,
-        ).first()
-        if family_member:
-            messages = family.messages.filter(
-                date_created__gt=family_member.date_approved,
-            ).exclude(
-                users_read=self.request.user
-            ).exclude(
-                sender=self.request.user
-            ).all()
-            for message in messages:
-                message.users_read.add(self.request.user)
+        m.Conversation.mark_read(request.user, m.Conversation.TYPE_FAMILY, family_id=family.id)
         return Response(data=True)
 
     @detail_route(methods=['POST'])
     def read_family_single_message(self, request, pk):
         message = m.Message.objects.get(pk=pk)
-        message.users_read.add(self.request.user)
+        for family_id in message.families.values_list('id', flat=True):
+            m.Conversation.mark_read(request.user, m.Conversation.TYPE_FAMILY, family_id=family_id,
+                                     message_id=message.id)
         return Response(data=True)
 
 
@@ -409,8 +396,7 @@ class BroadcastViewSet(viewsets.ModelViewSet):
             target=m.Broadcast.TARGET_LIVE,
             content=content,
         )
-        for user in users:
-            broadcast.users.add(user)
+        broadcast.users.add(*users)
         broadcast.send()
         return Response(True)
 
@@ -418,29 +404,18 @@ class BroadcastViewSet(viewsets.ModelViewSet):
     def create_system_broadcast(self, request):
         content = request.data.get('content')
         target = request.data.get('target')
-        if target == m.Broadcast.TARGET_SYSTEM or target == m.Broadcast.TARGET_ACTIVITY:
-            users = m.User.objects.all()
-        elif target == m.Broadcast.TARGET_SYSTEM_FAMILYS:
-            users = m.User.objects.filter(
-                familymembers_owned__gt=0,
-            ).distinct().all()
-        elif target == m.Broadcast.TARGET_SYSTEM_NOT_FAMILYS:
-            users = m.User.objects.exclude(
-                familymembers_owned__gt=0,
-            ).distinct().all()
-        elif target == m.Broadcast.TARGET_LIVE:
-            users = m.User.objects.filter(
-                m.models.Q(livewatchlogs_owned__date_leave=None) |
-                m.models.Q(
-                    livewatchlogs_owned__date_leave__lt=m.models.F('livewatchlogs_owned__date_enter')),
-                livewatchlogs_owned__id__gt=0,
-            ).distinct().all()
         broadcast = m.Broadcast.objects.create(
             target=target,
             content=content,
         )
-        for user in users:
-            broadcast.users.add(user)
+        # 系统和活动推送不指定用户，由用户读取时拉取
+        if target == m.Broadcast.TARGET_LIVE:
+            broadcast.users.add(*m.User.objects.filter(
+                m.models.Q(livewatchlogs_owned__date_leave=None) |
+                m.models.Q(
+                    livewatchlogs_owned__date_leave__lt=m.models.F('livewatchlogs_owned__date_enter')),
+                livewatchlogs_owned__id__gt=0,
+            ).distinct())
         broadcast.send()
         return Response(True)
 
@@ -865,10 +840,7 @@ class UserViewSet(viewsets.ModelViewSet):
     def read_messages(self, request, pk):
         """ 标记当前用户与指定用户的消息为已读 """
         user = m.User.objects.get(pk=pk)
-        user.messages_owned.filter(
-            receiver=request.user,
-            is_read=False,
-        ).update(is_read=True)
+        m.Conversation.mark_read(request.user, m.Conversation.TYPE_CHAT, peer_id=user.id)
         return Response(1)
 
     @list_route(methods=['POST'])
@@ -894,7 +866,7 @@ class UserViewSet(viewsets.ModelViewSet):
         ))
 
 
-class MemberViewSet(viewsets.ModelViewSet):
+class MemberViewSet(PrefetchPlannerMixin, viewsets.ModelViewSet):
     class Filter(FilterSet):
         is_active = filters.BooleanFilter(
             name='user__is_active',
@@ -924,6 +896,37 @@ class MemberViewSet(viewsets.ModelViewSet):
     #     user.save()
     #     serializer.save()
 
+    # 从实时排行榜读取的排行，总榜
+    RANK_BOARDS = dict(
+        rank_diamond=leaderboard.BOARD_RECEIVE_DIAMOND,
+        rank_star=leaderboard.BOARD_STAR_INDEX,
+    )
+
+    def list(self, request, *args, **kwargs):
+        board = self.RANK_BOARDS.get(request.query_params.get('rank_type'))
+        if not board:
+            return super().list(request, *args, **kwargs)
+        # 收到礼物钻石数量 / 元气指数，只从排行榜取出请求的这一页
+        page = int(request.query_params.get('page') or 1)
+        page_size = int(request.query_params.get('page_size') or self.paginator.page_size)
+        rows = leaderboard.top(board, leaderboard.DURATION_TOTAL, (page - 1) * page_size, page_size)
+        members = plan_queryset(m.Member.objects.all(), self.get_serializer()).in_bulk(
+            [user_id for rank, user_id, score in rows])
+        results = []
+        for rank, user_id, score in rows:
+            member = members.get(user_id)
+            if member:
+                member.amount = score
+                results.append(member)
+        count = leaderboard.count(board, leaderboard.DURATION_TOTAL)
+        url = request.build_absolute_uri()
+        return Response(data=dict(
+            count=count,
+            next=replace_query_param(url, 'page', page + 1) if page * page_size < count else None,
+            previous=replace_query_param(url, 'page', page - 1) if page > 1 else None,
+            results=self.get_serializer(results, many=True).data,
+        ))
+
     def perform_destroy(self, instance):
         deleted_username = 'deleted_' \
                            + datetime.now().strftime('%Y%m%d%H%M%S') \
@@ -1025,23 +1028,10 @@ class MemberViewSet(viewsets.ModelViewSet):
 
         rank_type = self.request.query_params.get('rank_type')
 
-        if rank_type and rank_type == 'rank_diamond':
-            # 收到礼物钻石数量
-            qs = m.Member.objects.annotate(
-                amount=m.models.Sum(
-                    'user__creditdiamondtransactions_debit__prize_orders__diamond_transaction__amount'
-                )
-            ).order_by('-amount')
         if rank_type and rank_type == 'rank_prize':
             qs = m.Member.objects.annotate(
                 amount=m.models.Sum('user__prizeorders_owned__sender_prize_transaction__amount')
             ).order_by('-amount')
-        if rank_type and rank_type == 'rank_star':
-            # TODO：根据收到主播元气指数排序
-            qs = m.Member.objects.annotate(
-                amount=m.models.Sum('user__creditstarindexsendertransactions_credit__amount')
-                       - m.models.Sum('user__creditstarindexsendertransactions_debit__amount')
-            ).order_by('amount')
 
         is_withdraw_blacklisted = self.request.query_params.get('is_withdraw_blacklisted')
         if is_withdraw_blacklisted == 'true':
@@ -1059,14 +1049,12 @@ class MemberViewSet(viewsets.ModelViewSet):
             ).order_by('live_count', '-date_created')
 
         if follow_recommended:
-            me = self.request.user.member
-            follow = me.get_follow().all()
             qs = qs.filter(
                 is_follow_recommended=True
             ).exclude(
                 user=self.request.user
             ).exclude(
-                user__in=[member.user for member in follow],
+                user__follows_related__author=self.request.user,
             )
 
         # 使用鑽石消費排行
@@ -1120,10 +1108,9 @@ class MemberViewSet(viewsets.ModelViewSet):
     @detail_route(methods=['POST'])
     def cancel_follow(self, request, pk):
         me = m.Member.objects.get(pk=pk)
-        member = request.data.get('member')
-        follow_mark = m.UserMark.objects.filter(author=me.user, subject='follow', object_id=member)
-        if follow_mark.exists():
-            follow_mark.first().delete()
+        member = m.Member.objects.filter(pk=request.data.get('member')).first()
+        if member:
+            member.set_followed_by(me.user, False)
 
         return Response(data=True)
 
@@ -1135,16 +1122,17 @@ class MemberViewSet(viewsets.ModelViewSet):
         contact_list = m.Member.objects.filter(m.models.Q(user__contacts_related__author=member.user),
                                                m.models.Q(user__contacts_owned__user=member.user))
 
+        unread = dict(m.Conversation.objects.filter(
+            owner=member.user,
+            type=m.Conversation.TYPE_CHAT,
+        ).values_list('peer_id', 'unread_count'))
         data = []
         for contact in contact_list:
-            unread = m.Message.objects.filter(sender=contact.user,
-                                              receiver=member.user,
-                                              is_read=False).count()
             data.append(dict(
                 id=contact.user.id,
                 nickname=contact.nickname,
                 avatar_url=contact.avatar.image.url,
-                unread=unread,
+                unread=unread.get(contact.user.id, 0),
             ))
         return Response(data=data)
 
@@ -1219,152 +1207,56 @@ class MemberViewSet(viewsets.ModelViewSet):
     @list_route(methods=['GET'])
     def get_chat_list(self, request):
         """ 获取聊天列表
-        所有和自己发过消息的人的列表
+        所有和自己发过消息的人、所在的家族，以及追踪、动态互动、活动消息的摘要
         附加最近发布过的消息，按照从新到旧的顺序排列
+        直接读取会话摘要表，传入 page 参数时分页
         :return:
         """
-        me = request.user
-        sql = '''
-        select u.*, max(m.date_created) last_date
-        from auth_user u, base_message m
-        where u.id = m.sender_id and m.receiver_id = %s
-          or u.id = m.receiver_id and m.sender_id = %s
-        group by u.id
-        order by max(m.date_created) desc
-        '''
-
-        users = m.User.objects.raw(sql, [me.id, me.id])
-        data = []
-
-        for user in users:
-            message = m.Message.objects.filter(
-                m.models.Q(sender=user, receiver=me) |
-                m.models.Q(sender=me, receiver=user)
-            ).order_by('-date_created').first()
-            unread_count = m.Message.objects.filter(
-                sender=user,
-                receiver=me,
-                is_read=False,
-            ).count()
-            data.append(dict(
-                id=user.id,
-                nickname=user.member.nickname,
-                date_created=message.date_created,
-                message_content='[禮物表情]' if message.type == m.Message.TYPE_IMAGE else message.content,
-                avatar=s.ImageSerializer(user.member.avatar).data['image'],
-                type='chat',
-                unread_count=unread_count,
-            ))
+        m.Conversation.deliver_broadcasts(request.user)
+        qs = m.Conversation.objects.filter(
+            owner=request.user,
+        ).exclude(
+            type=m.Conversation.TYPE_SYSTEM,
+        ).exclude(
+            # 只记录了推送拉取水位，还没有消息的活动会话
+            type=m.Conversation.TYPE_ACTIVITY,
+            last_message_id=0,
+            content='',
+        ).select_related(
+            'peer__member__avatar', 'family__logo',
+        ).order_by('-date_last')
+
+        conversations = qs
+        if 'page' in request.query_params:
+            conversations = self.paginate_queryset(qs)
 
-        # 最新跟蹤信息
-        follow_user_mark = m.UserMark.objects.filter(
-            object_id=self.request.user.id,
-            subject='follow',
-            content_type=m.ContentType.objects.get(model='member'),
-        ).order_by('-date_created')
-        if follow_user_mark.exists():
-            unread_count = m.UserMark.objects.filter(
-                object_id=self.request.user.id,
-                subject='follow',
-                content_type=m.ContentType.objects.get(model='member'),
-                is_read=False,
-            ).count()
-            data.append(dict(
-                type='follow',
-                message_content='{} 追蹤了你'.format(follow_user_mark.first().author.member.nickname),
-                unread_count=unread_count,
-                date_created=follow_user_mark.first().date_created,
-            ))
-        # 最新動態消息
-        activeevents = self.request.user.activeevents_owned.all()
-        like_activeevent_mark = m.UserMark.objects.filter(
-            object_id__in=[activeevent.id for activeevent in activeevents],
-            subject='like',
-            content_type=m.ContentType.objects.get(model='activeevent'),
-        ).order_by('-date_created').first()
-        activeevent_comment = m.Comment.objects.filter(
-            m.models.Q(activeevents__id__in=[activeevent.id for activeevent in activeevents]) |
-            m.models.Q(activeevents__id__gt=0, parent__author=self.request.user)
-        ).exclude(author=self.request.user, ).order_by('-date_created').first()
-        last_activeevent_message = None
-        if like_activeevent_mark and activeevent_comment:
-            if like_activeevent_mark.date_created > activeevent_comment.date_created:
-                last_activeevent_message = 'mark'
-            else:
-                last_activeevent_message = 'comment'
-        else:
-            last_activeevent_message = 'mark' if like_activeevent_mark else 'comment' if activeevent_comment else None
-
-        unread_count = m.UserMark.objects.filter(
-            object_id__in=[activeevent.id for activeevent in activeevents],
-            subject='like',
-            content_type=m.ContentType.objects.get(model='activeevent'),
-            is_read=False,
-        ).count() + m.Comment.objects.filter(
-            m.models.Q(activeevents__id__in=[activeevent.id for activeevent in activeevents], is_read=False) |
-            m.models.Q(activeevents__id__gt=0, parent__author=self.request.user, is_read=False)
-        ).exclude(author=self.request.user).count()
-
-        if last_activeevent_message and last_activeevent_message == 'mark':
-            data.append(dict(
-                date_created=like_activeevent_mark.date_created,
-                message_content='{} 給你點了一個讃'.format(like_activeevent_mark.author.member.nickname),
-                type='activeevent',
-                unread_count=unread_count,
-            ))
-
-        if last_activeevent_message and last_activeevent_message == 'comment':
-            data.append(dict(
-                date_created=activeevent_comment.date_created,
-                message_content=activeevent_comment.content,
-                type='activeevent',
-                unread_count=unread_count,
-            ))
-
-        # 活動消息
-        activity_message = m.Message.objects.filter(
-            sender=None,
-            receiver=self.request.user,
-            broadcast__target=m.Broadcast.TARGET_ACTIVITY,
-        ).order_by('-date_created')
-
-        if activity_message.exists():
-            unread_count = m.Message.objects.filter(
-                sender=None,
-                receiver=self.request.user,
-                broadcast__target=m.Broadcast.TARGET_ACTIVITY,
-            ).exclude(users_read=self.request.user).count()
-            data.append(dict(
-                date_created=activity_message.first().date_created,
-                message_content=activity_message.first().content,
-                unread_count=unread_count,
-                type='activity',
-            ))
-
-        # 家族消息
-        family_members = m.FamilyMember.objects.filter(
-            author=self.request.user,
-            status=m.FamilyMember.STATUS_APPROVED,
-        ).all()
-        for family_member in family_members:
-            if family_member.family.messages.exists():
-                last_message = family_member.family.messages.filter(
-                    date_created__gt=family_member.date_approved,
-                ).order_by('-date_created').first()
-                unread_count = family_member.family.messages.filter(
-                    date_created__gt=family_member.date_approved,
-                ).exclude(users_read=me).exclude(sender=me).count()
-                data.append(dict(
-                    id=family_member.family.id,
-                    nickname=family_member.family.name,
-                    date_created=last_message.date_created,
-                    message_content='[禮物表情]' if last_message.type == m.Message.TYPE_IMAGE else last_message.content,
-                    avatar=s.ImageSerializer(family_member.family.logo).data['image'],
-                    type='family',
-                    unread_count=unread_count,
-                ))
+        data = []
+        for conversation in conversations:
+            item = dict(
+                type=conversation.type,
+                date_created=conversation.date_last,
+                message_content=conversation.content,
+                unread_count=conversation.unread_count,
+                last_read_id=conversation.last_read_id,
+            )
+            if conversation.type == m.Conversation.TYPE_CHAT:
+                member = conversation.peer.member
+                item.update(
+                    id=conversation.peer_id,
+                    nickname=member.nickname,
+                    avatar=s.ImageSerializer(member.avatar).data['image'],
+                )
+            elif conversation.type == m.Conversation.TYPE_FAMILY:
+                item.update(
+                    id=conversation.family_id,
+                    nickname=conversation.family.name,
+                    avatar=s.ImageSerializer(conversation.family.logo).data['image'],
+                )
+            data.append(item)
 
-        return Response(data=sorted(data, key=lambda item: item['date_created'], reverse=True))
+        if 'page' in request.query_params:
+            return self.get_paginated_response(data)
+        return Response(data=data)
 
     @list_route(methods=['POST'])
     def member_inform(self, request):
@@ -1402,6 +1294,7 @@ class MemberViewSet(viewsets.ModelViewSet):
     @list_route(methods=['GET'])
     def get_system_message_list(self, request):
         # 获得系统消息列表
+        m.Conversation.deliver_broadcasts(self.request.user)
         # 最新系統信息
         system_message = m.Message.objects.filter(
             m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM,
@@ -1413,14 +1306,10 @@ class MemberViewSet(viewsets.ModelViewSet):
         ).order_by('-date_created')
         last_system_message = None
         if system_message.exists():
-            unread_count = m.Message.objects.filter(
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM,
-                           sender=None, receiver=self.request.user, ) |
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_NOT_FAMILYS,
-                           sender=None, receiver=self.request.user, ) |
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_FAMILYS,
-                           sender=None, receiver=self.request.user, )
-            ).exclude(users_read=self.request.user).count()
+            unread_count = m.Conversation.objects.filter(
+                owner=self.request.user,
+                type=m.Conversation.TYPE_SYSTEM,
+            ).values_list('unread_count', flat=True).first() or 0
             last_system_message = dict(
                 date_created=system_message.first().date_created,
                 content=system_message.first().content,
@@ -1471,114 +1360,10 @@ class MemberViewSet(viewsets.ModelViewSet):
             return response_fail('請填寫完整的時間區間')
         begin = datetime.strptime(time_begin, '%Y-%m-%d')
         end = datetime.strptime(time_end, '%Y-%m-%d')
-        duration = end - begin
-        data = None
-        labels = []
-        amounts = []
-        if duration.days < 31:
-            for i in range(duration.days + 1):
-                label_item = '{}月{}號'.format(
-                    (begin + timedelta(days=i)).month, (begin + timedelta(days=i)).day)
-                amount_item = m.Member.objects.filter(
-                    date_created__gt=begin + timedelta(days=i),
-                    date_created__lt=begin + timedelta(days=i + 1)
-                ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        elif 31 < duration.days < 62:
-            for i in range(int(duration.days / 7)):
-                label_item = '{}月{}號 - {}月{}號'.format(
-                    (begin + timedelta(days=i * 7)).month,
-                    (begin + timedelta(days=i * 7)).day,
-                    (begin + timedelta(days=(i + 1) * 7)).month,
-                    (begin + timedelta(days=(i + 1) * 7)).day,
-                )
-                amount_item = m.Member.objects.filter(
-                    date_created__gt=begin + timedelta(days=i * 7),
-                    date_created__lt=begin + timedelta(days=(i + 1) * 7)
-                ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-                if i == int(duration.days / 7) - 1 and duration.days % 7 > 0:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        (begin + timedelta(days=(i + 1) * 7)).month,
-                        (begin + timedelta(days=(i + 1) * 7)).day,
-                        end.month,
-                        end.day,
-                    )
-                    amount_item = m.Member.objects.filter(
-                        date_created__gt=begin + timedelta(days=(i + 1) * 7),
-                        date_created__lt=end + timedelta(days=1),
-                    ).count()
-                    labels.append(label_item)
-                    amounts.append(amount_item)
-        elif 62 < duration.days <= 366:
-            for i in range(int(duration.days / 31) + 2):
-                if i == 0 and begin.day != 1:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        begin.month,
-                        begin.day,
-                        1 if begin.month == 12 else begin.month + 1,
-                        1,
-                    )
-                    amount_item = m.Member.objects.filter(
-                        date_created__gt=begin,
-                        date_created__lt=datetime(begin.year + 1, 1, 1) if begin.month == 12 else datetime(
-                            begin.year, begin.month + 1, 1),
-                    ).count()
-                elif i == int(duration.days / 31) + 1:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        1 if begin.month + i == 12 else (begin.month + i) % 12,
-                        1,
-                        end.month,
-                        end.day,
-                    )
-                    amount_item = m.Member.objects.filter(
-                        date_created__gt=datetime(begin.year + 1, (begin.month + i) % 12,
-                                                  1) if begin.month + i > 12 else datetime(begin.year,
-                                                                                           begin.month + i, 1),
-                        date_created__lt=end + timedelta(days=1)
-                    ).count()
-                else:
-                    label_item = '{}月1號 - {}月1號'.format(
-                        begin.month + i if begin.month + i <= 12 else (begin.month + i) % 12,
-                        begin.month + i + 1 if begin.month + i + 1 <= 12 else (begin.month + i + 1) % 12,
-                    )
-                    amount_item = m.Member.objects.filter(
-                        date_created__gt=datetime(begin.year + 1, (begin.month + i) % 12,
-                                                  1) if begin.month + i > 12 else datetime(
-                            begin.year, begin.month + i, 1),
-                        date_created__lt=datetime(begin.year + 1, (begin.month + i + 1) % 12,
-                                                  1) if begin.month + i + 1 > 12 else datetime(
-                            begin.year, begin.month + i + 1, 1),
-                    ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        else:
-            for i in range(int(duration.days / 365) + 1):
-                label_item = '{}年'.format(begin.year + i)
-                if i == 0:
-                    amount_item = m.Member.objects.filter(
-                        date_created__gt=begin,
-                        date_created__lt=datetime(begin.year + 1, 1, 1)
-                    ).count()
-                elif i == duration.days / 365:
-                    amount_item = m.Member.objects.filter(
-                        date_created__gt=datetime(begin.year + i, 1, 1),
-                        date_created__lt=end,
-                    ).count()
-                else:
-                    amount_item = m.Member.objects.filter(
-                        date_created__gt=datetime(begin.year + i, 1, 1),
-                        date_created__lt=datetime(begin.year + i + 1, 1, 1),
-                    ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        data = dict(
-            labels=labels,
-            amounts=amounts,
-        )
-        return Response(data=data)
+        return Response(data=timeseries.get_chart_data(
+            m.DailyStatistic.objects.all(), 'date', begin, end + timedelta(days=1),
+            value=models.Sum('new_member_count'),
+        ))
 
     @list_route(methods=['GET'])
     def get_gender_chart_data(self, request):
@@ -1681,120 +1466,54 @@ class MemberViewSet(viewsets.ModelViewSet):
         """
         检测用户是否有未读信息 返回Bool
         """
-        chat = m.Message.objects.filter(
-            receiver=self.request.user,
-            is_read=False,
-        ).exists()
-        if chat:
-            return Response(data=True)
-        family_members = m.FamilyMember.objects.filter(
-            author=self.request.user,
-            status=m.FamilyMember.STATUS_APPROVED,
-        ).all()
-        for family_member in family_members:
-            if family_member.family.messages.filter(
-                    date_created__gt=family_member.date_approved,
-            ).exclude(users_read=self.request.user).exclude(sender=self.request.user).exists():
-                return Response(data=True)
-        activity_message = m.Message.objects.filter(
-            sender=None,
-            receiver=self.request.user,
-            broadcast__target=m.Broadcast.TARGET_ACTIVITY,
-        ).exclude(users_read=self.request.user).exists()
-        if activity_message:
-            return Response(data=True)
+        m.Conversation.deliver_broadcasts(request.user)
+        return Response(data=m.UnreadCounter.get(request.user).get_total() > 0)
 
-        system_message = m.Message.objects.filter(
-            m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM,
-                       sender=None, receiver=self.request.user, ) |
-            m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_NOT_FAMILYS,
-                       sender=None, receiver=self.request.user, ) |
-            m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_FAMILYS,
-                       sender=None, receiver=self.request.user, )
-        ).exclude(users_read=self.request.user).exists()
-        if system_message:
-            return Response(data=True)
-
-        activeevents = self.request.user.activeevents_owned.all()
-        activeevents_comments = m.Comment.objects.filter(
-            m.models.Q(activeevents__id__in=[activeevent.id for activeevent in activeevents], is_read=False) |
-            m.models.Q(activeevents__id__gt=0, parent__author=self.request.user, is_read=False)
-        ).exclude(author=self.request.user, ).exists()
-        activeevents_marks = m.UserMark.objects.filter(
-            object_id__in=[activeevent.id for activeevent in activeevents],
-            subject='like',
-            content_type=m.ContentType.objects.get(model='activeevent'),
-        ).exclude(is_read=True).exists()
-        if activeevents_comments or activeevents_marks:
-            return Response(data=True)
-
-        follow_marks = m.UserMark.objects.filter(
-            object_id=self.request.user.id,
-            subject='follow',
-            content_type=m.ContentType.objects.get(model='member'),
-        ).exclude(is_read=True).exists()
-        if follow_marks:
-            return Response(data=True)
-
-        return Response(data=False)
+    @list_route(methods=['GET'])
+    def get_unread_count(self, request):
+        """
+        按类型返回用户的未读数
+        """
+        m.Conversation.deliver_broadcasts(request.user)
+        counter = m.UnreadCounter.get(request.user)
+        data = {field: getattr(counter, field) for field in m.UnreadCounter.FIELDS}
+        data['total'] = counter.get_total()
+        return Response(data=data)
 
     @list_route(methods=['POST'])
     def read_system_message(self, requset):
         """阅读系统信息
         """
         type = requset.data.get('type')
-        messages = None
-        if type == 'system':
-            messages = m.Message.objects.filter(
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM,
-                           sender=None, receiver=self.request.user, ) |
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_NOT_FAMILYS,
-                           sender=None, receiver=self.request.user, ) |
-                m.models.Q(broadcast__target=m.Broadcast.TARGET_SYSTEM_FAMILYS,
-                           sender=None, receiver=self.request.user, )
-            ).exclude(users_read=self.request.user).order_by('-date_created').all()
-        if type == 'activity':
-            messages = m.Message.objects.filter(
-                sender=None,
-                receiver=self.request.user,
-                broadcast__target=m.Broadcast.TARGET_ACTIVITY,
-            ).exclude(users_read=self.request.user).all()
-
-        for message in messages:
-            message.users_read.add(self.request.user)
-
+        if type in (m.Conversation.TYPE_SYSTEM, m.Conversation.TYPE_ACTIVITY):
+            m.Conversation.mark_read(self.request.user, type)
         return Response(data=True)
 
     @list_route(methods=['POST'])
     def read_follow_message(self, request):
         type = request.data.get('type')
-        marks = None
-        comments = None
         if type == 'follow':
-            marks = m.UserMark.objects.filter(
+            m.UserMark.objects.filter(
                 object_id=self.request.user.id,
                 subject='follow',
                 content_type=m.ContentType.objects.get(model='member'),
-            ).exclude(is_read=True).all()
+                is_read=False,
+            ).update(is_read=True)
+            m.Conversation.mark_read(self.request.user, m.Conversation.TYPE_FOLLOW)
         if type == 'activity':
-            activeevents = self.request.user.activeevents_owned.all()
-            marks = m.UserMark.objects.filter(
-                object_id__in=[activeevent.id for activeevent in activeevents],
+            activeevent_ids = list(self.request.user.activeevents_owned.values_list('id', flat=True))
+            m.UserMark.objects.filter(
+                object_id__in=activeevent_ids,
                 subject='like',
                 content_type=m.ContentType.objects.get(model='activeevent'),
-            ).exclude(is_read=True).all()
-            comments = m.Comment.objects.filter(
-                m.models.Q(activeevents__id__in=[activeevent.id for activeevent in activeevents], is_read=False) |
+                is_read=False,
+            ).update(is_read=True)
+            comment_ids = list(m.Comment.objects.filter(
+                m.models.Q(activeevents__id__in=activeevent_ids, is_read=False) |
                 m.models.Q(activeevents__id__gt=0, parent__author=self.request.user, is_read=False)
-            ).exclude(author=self.request.user, ).all()
-
-        for mark in marks:
-            mark.is_read = True
-            mark.save()
-        if comments:
-            for comment in comments:
-                comment.is_read = True
-                comment.save()
+            ).exclude(author=self.request.user).values_list('id', flat=True))
+            m.Comment.objects.filter(id__in=comment_ids).update(is_read=True)
+            m.Conversation.mark_read(self.request.user, m.Conversation.TYPE_ACTIVEEVENT)
         return Response(data=True)
 
     @list_route(methods=['GET'])
@@ -1880,18 +1599,14 @@ class CreditDiamondTransactionViewSet(viewsets.ModelViewSet):
         :return:
         """
         # type   0:日榜； 1:周榜； 2：总榜
-        type = request.data.get('type')
-        data = []
-        users = []
-        transactions = m.CreditDiamondTransaction.objects.filter(user_debit=request.user)
-        for transaction in transactions:
-            if not transaction.user_credit in users:
-                users.append(transaction.user_credit)
-        for user in users:
-            amount = m.CreditDiamondTransaction.objects.filter(
-                user_debit=request.user,
-                user_credit=user).all().aggregate(amount=models.Sum('amount')).get('amount') or 0
-        return Response(data=data)
+        durations = [leaderboard.DURATION_DATE, leaderboard.DURATION_WEEK, leaderboard.DURATION_TOTAL]
+        type = request.query_params.get('type') or request.data.get('type') or 0
+        assert str(type) in ('0', '1', '2'), '不正確的統計區間'
+        page = int(request.query_params.get('page') or 1)
+        page_size = int(request.query_params.get('page_size') or 10)
+        return Response(data=get_leaderboard_data(
+            request, leaderboard.BOARD_RECEIVE_DIAMOND, durations[int(type)], page, page_size,
+        ))
 
 
 class CreditCoinTransactionViewSet(viewsets.ModelViewSet):
@@ -2180,7 +1895,7 @@ class LiveCategoryViewSet(viewsets.ModelViewSet):
         return qs
 
 
-class LiveViewSet(viewsets.ModelViewSet):
+class LiveViewSet(PrefetchPlannerMixin, viewsets.ModelViewSet):
     filter_fields = '__all__'
     queryset = m.Live.objects.all()
     serializer_class = s.LiveSerializer
@@ -2325,10 +2040,7 @@ class LiveViewSet(viewsets.ModelViewSet):
         live = m.Live.objects.get(pk=pk)
         watch_log = live.watch_logs.filter(author=request.user).first()
         assert watch_log, '观看记录尚未生成'
-        comment = watch_log.comments.create(
-            author=request.user,
-            content=request.data.get('content'),
-        )
+        comment = watch_log.make_comment(request.user, request.data.get('content'))
         return Response(data=s.CommentSerializer(comment).data)
 
     @detail_route(methods=['POST'])
@@ -2353,6 +2065,32 @@ class LiveViewSet(viewsets.ModelViewSet):
         prize_order = m.PrizeOrder.buy_prize(live, prize, count, request.user)
         return Response(data=s.PrizeOrderSerializer(prize_order).data)
 
+    @detail_route(methods=['POST'])
+    def buy_prize_batch(self, request, pk):
+        """ 连击送礼，一次提交多个礼物
+        prizes: [{"prize": id, "count": int}, ...]
+        """
+        live = m.Live.objects.get(pk=pk)
+        prizes = request.data.get('prizes') or []
+        for item in prizes:
+            assert isinstance(item, dict) and item.get('prize') and item.get('count'), '請選擇要贈送的禮物和數量'
+            assert str(item.get('prize')).isdigit() and str(item.get('count')).isdigit(), '禮物或數量不正確'
+        prize_map = m.Prize.objects.in_bulk([int(item.get('prize')) for item in prizes])
+        items = []
+        for item in prizes:
+            prize = prize_map.get(int(item.get('prize')))
+            assert prize, '禮物不存在'
+            assert self.request.user.member.vip_level >= prize.vip_limit, \
+                '購買該禮物需要vip等級達到{}'.format(prize.vip_limit)
+            items.append((prize, int(item.get('count'))))
+        prize_orders = m.PrizeOrder.buy_prize_batch(live, items, request.user)
+        wallet = m.Wallet.get(request.user)
+        return Response(data=dict(
+            orders=s.PrizeOrderSerializer(prize_orders, many=True).data,
+            coin_balance=wallet.coin,
+            star_balance=wallet.star,
+        ))
+
     @detail_route(methods=['POST'])
     def send_active_prize(self, request, pk):
         live = m.Live.objects.get(pk=pk)
@@ -2467,30 +2205,22 @@ class LiveViewSet(viewsets.ModelViewSet):
         """
         获得直播间实时人数
         """
-        live = m.Live.objects.get(pk=pk)
-        count = m.LiveWatchLog.objects.filter(
-            m.models.Q(live=live, date_leave=None) |
-            m.models.Q(live=live, date_leave__lt=m.models.F('date_enter'))
-        ).count()
-        return Response(data=count)
+        from . import presence
+        return Response(data=presence.count(int(pk)))
 
     @detail_route(methods=['POST'])
     def owner_live_response(self, request, pk):
         """
         主播直播响应
+        心跳先记录在内存中，由 presence 批量写回 date_response
         """
-        live = m.Live.objects.get(pk=pk)
-        live.date_response = datetime.now()
-        live.save()
-        log = live.watch_logs.filter(author=self.request.user).first()
-        if log:
-            log.date_response = datetime.now()
-            log.save()
-        count = m.LiveWatchLog.objects.filter(
-            m.models.Q(live=live, date_leave=None) |
-            m.models.Q(live=live, date_leave__lt=m.models.F('date_enter'))
-        ).count()
-        return Response(data=count)
+        from . import presence
+        live_id = int(pk)
+        if not m.Live.objects.filter(pk=live_id).exists():
+            raise Http404
+        presence.owner_heartbeat(live_id)
+        presence.heartbeat(live_id, request.user.id)
+        return Response(data=presence.count(live_id))
 
     @list_route(methods=['GET'])
     def get_hot_live(self, request):
@@ -2519,7 +2249,7 @@ class LiveBarrageViewSet(viewsets.ModelViewSet):
         return interceptor_get_queryset_kw_field(self)
 
 
-class LiveWatchLogViewSet(viewsets.ModelViewSet):
+class LiveWatchLogViewSet(PrefetchPlannerMixin, viewsets.ModelViewSet):
     filter_fields = '__all__'
     queryset = m.LiveWatchLog.objects.all()
     serializer_class = s.LiveWatchLogSerializer
@@ -2549,43 +2279,36 @@ class LiveWatchLogViewSet(viewsets.ModelViewSet):
 
     @list_route(methods=['GET'])
     def get_watch_chart_data(self, request):
-        labels = []
-        amounts = []
-        data = None
+        """
+        数据分析 - 昨日各时段进入直播间的人次
+        :param request:
+        :return:
+        """
         category = self.request.query_params.get('category')
         now = datetime.now()
-        yesterday = datetime(now.year, now.month, now.day) - timedelta(days=1)
-        for i in range(24):
-            print(datetime(yesterday.year, yesterday.month, yesterday.day, i))
-            label_item = '{:0>2d}:00 - {:0>2d}:00'.format(i, i + 1)
-            amount_item = m.LiveWatchLog.objects.filter(
-                live__category=category,
-                date_enter__gte=datetime(yesterday.year, yesterday.month, yesterday.day, i),
-                date_enter__lte=datetime(yesterday.year, yesterday.month, yesterday.day,
-                                         i + 1) if i + 1 < 24 else datetime(now.year, now.month, now.day)
-            ).count()
-            labels.append(label_item)
-            amounts.append(amount_item)
-        data = dict(labels=labels, amounts=amounts)
-        return Response(data=data)
+        today = datetime(now.year, now.month, now.day)
+        return Response(data=timeseries.get_chart_data(
+            m.LiveWatchLog.objects.filter(live__category=category), 'date_enter',
+            today - timedelta(days=1), today, timeseries.GRANULARITY_HOUR,
+        ))
 
     @list_route(methods=['POST'])
     def viewer_log_response(self, request):
         """观众观看直播响应
         """
-        live = m.Live.objects.get(pk=request.data.get('live'))
-        watch_log = live.watch_logs.filter(
-            author=self.request.user,
-        ).first()
-        if not watch_log:
-            return Response(data=False)
-        watch_log.date_response = datetime.now()
-        watch_log.save()
-        count = m.LiveWatchLog.objects.filter(
-            m.models.Q(live=watch_log.live, date_leave=None) |
-            m.models.Q(live=watch_log.live, date_leave__lt=m.models.F('date_enter'))
-        ).count()
-        return Response(data=count)
+        from . import presence
+        live_id = int(request.data.get('live'))
+        if not presence.heartbeat(live_id, request.user.id):
+            # 内存中没有在线记录，以观看记录为准
+            watch_log = m.LiveWatchLog.objects.filter(
+                live_id=live_id,
+                author=request.user,
+            ).first()
+            if not watch_log:
+                return Response(data=False)
+            if watch_log.is_watching():
+                presence.enter(live_id, request.user.id)
+        return Response(data=presence.count(live_id))
 
 
 class ActiveEventViewSet(viewsets.ModelViewSet):
@@ -2619,13 +2342,12 @@ class ActiveEventViewSet(viewsets.ModelViewSet):
         if hot:
             # 热门动态
             me = self.request.user.member
-            follow = me.get_follow().all()
             friend = m.Member.objects.filter(
                 m.models.Q(user__contacts_related__author=me.user),
                 m.models.Q(user__contacts_owned__user=me.user),
             ).all()
             qs = qs.exclude(
-                author__in=[member.user for member in follow],
+                author__follows_related__author=me.user,
             ).exclude(
                 author__in=[member.user for member in friend],
             ).exclude(
@@ -2787,7 +2509,7 @@ class PrizeTransactionViewSet(viewsets.ModelViewSet):
         #     return Response(True)
 
 
-class PrizeOrderViewSet(viewsets.ModelViewSet):
+class PrizeOrderViewSet(PrefetchPlannerMixin, viewsets.ModelViewSet):
     filter_fields = '__all__'
     queryset = m.PrizeOrder.objects.all()
     serializer_class = s.PrizeOrderSerializer
@@ -3268,6 +2990,7 @@ class CommentViewSet(viewsets.ModelViewSet):
             if parent:
                 comment.parent = m.Comment.objects.get(pk=parent)
                 comment.save()
+            m.Conversation.on_activeevent_comment(comment, activeevent)
         return Response(data=True)
 
     @list_route(methods=['POST'])
@@ -3381,8 +3104,7 @@ class AccountTransactionViewSet(viewsets.ModelViewSet):
 
     @list_route(methods=['GET'])
     def get_total_recharge(self, request):
-        data = m.AccountTransaction.objects.filter(type=m.AccountTransaction.TYPE_RECHARGE).aggregate(
-            amount=models.Sum('amount')).get('amount') or 0
+        data = m.DailyStatistic.objects.aggregate(amount=models.Sum('recharge_amount')).get('amount') or 0
         return Response(data=data)
 
     @list_route(methods=['GET'])
@@ -3448,6 +3170,20 @@ class RankRecordViewSet(viewsets.ModelViewSet):
 
         return qs
 
+    @list_route(methods=['GET'])
+    def leaderboard(self, request):
+        """ 实时排行榜
+        rank_type: receive_diamond_amount / send_diamond_amount / star_index_amount
+        duration: DATE / WEEK / TOTAL
+        """
+        rank_type = request.query_params.get('rank_type')
+        duration = request.query_params.get('duration')
+        assert rank_type in leaderboard.BOARDS, '不正確的榜單類型'
+        assert duration in leaderboard.DURATIONS, '不正確的統計區間'
+        page = int(request.query_params.get('page') or 1)
+        page_size = int(request.query_params.get('page_size') or 10)
+        return Response(data=get_leaderboard_data(request, rank_type, duration, page, page_size))
+
 
 class AdminLogViewSet(viewsets.ModelViewSet):
     filter_fields = '__all__'
@@ -3459,19 +3195,66 @@ class AdminLogViewSet(viewsets.ModelViewSet):
         return interceptor_get_queryset_kw_field(self)
 
 
+class RecurringJobViewSet(viewsets.ReadOnlyModelViewSet):
+    """ 周期任务的执行状态：下次执行时间、上次延迟和耗时、失败次数 """
+    filter_fields = '__all__'
+    queryset = m.RecurringJob.objects.all()
+    serializer_class = s.RecurringJobSerializer
+    permission_classes = [p.IsAdminUser]
+    ordering = ['date_next']
+
+
+class DailyStatisticViewSet(viewsets.ReadOnlyModelViewSet):
+    """ 平台每日统计：活跃用户、新增会员、充值、送礼、直播时长和最高同时观看人数 """
+    filter_fields = '__all__'
+    queryset = m.DailyStatistic.objects.all()
+    serializer_class = s.DailyStatisticSerializer
+    permission_classes = [p.IsAdminUser]
+    ordering = ['-date']
+
+    def get_queryset(self):
+        qs = super().get_queryset()
+        date_begin = self.request.query_params.get('date_begin')
+        if date_begin:
+            qs = qs.filter(date__gte=date_begin)
+        date_end = self.request.query_params.get('date_end')
+        if date_end:
+            qs = qs.filter(date__lte=date_end)
+        return qs
+
+
+class RequestMetricViewSet(viewsets.ViewSet):
+    """ 当前进程各接口的查询数、数据库耗时和总耗时分布，需开启 QUERY_METRICS_ENABLED """
+    permission_classes = [p.IsAdminUser]
+
+    def list(self, request):
+        return Response(data=metrics.get_registry().snapshot())
+
+    @list_route(methods=['POST'])
+    def reset(self, request):
+        metrics.get_registry().reset()
+        return Response(data=True)
+
+
 class OptionViewSet(viewsets.ModelViewSet):
     filter_fields = '__all__'
-    queryset = m.Option.objects.all()
+    queryset = m.Option.objects.exclude(key=m.OptionCache.VERSION_KEY)
     serializer_class = s.OptionSerializer
     permission_classes = [p.IsAdminOrReadOnly]
 
     @list_route(methods=['GET'])
     def all(self, request):
         data = dict()
-        for opt in m.Option.objects.all():
+        for opt in m.Option.objects.exclude(key=m.OptionCache.VERSION_KEY):
             data[opt.key] = opt.value
         return Response(data=data)
 
+    @list_route(methods=['GET'], permission_classes=[p.IsAdminUser])
+    def cache_stats(self, request):
+        """ 当前进程的选项缓存命中统计
+        """
+        return Response(data=m.OptionCache.stats())
+
     @list_route(methods=['GET'])
     def get(self, request):
         return Response(data=m.Option.get(request.GET.get('name')))
@@ -3655,114 +3438,16 @@ class LoginRecordViewSet(viewsets.ModelViewSet):
             return response_fail('請填寫完整的時間區間')
         begin = datetime.strptime(time_begin, '%Y-%m-%d')
         end = datetime.strptime(time_end, '%Y-%m-%d')
-        duration = end - begin
-        data = None
-        labels = []
-        amounts = []
-        if duration.days < 31:
-            for i in range(duration.days + 1):
-                label_item = '{}月{}號'.format(
-                    (begin + timedelta(days=i)).month, (begin + timedelta(days=i)).day)
-                amount_item = m.LoginRecord.objects.filter(
-                    date_login__gt=begin + timedelta(days=i),
-                    date_login__lt=begin + timedelta(days=i + 1)
-                ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        elif 31 < duration.days < 62:
-            for i in range(int(duration.days / 7)):
-                label_item = '{}月{}號 - {}月{}號'.format(
-                    (begin + timedelta(days=i * 7)).month,
-                    (begin + timedelta(days=i * 7)).day,
-                    (begin + timedelta(days=(i + 1) * 7)).month,
-                    (begin + timedelta(days=(i + 1) * 7)).day,
-                )
-                amount_item = m.LoginRecord.objects.filter(
-                    date_login__gt=begin + timedelta(days=i * 7),
-                    date_login__lt=begin + timedelta(days=(i + 1) * 7)
-                ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-                if i == int(duration.days / 7) - 1 and duration.days % 7 > 0:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        (begin + timedelta(days=(i + 1) * 7)).month,
-                        (begin + timedelta(days=(i + 1) * 7)).day,
-                        end.month,
-                        end.day,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=begin + timedelta(days=(i + 1) * 7),
-                        date_login__lt=end + timedelta(days=1),
-                    ).count()
-                    labels.append(label_item)
-                    amounts.append(amount_item)
-        elif 62 < duration.days <= 366:
-            for i in range(int(duration.days / 31) + 2):
-                if i == 0 and begin.day != 1:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        begin.month,
-                        begin.day,
-                        1 if begin.month == 12 else begin.month + 1,
-                        1,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=begin,
-                        date_login__lt=datetime(begin.year + 1, 1, 1) if begin.month == 12 else datetime(
-                            begin.year, begin.month + 1, 1),
-                    ).count()
-                elif i == int(duration.days / 31) + 1:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        1 if begin.month + i == 12 else (begin.month + i) % 12,
-                        1,
-                        end.month,
-                        end.day,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=datetime(begin.year + 1, (begin.month + i) % 12,
-                                                1) if begin.month + i > 12 else datetime(begin.year,
-                                                                                         begin.month + i, 1),
-                        date_login__lt=end + timedelta(days=1)
-                    ).count()
-                else:
-                    label_item = '{}月1號 - {}月1號'.format(
-                        begin.month + i if begin.month + i <= 12 else (begin.month + i) % 12,
-                        begin.month + i + 1 if begin.month + i + 1 <= 12 else (begin.month + i + 1) % 12,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=datetime(begin.year + 1, (begin.month + i) % 12,
-                                                1) if begin.month + i > 12 else datetime(
-                            begin.year, begin.month + i, 1),
-                        date_login__lt=datetime(begin.year + 1, (begin.month + i + 1) % 12,
-                                                1) if begin.month + i + 1 > 12 else datetime(
-                            begin.year, begin.month + i + 1, 1),
-                    ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        else:
-            for i in range(int(duration.days / 365) + 1):
-                label_item = '{}年'.format(begin.year + i)
-                if i == 0:
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_created__gt=begin,
-                        date_created__lt=datetime(begin.year + 1, 1, 1)
-                    ).count()
-                elif i == duration.days / 365:
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_created__gt=datetime(begin.year + i, 1, 1),
-                        date_created__lt=end,
-                    ).count()
-                else:
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_created__gt=datetime(begin.year + i, 1, 1),
-                        date_created__lt=datetime(begin.year + i + 1, 1, 1),
-                    ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        data = dict(
-            labels=labels,
-            amounts=amounts,
-        )
-        return Response(data=data)
+        if timeseries.get_granularity(begin, end) == timeseries.GRANULARITY_DAY:
+            return Response(data=timeseries.get_chart_data(
+                m.DailyStatistic.objects.all(), 'date', begin, end + timedelta(days=1),
+                value=models.Sum('active_count'),
+            ))
+        # 按周、月、年统计时同一用户在多天登录只算一次，不能累加每日活跃数
+        return Response(data=timeseries.get_chart_data(
+            m.LoginRecord.objects.all(), 'date_login', begin, end + timedelta(days=1),
+            value=models.Count('author', distinct=True),
+        ))
 
     @list_route(methods=['GET'])
     def get_remain_chart_data(self, request):
@@ -3775,118 +3460,12 @@ class LoginRecordViewSet(viewsets.ModelViewSet):
         time_end = self.request.query_params.get('time_end')
         if not time_begin or not time_end:
             return response_fail('請填寫完整的時間區間')
-        days = int(self.request.query_params.get('days'))
-        print(days)
         begin = datetime.strptime(time_begin, '%Y-%m-%d')
         end = datetime.strptime(time_end, '%Y-%m-%d')
-        duration = end - begin
-        data = None
-        labels = []
-        amounts = []
-        if duration.days < 31:
-            for i in range(duration.days + 1):
-                label_item = '{}月{}號'.format(
-                    (begin + timedelta(days=i)).month, (begin + timedelta(days=i)).day)
-                amount_item = m.LoginRecord.objects.filter(
-                    date_login__gt=begin + timedelta(days=i),
-                    date_login__lt=begin + timedelta(days=i + 1)
-                ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        elif 31 < duration.days < 62:
-            for i in range(int(duration.days / 7)):
-                label_item = '{}月{}號 - {}月{}號'.format(
-                    (begin + timedelta(days=i * 7)).month,
-                    (begin + timedelta(days=i * 7)).day,
-                    (begin + timedelta(days=(i + 1) * 7)).month,
-                    (begin + timedelta(days=(i + 1) * 7)).day,
-                )
-                amount_item = m.LoginRecord.objects.filter(
-                    date_login__gt=begin + timedelta(days=i * 7),
-                    date_login__lt=begin + timedelta(days=(i + 1) * 7)
-                ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-                if i == int(duration.days / 7) - 1 and duration.days % 7 > 0:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        (begin + timedelta(days=(i + 1) * 7)).month,
-                        (begin + timedelta(days=(i + 1) * 7)).day,
-                        end.month,
-                        end.day,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=begin + timedelta(days=(i + 1) * 7),
-                        date_login__lt=end + timedelta(days=1),
-                    ).count()
-                    labels.append(label_item)
-                    amounts.append(amount_item)
-        elif 62 < duration.days <= 366:
-            for i in range(int(duration.days / 31) + 2):
-                if i == 0 and begin.day != 1:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        begin.month,
-                        begin.day,
-                        1 if begin.month == 12 else begin.month + 1,
-                        1,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=begin,
-                        date_login__lt=datetime(begin.year + 1, 1, 1) if begin.month == 12 else datetime(
-                            begin.year, begin.month + 1, 1),
-                    ).count()
-                elif i == int(duration.days / 31) + 1:
-                    label_item = '{}月{}號 - {}月{}號'.format(
-                        1 if begin.month + i == 12 else (begin.month + i) % 12,
-                        1,
-                        end.month,
-                        end.day,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=datetime(begin.year + 1, (begin.month + i) % 12,
-                                                1) if begin.month + i > 12 else datetime(begin.year,
-                                                                                         begin.month + i, 1),
-                        date_login__lt=end + timedelta(days=1)
-                    ).count()
-                else:
-                    label_item = '{}月1號 - {}月1號'.format(
-                        begin.month + i if begin.month + i <= 12 else (begin.month + i) % 12,
-                        begin.month + i + 1 if begin.month + i + 1 <= 12 else (begin.month + i + 1) % 12,
-                    )
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_login__gt=datetime(begin.year + 1, (begin.month + i) % 12,
-                                                1) if begin.month + i > 12 else datetime(
-                            begin.year, begin.month + i, 1),
-                        date_login__lt=datetime(begin.year + 1, (begin.month + i + 1) % 12,
-                                                1) if begin.month + i + 1 > 12 else datetime(
-                            begin.year, begin.month + i + 1, 1),
-                    ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        else:
-            for i in range(int(duration.days / 365) + 1):
-                label_item = '{}年'.format(begin.year + i)
-                if i == 0:
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_created__gt=begin,
-                        date_created__lt=datetime(begin.year + 1, 1, 1)
-                    ).count()
-                elif i == duration.days / 365:
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_created__gt=datetime(begin.year + i, 1, 1),
-                        date_created__lt=end,
-                    ).count()
-                else:
-                    amount_item = m.LoginRecord.objects.filter(
-                        date_created__gt=datetime(begin.year + i, 1, 1),
-                        date_created__lt=datetime(begin.year + i + 1, 1, 1),
-                    ).count()
-                labels.append(label_item)
-                amounts.append(amount_item)
-        data = dict(
-            labels=labels,
-            amounts=amounts,
-        )
-        return Response(data=data)
+        return Response(data=timeseries.get_chart_data(
+            m.DailyStatistic.objects.all(), 'date', begin, end + timedelta(days=1),
+            value=models.Sum('login_count'),
+        ))
 
 
 class PaymentRecordViewSet(viewsets.ModelViewSet):
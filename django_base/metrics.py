@@ -0,0 +1,141 @@
+""" 接口性能统计
+
+QueryMetricsMiddleware 按接口（ViewSet 类名.action）记录每次请求的 SQL 查询数、
+数据库耗时和总耗时，按固定分桶累计为直方图，保存在进程内，
+多进程部署时每个 worker 各自统计。
+
+settings:
+    QUERY_METRICS_ENABLED      是否启用，默认关闭
+    QUERY_METRICS_SAMPLE_RATE  采样比例，默认 1 即全部记录
+"""
+import random
+from bisect import bisect_left
+from threading import RLock
+
+from django.conf import settings
+
+# 查询数分桶上界
+QUERY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+
+# 耗时分桶上界（毫秒）
+TIME_BUCKETS = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+
+def is_enabled():
+    return getattr(settings, 'QUERY_METRICS_ENABLED', False)
+
+
+def is_sampled():
+    return random.random() < getattr(settings, 'QUERY_METRICS_SAMPLE_RATE', 1)
+
+
+def get_view_key(view_func, method):
+    """ 接口标识，ViewSet 为 类名.action，其他视图为函数名
+    :param view_func: URL 解析得到的视图函数
+    :param method: HTTP 方法
+    """
+    cls = getattr(view_func, 'cls', None)
+    if cls is None:
+        return getattr(view_func, '__name__', str(view_func))
+    actions = getattr(view_func, 'actions', None) or dict()
+    return '{}.{}'.format(cls.__name__, actions.get(method.lower(), method.lower()))
+
+
+class Histogram:
+    """ 固定分桶的直方图，最后一个桶收集超过最大上界的值 """
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.max = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """ 分位数所在分桶的上界，落在最后一个桶时返回最大值 """
+        rank = q * self.count
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if count and total >= rank:
+                return self.buckets[i] if i < len(self.buckets) else self.max
+        return 0
+
+    def as_dict(self):
+        return dict(
+            buckets=[
+                dict(le=le, count=count)
+                for le, count in zip(list(self.buckets) + ['+Inf'], self.counts)
+            ],
+            avg=round(self.sum / self.count, 2) if self.count else 0,
+            p50=self.quantile(0.5),
+            p95=self.quantile(0.95),
+            p99=self.quantile(0.99),
+            max=round(self.max, 2),
+        )
+
+
+class EndpointMetrics:
+    def __init__(self):
+        self.queries = Histogram(QUERY_BUCKETS)
+        self.db_time = Histogram(TIME_BUCKETS)
+        self.wall_time = Histogram(TIME_BUCKETS)
+
+    def observe(self, queries, db_time, wall_time):
+        self.queries.observe(queries)
+        self.db_time.observe(db_time)
+        self.wall_time.observe(wall_time)
+
+
+class MetricsRegistry:
+    """ 进程内的接口统计 """
+
+    def __init__(self):
+        self.lock = RLock()
+        self.endpoints = dict()
+
+    def record(self, key, queries, db_time, wall_time):
+        """ 记录一次请求
+        :param key: 接口标识
+        :param queries: 查询数
+        :param db_time: 数据库耗时（毫秒）
+        :param wall_time: 总耗时（毫秒）
+        """
+        with self.lock:
+            endpoint = self.endpoints.get(key)
+            if endpoint is None:
+                endpoint = self.endpoints[key] = EndpointMetrics()
+            endpoint.observe(queries, db_time, wall_time)
+
+    def snapshot(self):
+        """ 按总耗时从大到小排列的各接口统计 """
+        with self.lock:
+            items = [
+                dict(
+                    endpoint=key,
+                    count=endpoint.queries.count,
+                    queries=endpoint.queries.as_dict(),
+                    db_time=endpoint.db_time.as_dict(),
+                    wall_time=endpoint.wall_time.as_dict(),
+                    total_wall_time=round(endpoint.wall_time.sum, 2),
+                )
+                for key, endpoint in self.endpoints.items()
+            ]
+        return sorted(items, key=lambda item: -item['total_wall_time'])
+
+    def reset(self):
+        with self.lock:
+            self.endpoints = dict()
+
+
+_registry = MetricsRegistry()
+
+
+def get_registry():
+    return _registry
@@ -1,4 +1,5 @@
 from threading import currentThread
+from time import time
 from django.utils.deprecation import MiddlewareMixin
 
 _requests = {}
@@ -47,6 +48,44 @@ class CookieCsrfMiddleware(MiddlewareMixin):
             request.META['HTTP_X_CSRFTOKEN'] = csrftoken
 
 
+class QueryMetricsMiddleware(MiddlewareMixin):
+    """ 记录每个接口的查询数、数据库耗时和总耗时，统计结果见 django_base.metrics
+    QUERY_METRICS_ENABLED 为真时才启用，期间强制记录 SQL 以统计数量和耗时
+    """
+
+    def process_request(self, request):
+        from django.db import connection
+        from . import metrics
+        if not metrics.is_enabled() or not metrics.is_sampled():
+            return
+        request._metrics = (time(), len(connection.queries_log), connection.force_debug_cursor)
+        connection.force_debug_cursor = True
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        from . import metrics
+        if hasattr(request, '_metrics'):
+            request._metrics_key = metrics.get_view_key(view_func, request.method)
+
+    def process_response(self, request, response):
+        from django.db import connection
+        from . import metrics
+        state = getattr(request, '_metrics', None)
+        if state is None:
+            return response
+        date_begin, offset, force_debug_cursor = state
+        connection.force_debug_cursor = force_debug_cursor
+        key = getattr(request, '_metrics_key', None)
+        if key:
+            queries = list(connection.queries_log)[offset:]
+            metrics.get_registry().record(
+                key,
+                len(queries),
+                sum(float(query['time']) for query in queries) * 1000,
+                (time() - date_begin) * 1000,
+            )
+        return response
+
+
 class DebugMiddleware(MiddlewareMixin):
     def process_request(self, request):
         pass
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_base', '0012_comment_is_read'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='plannedtask',
+            name='attempts',
+            field=models.IntegerField(default=0, verbose_name='已执行次数'),
+        ),
+        migrations.AddField(
+            model_name='plannedtask',
+            name='worker',
+            field=models.CharField(blank=True, default='', help_text='认领任务的执行批次标识', max_length=50, verbose_name='执行者'),
+        ),
+        migrations.AddField(
+            model_name='plannedtask',
+            name='date_claimed',
+            field=models.DateTimeField(blank=True, null=True, verbose_name='认领时间'),
+        ),
+        migrations.AlterIndexTogether(
+            name='plannedtask',
+            index_together=set([('status', 'date_planned')]),
+        ),
+    ]
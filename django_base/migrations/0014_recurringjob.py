@@ -0,0 +1,58 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+RECURRING_METHODS = (
+    'update_rank_record',
+    'update_member_check_history',
+    'settle_activity',
+    'update_live_hot_ranking',
+    'update_live_end',
+    'update_live_log_leave',
+    'compact_planned_tasks',
+)
+
+
+def remove_planned_occurrences(apps, schema_editor):
+    """ 周期任务改由 RecurringJob 调度，清除旧方式预先排好的计划任务 """
+    PlannedTask = apps.get_model('django_base', 'PlannedTask')
+    PlannedTask.objects.filter(
+        method__in=RECURRING_METHODS,
+        status='PLANNED',
+    ).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_base', '0013_plannedtask_claim'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='RecurringJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('method', models.CharField(max_length=100, unique=True, verbose_name='任务')),
+                ('interval', models.IntegerField(blank=True, help_text='单位（秒），与 cron 二选一', null=True, verbose_name='执行间隔')),
+                ('cron', models.CharField(blank=True, default='', max_length=100, verbose_name='cron 表达式')),
+                ('date_next', models.DateTimeField(db_index=True, verbose_name='下次执行时间')),
+                ('worker', models.CharField(blank=True, default='', max_length=50, verbose_name='执行者')),
+                ('date_locked', models.DateTimeField(blank=True, null=True, verbose_name='开始执行时间')),
+                ('date_last_run', models.DateTimeField(blank=True, null=True, verbose_name='上次执行时间')),
+                ('last_lag', models.FloatField(default=0, help_text='实际开始时间与计划时间之差，单位（秒）', verbose_name='上次延迟')),
+                ('last_runtime', models.FloatField(default=0, help_text='单位（秒）', verbose_name='上次耗时')),
+                ('max_runtime', models.FloatField(default=0, help_text='单位（秒）', verbose_name='最长耗时')),
+                ('run_count', models.IntegerField(default=0, verbose_name='执行次数')),
+                ('fail_count', models.IntegerField(default=0, verbose_name='失败次数')),
+                ('traceback', models.TextField(blank=True, default='', verbose_name='上次错误信息')),
+            ],
+            options={
+                'verbose_name': '周期任务',
+                'verbose_name_plural': '周期任务',
+                'db_table': 'base_cron_recurring_job',
+            },
+        ),
+        migrations.RunPython(remove_planned_occurrences, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_base', '0014_recurringjob'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='broadcast',
+            name='delivery',
+            field=models.CharField(choices=[('PUSH', '推送时写入'), ('PULL', '阅读时拉取')], default='PUSH', help_text='面向全体用户的系统、活动推送只保存一份，用户读取消息时才写入其收件箱', max_length=20, verbose_name='送达方式'),
+        ),
+    ]
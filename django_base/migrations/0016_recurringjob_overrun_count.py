@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('django_base', '0015_broadcast_delivery'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recurringjob',
+            name='overrun_count',
+            field=models.IntegerField(default=0, help_text='锁超时被释放后才执行完毕的次数，期间可能有其他执行者重复执行', verbose_name='超时执行次数'),
+        ),
+        migrations.AlterField(
+            model_name='recurringjob',
+            name='date_locked',
+            field=models.DateTimeField(blank=True, help_text='执行期间定期刷新，超过 TIMEOUT 没有刷新视为执行者已退出', null=True, verbose_name='锁定时间'),
+        ),
+    ]
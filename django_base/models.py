@@ -4,9 +4,14 @@ import os
 import os.path
 import random
 
+from contextlib import contextmanager
+from threading import Event, Thread
+from time import time
+from uuid import uuid4
 from datetime import datetime, timedelta
 
 from django.db import models
+from django.db.models.functions import Concat, Greatest
 from django.conf import settings
 from django.contrib.staticfiles.templatetags.staticfiles import static
 from django.contrib.auth.models import User, Group, Permission
@@ -871,6 +876,27 @@ class Broadcast(AbstractMessageModel):
         blank=True,
     )
 
+    DELIVERY_PUSH = 'PUSH'
+    DELIVERY_PULL = 'PULL'
+    DELIVERY_CHOICES = (
+        (DELIVERY_PUSH, '推送时写入'),
+        (DELIVERY_PULL, '阅读时拉取'),
+    )
+
+    delivery = models.CharField(
+        verbose_name='送达方式',
+        max_length=20,
+        choices=DELIVERY_CHOICES,
+        default=DELIVERY_PUSH,
+        help_text='面向全体用户的系统、活动推送只保存一份，用户读取消息时才写入其收件箱',
+    )
+
+    # 没有指定推送用户和推送组时，可以按阅读时拉取送达的推送目标
+    PULL_TARGETS = (TARGET_SYSTEM, TARGET_SYSTEM_FAMILYS, TARGET_SYSTEM_NOT_FAMILYS, TARGET_ACTIVITY)
+
+    # 推送时写入的消息每批插入的行数
+    CHUNK_SIZE = 1000
+
     class Meta:
         verbose_name = '消息推送'
         verbose_name_plural = '消息推送'
@@ -894,17 +920,29 @@ class Broadcast(AbstractMessageModel):
         if self.status == self.STATUS_DONE:
             raise ValidationError('消息已推送，不能重复操作。')
 
-        for user in self.get_recipients():
-            self.messages.create(
-                receiver=user,
-                # name=self.name,
+        if self.target in self.PULL_TARGETS and not self.users.exists() and not self.groups.exists():
+            # 全体推送不逐个写入消息，由 Conversation.deliver_broadcasts 在用户读取时写入
+            self.delivery = self.DELIVERY_PULL
+            self.status = self.STATUS_DONE
+            self.date_sent = datetime.now()
+            self.save()
+            return
+
+        user_ids = list(self.get_recipients().values_list('id', flat=True))
+        for i in range(0, len(user_ids), self.CHUNK_SIZE):
+            Message.objects.bulk_create([Message(
+                broadcast=self,
+                receiver_id=user_id,
                 content=self.content,
                 params=self.params,
-            )
-            # TODO: 特殊发送渠道需要外接触发实现
+            ) for user_id in user_ids[i:i + self.CHUNK_SIZE]])
+        # TODO: 特殊发送渠道需要外接触发实现
+        self.delivery = self.DELIVERY_PUSH
         self.status = self.STATUS_DONE
         self.date_sent = datetime.now()
         self.save()
+        from core.models import Conversation
+        Conversation.on_broadcast(self, user_ids)
 
 
 class AddressDistrict(HierarchicalModel):
@@ -1153,6 +1191,104 @@ class Menu(HierarchicalModel, models.Model):
         return '%s: %s' % (self.name, self.title)
 
 
+class OptionCache:
+    """ 系统选项的进程内缓存
+    首次读取时一次性载入全部选项，JSON 选项解析后的结果也一并缓存。
+    选项写入时更新版本戳（settings_option 中 key 为 __version__ 的记录），
+    各 worker 每隔 OPTION_CACHE_CHECK_INTERVAL 秒（默认 1 秒）检查一次版本戳，
+    发现变化即清空本进程缓存
+    """
+    VERSION_KEY = '__version__'
+
+    values = None
+    parsed = dict()
+    version = None
+    date_checked = 0
+
+    hits = 0
+    misses = 0
+    reloads = 0
+
+    @classmethod
+    def clear(cls):
+        cls.values = None
+        cls.parsed = dict()
+
+    @classmethod
+    def reset(cls):
+        """ 清空缓存并遗忘版本戳，下次读取时重新检查
+        测试之间数据库回滚后版本戳也随之回滚，需要调用此方法，见 django_base.testing.TestRunner
+        """
+        cls.clear()
+        cls.version = None
+        cls.date_checked = 0
+
+    @classmethod
+    def check_version(cls):
+        now = time()
+        if now - cls.date_checked < getattr(settings, 'OPTION_CACHE_CHECK_INTERVAL', 1):
+            return
+        cls.date_checked = now
+        version = Option.objects.filter(
+            key=cls.VERSION_KEY,
+        ).values_list('value', flat=True).first()
+        if version != cls.version:
+            cls.version = version
+            cls.clear()
+
+    @classmethod
+    def bump(cls):
+        """ 更新版本戳，使所有进程的缓存失效
+        """
+        version = uuid4().hex
+        if not Option.objects.filter(key=cls.VERSION_KEY).update(value=version):
+            # 直接插入，避免再次触发 Option.save
+            Option.objects.bulk_create([Option(key=cls.VERSION_KEY, value=version)])
+        cls.clear()
+        cls.version = version
+        cls.date_checked = time()
+
+    @classmethod
+    def get(cls, key):
+        cls.check_version()
+        values = cls.values
+        if values is None:
+            cls.misses += 1
+            cls.reloads += 1
+            values = dict(Option.objects.exclude(
+                key=cls.VERSION_KEY,
+            ).values_list('key', 'value'))
+            cls.values = values
+        else:
+            cls.hits += 1
+        return values.get(key)
+
+    @classmethod
+    def get_json(cls, key, default=None):
+        value = cls.get(key)
+        if not value:
+            return default
+        cached = cls.parsed.get(key)
+        if cached and cached[0] == value:
+            return cached[1]
+        data = json.loads(value)
+        cls.parsed[key] = (value, data)
+        return data
+
+    @classmethod
+    def stats(cls):
+        """ 缓存命中统计
+        :return: dict
+        """
+        return dict(
+            hits=cls.hits,
+            misses=cls.misses,
+            reloads=cls.reloads,
+            version=cls.version,
+            size=len(cls.values or []),
+        )
+
+
 class Option(models.Model):
     """
     选项
@@ -1181,8 +1317,16 @@ class Option(models.Model):
         :param key: 选项的关键字
         :return: 匹配到的选项值，如果没有此选项，返回 None
         """
-        opt = cls.objects.filter(key=key).first()
-        return opt and opt.value
+        return OptionCache.get(key)
+
+    @classmethod
+    def get_json(cls, key, default=None):
+        """ 获取 JSON 格式的选项值，解析结果会被缓存，调用方不应修改返回的对象
+        :param key: 选项的关键字
+        :param default: 没有此选项或选项为空时的返回值
+        :return: 解析后的选项值
+        """
+        return OptionCache.get_json(key, default)
 
     @classmethod
     def unset(cls, key):
@@ -1191,6 +1335,7 @@ class Option(models.Model):
         :return: 没有返回值
         """
         cls.objects.filter(key=key).delete()
+        OptionCache.bump()
 
     @classmethod
     def set(cls, key, val):
@@ -1206,6 +1351,14 @@ class Option(models.Model):
         opt.value = val or ''
         opt.save()
 
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        OptionCache.bump()
+
+    def delete(self, *args, **kwargs):
+        super().delete(*args, **kwargs)
+        OptionCache.bump()
+
     def __str__(self):
         return '{}: {}'.format(self.key, self.value)
 
@@ -1284,6 +1437,9 @@ class Contact(UserOwnedModel):
                 content_type=ContentType.objects.get(model='member'),
                 object_id=self.user.id,
             )
+            from core.models import Follow
+            Follow.set(self.user, self.author)
+            Follow.set(self.author, self.user)
         super().save(*args, **kwargs)
 
 
@@ -1401,8 +1557,8 @@ class UserMarkableModel(models.Model):
         mark = UserMark.objects.filter(**fields).first()
         if is_marked:
             if not mark:
-                UserMark.objects.create(**fields)
-        else:
+                return UserMark.objects.create(**fields)
+        elif mark:
             mark.delete()
 
     @classmethod
@@ -1551,6 +1707,30 @@ class UserPreference(models.Model):
         pref.save()
 
 
+@contextmanager
+def keep_alive(queryset, field, interval):
+    """ with 块执行期间，由后台线程每 interval 秒把 queryset 中各行的 field 刷新为当前时间
+    执行中的任务以此作为心跳，超时释放只回收真正已经退出的执行者，长任务不会被并发重复执行
+    """
+    stop = Event()
+
+    def beat():
+        from django.db import connection
+        try:
+            while not stop.wait(interval):
+                queryset.update(**{field: datetime.now()})
+        finally:
+            connection.close()
+
+    thread = Thread(target=beat, daemon=True)
+    thread.start()
+    try:
+        yield
+    finally:
+        stop.set()
+        thread.join()
+
+
 class PlannedTask(models.Model):
     method = models.CharField(
         verbose_name='任务',
@@ -1588,10 +1768,12 @@ class PlannedTask(models.Model):
     )
 
     STATUS_PLANNED = 'PLANNED'
+    STATUS_RUNNING = 'RUNNING'
     STATUS_DONE = 'DONE'
     STATUS_FAIL = 'FAIL'
     STATUS_CHOICES = (
         (STATUS_PLANNED, '计划中'),
+        (STATUS_RUNNING, '执行中'),
         (STATUS_DONE, '执行成功'),
         (STATUS_FAIL, '失败'),
     )
@@ -1602,10 +1784,30 @@ class PlannedTask(models.Model):
         default=STATUS_PLANNED,
     )
 
+    attempts = models.IntegerField(
+        verbose_name='已执行次数',
+        default=0,
+    )
+
+    worker = models.CharField(
+        verbose_name='执行者',
+        max_length=50,
+        blank=True,
+        default='',
+        help_text='认领任务的执行批次标识',
+    )
+
+    date_claimed = models.DateTimeField(
+        verbose_name='认领时间',
+        blank=True,
+        null=True,
+    )
+
     class Meta:
         verbose_name = '计划任务'
         verbose_name_plural = '计划任务'
         db_table = 'base_cron_planned_task'
+        index_together = (('status', 'date_planned'),)
 
     @staticmethod
     def make(method, date_planned, *args, **kwargs):
@@ -1617,17 +1819,159 @@ class PlannedTask(models.Model):
         )
 
     @staticmethod
-    def trigger_all():
-        tasks = PlannedTask.objects.filter(
+    def get_config(key, default):
+        """ 任务执行器配置，从 settings.PLANNED_TASK 读取
+        WORKERS: 并发数；POOL: thread / process；BATCH_SIZE: 每次认领数量；
+        MAX_ATTEMPTS: 最多执行次数；RETRY_DELAY: 首次重试间隔秒数，之后按指数增长；
+        TIMEOUT: 执行中超过此秒数没有心跳视为执行者已退出，重新放回队列；
+        HEARTBEAT: 执行期间刷新认领时间的间隔秒数，默认为 TIMEOUT 的三分之一；
+        CONCURRENCY: {method: 同时执行的上限}；
+        RETENTION_DAYS: 成功任务保留天数；FAIL_RETENTION_DAYS: 失败任务保留天数
+        """
+        return getattr(settings, 'PLANNED_TASK', {}).get(key, default)
+
+    @staticmethod
+    def get_heartbeat():
+        return PlannedTask.get_config('HEARTBEAT', PlannedTask.get_config('TIMEOUT', 600) / 3)
+
+    @staticmethod
+    def release_timeout():
+        """ 执行者中途退出时，超时的执行中任务重新放回队列
+        执行中的任务由 keep_alive 定期刷新认领时间，超时意味着执行者已经不在了
+        :return: 放回的任务数
+        """
+        date_limit = datetime.now() - timedelta(seconds=PlannedTask.get_config('TIMEOUT', 600))
+        return PlannedTask.objects.filter(
+            status=PlannedTask.STATUS_RUNNING,
+            date_claimed__lt=date_limit,
+        ).update(status=PlannedTask.STATUS_PLANNED, worker='')
+
+    @staticmethod
+    def claim(limit):
+        """ 认领到期的任务
+        通过一条带状态条件的 UPDATE 认领，重叠执行的进程不会拿到同一个任务
+        method 有并发上限的，按当前执行中的数量扣减可认领数
+        :param limit: 最多认领数量
+        :return: 认领到的任务列表
+        """
+        now = datetime.now()
+        concurrency = PlannedTask.get_config('CONCURRENCY', {})
+        quota = dict()
+        if concurrency:
+            running = dict(PlannedTask.objects.filter(
+                status=PlannedTask.STATUS_RUNNING,
+                method__in=list(concurrency.keys()),
+            ).values_list('method').annotate(count=models.Count('id')))
+            quota = {method: limit - running.get(method, 0) for method, limit in concurrency.items()}
+        candidates = PlannedTask.objects.filter(
             status=PlannedTask.STATUS_PLANNED,
-            date_planned__lte=datetime.now(),
-        )
-        for task in tasks:
-            task.exec()
+            date_planned__lte=now,
+        ).order_by('date_planned', 'id').values_list('id', 'method')
+        ids = []
+        # 有并发上限时多取一些候选，避免被受限的 method 占满
+        for pk, method in candidates[:limit * 4 if quota else limit]:
+            if method in quota:
+                if quota[method] <= 0:
+                    continue
+                quota[method] -= 1
+            ids.append(pk)
+            if len(ids) >= limit:
+                break
+        if not ids:
+            return []
+        worker = uuid4().hex
+        PlannedTask.objects.filter(
+            pk__in=ids,
+            status=PlannedTask.STATUS_PLANNED,
+        ).update(status=PlannedTask.STATUS_RUNNING, worker=worker, date_claimed=now)
+        return list(PlannedTask.objects.filter(worker=worker, status=PlannedTask.STATUS_RUNNING))
+
+    @staticmethod
+    def run_claimed(task_ids):
+        """ 在执行池中执行已认领的任务，进程池中的子进程只接收 id """
+        from django.db import connection
+        try:
+            for task in PlannedTask.objects.filter(pk__in=task_ids):
+                task.exec()
+        finally:
+            connection.close()
+
+    @staticmethod
+    def run_due(workers=None, pool=None, batch_size=None):
+        """ 认领并执行到期任务，直到没有可执行的任务
+        :param workers: 并发数，默认 PLANNED_TASK['WORKERS']
+        :param pool: thread / process，默认 PLANNED_TASK['POOL']
+        :param batch_size: 每次认领的数量
+        :return: 执行的任务数
+        """
+        workers = workers or PlannedTask.get_config('WORKERS', 4)
+        pool = pool or PlannedTask.get_config('POOL', 'thread')
+        batch_size = batch_size or PlannedTask.get_config('BATCH_SIZE', 100)
+        PlannedTask.release_timeout()
+        executed = 0
+        while True:
+            tasks = PlannedTask.claim(batch_size)
+            if not tasks:
+                return executed
+            executed += len(tasks)
+            with keep_alive(PlannedTask.objects.filter(
+                    worker=tasks[0].worker,
+                    status=PlannedTask.STATUS_RUNNING,
+            ), 'date_claimed', PlannedTask.get_heartbeat()):
+                PlannedTask.run_batch(tasks, workers, pool)
+
+    @staticmethod
+    def run_batch(tasks, workers, pool):
+        """ 执行一批已认领的任务 """
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+        from django.db import connections
+        if workers <= 1:
+            for task in tasks:
+                task.exec()
+            return
+        # 每个执行单元一次拿一组，减少进程池的序列化开销
+        chunks = [[task.id for task in tasks[i::workers]] for i in range(workers)]
+        chunks = [chunk for chunk in chunks if chunk]
+        if pool == 'process':
+            # 子进程不能复用父进程的数据库连接
+            connections.close_all()
+            executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            for future in [executor.submit(PlannedTask.run_claimed, chunk) for chunk in chunks]:
+                future.result()
+
+    @staticmethod
+    def trigger_all():
+        return PlannedTask.run_due()
+
+    @staticmethod
+    def compact(chunk_size=1000):
+        """ 按保留策略清理已结束的任务
+        :return: 删除的任务数
+        """
+        now = datetime.now()
+        deleted = 0
+        for status, days in (
+                (PlannedTask.STATUS_DONE, PlannedTask.get_config('RETENTION_DAYS', 7)),
+                (PlannedTask.STATUS_FAIL, PlannedTask.get_config('FAIL_RETENTION_DAYS', 30)),
+        ):
+            qs = PlannedTask.objects.filter(
+                status=status,
+                date_planned__lt=now - timedelta(days=days),
+            )
+            while True:
+                ids = list(qs.values_list('id', flat=True)[:chunk_size])
+                if not ids:
+                    break
+                deleted += PlannedTask.objects.filter(pk__in=ids).delete()[0]
+        return deleted
 
     def exec(self):
         if self.status == self.STATUS_DONE or self.date_planned > datetime.now():
             return False
+        self.attempts += 1
         try:
             args = json.loads(self.args or '[]')
             kwargs = json.loads(self.kwargs or '{}')
@@ -1636,14 +1980,49 @@ class PlannedTask(models.Model):
             self.status = self.STATUS_DONE
         except Exception as e:
             import traceback
-            self.status = self.STATUS_FAIL
             self.traceback = traceback.format_exc()
+            if self.attempts < self.get_config('MAX_ATTEMPTS', 3):
+                # 指数退避后重新排队
+                self.status = self.STATUS_PLANNED
+                self.date_planned = datetime.now() + timedelta(
+                    seconds=self.get_config('RETRY_DELAY', 30) * 2 ** (self.attempts - 1),
+                )
+            else:
+                self.status = self.STATUS_FAIL
+        worker, self.worker = self.worker, ''
         self.date_execute = datetime.now()
-        self.save()
+        if not worker:
+            self.save()
+        elif not PlannedTask.objects.filter(pk=self.pk, worker=worker).update(
+                status=self.status,
+                attempts=self.attempts,
+                date_planned=self.date_planned,
+                date_execute=self.date_execute,
+                traceback=self.traceback,
+                worker='',
+        ):
+            # 认领已经超时被释放，任务可能已由其他执行者重新执行，不覆盖其状态，只留下记录
+            PlannedTask.objects.filter(pk=self.pk).update(traceback=Concat(
+                models.F('traceback'),
+                models.Value('\n[{}] 执行者 {} 认领超时后才执行完毕（{}），任务可能被重复执行'.format(
+                    self.date_execute.strftime('%Y-%m-%d %H:%M:%S'), worker, self.get_status_display(),
+                )),
+                output_field=models.TextField(),
+            ))
+        return self.status == self.STATUS_DONE
 
     # 具体注册的方法
     # ↓↓↓↓↓↓↓↓↓↓↓↓↓↓
 
+    @staticmethod
+    def noop():
+        """ 空任务，用于测试执行器吞吐量 """
+        pass
+
+    @staticmethod
+    def compact_planned_tasks():
+        print('compact_planned_tasks: deleted {}'.format(PlannedTask.compact()))
+
     @staticmethod
     def update_user_payment_password(user_id, hashed_password):
         """ 更新用户的支付密码
@@ -1656,13 +2035,15 @@ class PlannedTask(models.Model):
     # 更新每个用户的排行榜
     @staticmethod
     def update_rank_record():
-        from core.models import Member, RankRecord
-        for member in Member.objects.all():
-            rank_records = RankRecord.objects.filter(author=member.user)
-            if not rank_records:
-                RankRecord.make(member)
-            for rank_record in rank_records:
-                rank_record.update()
+        from core.models import RankRecord
+        from core import leaderboard
+        RankRecord.update_all()
+        leaderboard.prune()
+
+    @staticmethod
+    def update_daily_statistic():
+        from core.models import DailyStatistic
+        DailyStatistic.update()
 
     @staticmethod
     def update_member_check_history():
@@ -1680,62 +2061,299 @@ class PlannedTask(models.Model):
             activity.settle()
 
     @staticmethod
-    def change_vip_level(member_id_list):
-        # 把vip等级降1，并更新下次降级时间
+    def expire_vip():
+        """ 批量降级 VIP 到期的会员 """
         from core.models import Member
-        member = Member.objects.get(id=member_id_list[0])
-        pre_vip_level = member.vip_level
-        member.vip_level = pre_vip_level - 1
-        if pre_vip_level - 1 >= 0:
-            member.date_update_vip = datetime.now()
-        else:
-            member.date_update_vip = None
-        member.is_vip_demand = False
-        member.save()
-        planned_task = PlannedTask.objects.filter(
-            method='change_vip_level',
-            args__exact=json.dumps([member_id_list[0]]),
-        ).first()
-        # 降为等级0，依然可以有一个月以续费价升vip1的权利
-        if planned_task and pre_vip_level - 1 > 0:
-            planned_task.date_planned = planned_task.date_planned + timedelta(days=30)
-            planned_task.status = PlannedTask.STATUS_PLANNED
-            planned_task.save()
-        # 如果降到没有vip等级，且超过一个月，则删除计划任务
-        else:
-            planned_task.delete()
+        print('expire_vip: downgraded {}'.format(Member.expire_vip()))
 
     @staticmethod
     def update_live_hot_ranking():
-        from core.models import Live
-        for live in Live.objects.all():
-            live.update_hot_rating()
+        """ 更新进行中直播的热度，刚结束的直播再计算一次以固定最终分数
+        """
+        from core.models import Live, LiveCounter
+        weights = LiveCounter.get_weights()
+        lives = Live.objects.filter(
+            models.Q(date_end=None) |
+            models.Q(date_end__gt=datetime.now() - timedelta(minutes=10))
+        ).select_related('counter')
+        for live in lives:
+            live.update_hot_rating(weights)
 
     @staticmethod
     def update_live_end():
+        """ 批量结束超过 6 分钟没有主播响应的直播
+        :return: dict(closed=结束的直播数, seconds=耗时)
+        """
         from core.models import Live
-        limit_date_response = datetime.now() - timedelta(minutes=6)
-        lives = Live.objects.filter(
-            models.Q(date_end=None, date_response=None, date_created__lt=limit_date_response) |
-            models.Q(date_end=None, date_response__lt=limit_date_response)
-        ).all()
-        for live in lives:
-            live.date_end = datetime.now()
-            live.save()
+        time_start = time()
+        closed = Live.close_stale(datetime.now() - timedelta(minutes=6))
+        seconds = time() - time_start
+        print('update_live_end: closed {} lives in {:.3f}s'.format(closed, seconds))
+        return dict(closed=closed, seconds=seconds)
 
     @staticmethod
     def update_live_log_leave():
+        """ 兜底清理：观众超时离开由 core.presence 在 Web 进程中处理，
+        这里批量关闭进程重启等情况下遗留的观看记录
+        :return: dict(closed=关闭的记录数, seconds=耗时)
+        """
         from core.models import LiveWatchLog
-        limit_date_response = datetime.now() - timedelta(minutes=6)
-        logs = LiveWatchLog.objects.filter(
-            models.Q(date_leave=None, date_response=None, date_enter__lt=limit_date_response) |
-            models.Q(date_leave=None, date_response__lt=limit_date_response) |
-            models.Q(date_leave__lt=models.F('date_enter'), date_response=None, date_enter__lt=limit_date_response) |
-            models.Q(date_leave__lt=models.F('date_enter'), date_response__lt=limit_date_response)
-        ).all()
-        for log in logs:
-            log.date_leave = datetime.now()
-            log.save()
+        from core import presence
+        time_start = time()
+        closed = LiveWatchLog.close_stale(datetime.now() - timedelta(seconds=presence.get_ttl()))
+        seconds = time() - time_start
+        print('update_live_log_leave: closed {} logs in {:.3f}s'.format(closed, seconds))
+        return dict(closed=closed, seconds=seconds)
+
+
+class CronExpression:
+    """ 五段式 cron 表达式：分 时 日 月 周（0 为周日）
+    每段支持 *、数字、a-b 范围、逗号列表以及 /n 步长
+    """
+    RANGES = ((0, 59), (0, 23), (1, 31), (1, 12), (0, 6))
+
+    def __init__(self, expression):
+        fields = expression.split()
+        assert len(fields) == 5, 'cron 表达式需要 5 段：{}'.format(expression)
+        self.minutes, self.hours, self.days, self.months, self.weekdays = [
+            self.parse(field, low, high) for field, (low, high) in zip(fields, self.RANGES)
+        ]
+        # 日和周都有限定时满足其一即可，与 crontab 一致
+        self.day_or_weekday = fields[2] != '*' and fields[4] != '*'
+
+    @staticmethod
+    def parse(field, low, high):
+        values = set()
+        for part in field.split(','):
+            step = 1
+            if '/' in part:
+                part, step = part.split('/')
+                step = int(step)
+            if part == '*':
+                start, end = low, high
+            elif '-' in part:
+                start, end = [int(x) for x in part.split('-')]
+            else:
+                start = int(part)
+                end = high if step > 1 else start
+            assert low <= start <= end <= high, 'cron 表达式超出范围：{}'.format(field)
+            values.update(range(start, end + 1, step))
+        return values
+
+    def match_day(self, date):
+        day_ok = date.day in self.days
+        weekday_ok = (date.weekday() + 1) % 7 in self.weekdays
+        if self.day_or_weekday:
+            return day_ok or weekday_ok
+        return day_ok and weekday_ok
+
+    def get_next(self, after):
+        """ after 之后（不含）第一个匹配的时间 """
+        date = after.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        date_limit = date + timedelta(days=366 * 5)
+        while date < date_limit:
+            if date.month not in self.months:
+                date = datetime(date.year + date.month // 12, date.month % 12 + 1, 1)
+            elif not self.match_day(date):
+                date = datetime(date.year, date.month, date.day) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return date
+        raise ValueError('cron 表达式没有可执行的时间')
+
+
+class RecurringJob(models.Model):
+    """ 周期任务
+    由代码中声明的计划表同步而来（见 RecurringJob.sync），执行 PlannedTask 上注册的方法
+    每个任务同一时间只有一个执行者，每个周期只执行一次，错过的周期不补跑
+    """
+    method = models.CharField(
+        verbose_name='任务',
+        max_length=100,
+        unique=True,
+    )
+
+    interval = models.IntegerField(
+        verbose_name='执行间隔',
+        blank=True,
+        null=True,
+        help_text='单位（秒），与 cron 二选一',
+    )
+
+    cron = models.CharField(
+        verbose_name='cron 表达式',
+        max_length=100,
+        blank=True,
+        default='',
+    )
+
+    date_next = models.DateTimeField(
+        verbose_name='下次执行时间',
+        db_index=True,
+    )
+
+    worker = models.CharField(
+        verbose_name='执行者',
+        max_length=50,
+        blank=True,
+        default='',
+    )
+
+    date_locked = models.DateTimeField(
+        verbose_name='锁定时间',
+        blank=True,
+        null=True,
+        help_text='执行期间定期刷新，超过 TIMEOUT 没有刷新视为执行者已退出',
+    )
+
+    date_last_run = models.DateTimeField(
+        verbose_name='上次执行时间',
+        blank=True,
+        null=True,
+    )
+
+    last_lag = models.FloatField(
+        verbose_name='上次延迟',
+        default=0,
+        help_text='实际开始时间与计划时间之差，单位（秒）',
+    )
+
+    last_runtime = models.FloatField(
+        verbose_name='上次耗时',
+        default=0,
+        help_text='单位（秒）',
+    )
+
+    max_runtime = models.FloatField(
+        verbose_name='最长耗时',
+        default=0,
+        help_text='单位（秒）',
+    )
+
+    run_count = models.IntegerField(
+        verbose_name='执行次数',
+        default=0,
+    )
+
+    fail_count = models.IntegerField(
+        verbose_name='失败次数',
+        default=0,
+    )
+
+    overrun_count = models.IntegerField(
+        verbose_name='超时执行次数',
+        default=0,
+        help_text='锁超时被释放后才执行完毕的次数，期间可能有其他执行者重复执行',
+    )
+
+    traceback = models.TextField(
+        verbose_name='上次错误信息',
+        blank=True,
+        default='',
+    )
+
+    class Meta:
+        verbose_name = '周期任务'
+        verbose_name_plural = '周期任务'
+        db_table = 'base_cron_recurring_job'
+
+    def __str__(self):
+        return self.method
+
+    @staticmethod
+    def sync(jobs):
+        """ 按声明同步周期任务
+        :param jobs: [dict(method=..., interval=秒数) 或 dict(method=..., cron='分 时 日 月 周'), ...]
+        :return:
+        """
+        now = datetime.now()
+        existing = {job.method: job for job in RecurringJob.objects.filter(
+            method__in=[job['method'] for job in jobs],
+        )}
+        for config in jobs:
+            interval = config.get('interval')
+            cron = config.get('cron', '')
+            assert bool(interval) != bool(cron), '周期任务需要指定 interval 或 cron 其中之一'
+            job = existing.get(config['method'])
+            if job and job.interval == interval and job.cron == cron:
+                continue
+            job = job or RecurringJob(method=config['method'])
+            job.interval = interval
+            job.cron = cron
+            job.date_next = job.get_next(now) if cron else now
+            job.save()
+
+    @staticmethod
+    def run_due():
+        """ 执行所有到期的周期任务
+        :return: 执行的任务数
+        """
+        now = datetime.now()
+        # 执行者中途退出时释放锁
+        RecurringJob.objects.exclude(worker='').filter(
+            date_locked__lt=now - timedelta(seconds=PlannedTask.get_config('TIMEOUT', 600)),
+        ).update(worker='')
+        executed = 0
+        for job in RecurringJob.objects.filter(date_next__lte=now, worker='').order_by('date_next'):
+            if job.run():
+                executed += 1
+        return executed
+
+    def get_next(self, after):
+        """ 计划时间之后、after 之后的下一个周期 """
+        if self.cron:
+            return CronExpression(self.cron).get_next(after)
+        date_next = self.date_next or after
+        if date_next > after:
+            return date_next
+        periods = int((after - date_next).total_seconds() // self.interval) + 1
+        return date_next + timedelta(seconds=self.interval * periods)
+
+    def run(self):
+        """ 认领并执行一次，计划时间作为认领条件，保证每个周期只执行一次
+        :return: 是否由本次调用执行
+        """
+        worker = uuid4().hex
+        date_start = datetime.now()
+        if not RecurringJob.objects.filter(
+                pk=self.pk,
+                worker='',
+                date_next=self.date_next,
+        ).update(worker=worker, date_locked=date_start):
+            return False
+        time_start = time()
+        traceback_text = ''
+        try:
+            with keep_alive(RecurringJob.objects.filter(pk=self.pk, worker=worker), 'date_locked',
+                            PlannedTask.get_heartbeat()):
+                getattr(PlannedTask, self.method)()
+        except Exception as e:
+            import traceback
+            traceback_text = traceback.format_exc()
+        runtime = time() - time_start
+        if not RecurringJob.objects.filter(pk=self.pk, worker=worker).update(
+            worker='',
+            date_next=self.get_next(datetime.now()),
+            date_last_run=date_start,
+            last_lag=(date_start - self.date_next).total_seconds(),
+            last_runtime=runtime,
+            # 持有锁期间没有其他执行者，可以直接比较
+            max_runtime=max(self.max_runtime, runtime),
+            run_count=models.F('run_count') + 1,
+            fail_count=models.F('fail_count') + (1 if traceback_text else 0),
+            traceback=traceback_text,
+        ):
+            # 锁已超时被释放，可能有其他执行者正在执行，只累计统计，不改动锁和下次执行时间
+            RecurringJob.objects.filter(pk=self.pk).update(
+                max_runtime=Greatest(models.F('max_runtime'), runtime),
+                run_count=models.F('run_count') + 1,
+                fail_count=models.F('fail_count') + (1 if traceback_text else 0),
+                overrun_count=models.F('overrun_count') + 1,
+            )
+        return True
 
 
 class AdminLog(UserOwnedModel):
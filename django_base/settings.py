@@ -53,6 +53,9 @@ MIDDLEWARE = [
 
 ROOT_URLCONF = 'core.urls'
 
+# 每个测试开始前重置选项缓存
+TEST_RUNNER = 'django_base.testing.TestRunner'
+
 TEMPLATES = [
     {
         'BACKEND': 'django.template.backends.django.DjangoTemplates',
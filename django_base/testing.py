@@ -0,0 +1,62 @@
+""" 测试辅助 """
+from urllib.parse import urlparse
+
+from unittest import TextTestResult
+
+from django.db import connection
+from django.test.runner import DiscoverRunner
+from django.test.utils import CaptureQueriesContext
+from django.urls import resolve
+
+from .metrics import get_view_key
+from .models import OptionCache
+
+
+class OptionCacheResetResult:
+    """ 测试结果混入类，每个测试开始前重置进程内的选项缓存 """
+
+    def startTest(self, test):
+        OptionCache.reset()
+        super().startTest(test)
+
+
+class TestRunner(DiscoverRunner):
+    """ 测试运行器
+    TestCase 结束时回滚数据库，但 OptionCache 是进程内的类属性，不会随之回滚，
+    缓存的选项值和版本戳会带到下一个测试，因此每个测试开始前统一重置
+    """
+
+    def get_resultclass(self):
+        base = super().get_resultclass() or TextTestResult
+        return type('OptionCacheReset' + base.__name__, (OptionCacheResetResult, base), dict())
+
+
+class QueryBudgetMixin:
+    """ TestCase 混入类，断言接口的查询数不超过预算
+    预算按接口标识（ViewSet 类名.action，与 QueryMetricsMiddleware 一致）配置在 query_budgets 中，
+    出现 N+1 查询时数量随数据量增长，超出预算即测试失败
+    """
+    # 接口标识 => 最大查询数
+    query_budgets = dict()
+
+    def get_endpoint_key(self, path, method='get'):
+        return get_view_key(resolve(urlparse(path).path).func, method)
+
+    def assertQueryBudget(self, path, data=None, method='get', budget=None):
+        """ 请求接口并断言查询数
+        :param path: 接口路径
+        :param data: 请求参数
+        :param method: HTTP 方法
+        :param budget: 最大查询数，默认取 query_budgets 中的配置
+        :return: response
+        """
+        key = self.get_endpoint_key(path, method)
+        if budget is None:
+            budget = self.query_budgets[key]
+        with CaptureQueriesContext(connection) as context:
+            response = getattr(self.client, method)(path, data)
+        self.assertLess(response.status_code, 400, '{} 返回 {}'.format(key, response.status_code))
+        self.assertLessEqual(len(context), budget, '{} 执行了 {} 次查询，超出预算 {}：\n{}'.format(
+            key, len(context), budget, '\n'.join(query['sql'] for query in context.captured_queries),
+        ))
+        return response
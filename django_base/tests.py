@@ -1,4 +1,12 @@
-from django.test import TestCase
+from datetime import datetime, timedelta
+from time import sleep
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, TransactionTestCase, override_settings
+
+from . import timeseries
+from .metrics import Histogram, MetricsRegistry
+from .models import CronExpression, Message, Option, OptionCache, PlannedTask, RecurringJob, keep_alive
 
 
 class MemberTestCase(TestCase):
@@ -13,3 +21,161 @@ class ActivityTestCase(TestCase):
     def test_activity_settle(self):
         """ 活动结算测试 """
         pass
+
+
+class OptionTestCase(TestCase):
+    def setUp(self):
+        OptionCache.clear()
+
+    def test_option_cache(self):
+        """ 选项缓存及写入后失效 """
+        Option.set('level_rules', '{"level_1": []}')
+        self.assertEqual(Option.get('level_rules'), '{"level_1": []}')
+        hits = OptionCache.hits
+        self.assertEqual(Option.get('level_rules'), '{"level_1": []}')
+        self.assertEqual(OptionCache.hits, hits + 1)
+        self.assertIs(Option.get_json('level_rules'), Option.get_json('level_rules'))
+        Option.set('level_rules', '{"level_1": [1]}')
+        self.assertEqual(Option.get_json('level_rules'), {'level_1': [1]})
+        Option.unset('level_rules')
+        self.assertIsNone(Option.get('level_rules'))
+        self.assertEqual(Option.get_json('level_rules', []), [])
+
+    def test_option_cache_reset_between_tests(self):
+        """ 测试运行器在每个测试开始前重置选项缓存 """
+        from io import StringIO
+        from .testing import TestRunner
+        Option.set('level_rules', '{"level_1": []}')
+        Option.get('level_rules')
+        result = TestRunner().get_resultclass()(StringIO(), False, 0)
+        result.startTest(self)
+        self.assertIsNone(OptionCache.values)
+        self.assertIsNone(OptionCache.version)
+
+
+class PlannedTaskTestCase(TestCase):
+    def test_claim_once(self):
+        """ 同一任务只能被认领一次 """
+        for i in range(3):
+            PlannedTask.make('noop', datetime.now() - timedelta(minutes=1))
+        self.assertEqual(len(PlannedTask.claim(2)), 2)
+        self.assertEqual(len(PlannedTask.claim(10)), 1)
+        self.assertEqual(PlannedTask.claim(10), [])
+
+    @override_settings(PLANNED_TASK=dict(MAX_ATTEMPTS=2, RETRY_DELAY=60))
+    def test_retry(self):
+        """ 失败后按退避时间重新排队，超过次数后标记失败 """
+        PlannedTask.make('missing_method', datetime.now() - timedelta(minutes=1))
+        task = PlannedTask.objects.get()
+        self.assertFalse(task.exec())
+        self.assertEqual(task.status, PlannedTask.STATUS_PLANNED)
+        self.assertGreater(task.date_planned, datetime.now() + timedelta(seconds=50))
+        task.date_planned = datetime.now()
+        self.assertFalse(task.exec())
+        self.assertEqual(task.status, PlannedTask.STATUS_FAIL)
+
+    def test_lost_claim(self):
+        """ 认领超时被释放后才执行完毕，不覆盖新执行者的状态，留下可能重复执行的记录 """
+        PlannedTask.make('noop', datetime.now() - timedelta(minutes=1))
+        task, = PlannedTask.claim(1)
+        PlannedTask.objects.filter(pk=task.pk).update(worker='other')
+        with mock.patch.object(PlannedTask, 'noop', create=True):
+            self.assertTrue(task.exec())
+        task = PlannedTask.objects.get(pk=task.pk)
+        self.assertEqual(task.status, PlannedTask.STATUS_RUNNING)
+        self.assertEqual(task.worker, 'other')
+        self.assertIn('可能被重复执行', task.traceback)
+
+
+class KeepAliveTestCase(TransactionTestCase):
+    def test_refresh(self):
+        """ 执行期间定期刷新认领时间，释放超时任务时不会回收 """
+        PlannedTask.make('noop', datetime.now() - timedelta(minutes=1))
+        task, = PlannedTask.claim(1)
+        date_claimed = datetime.now() - timedelta(hours=1)
+        PlannedTask.objects.filter(pk=task.pk).update(date_claimed=date_claimed)
+        with keep_alive(PlannedTask.objects.filter(pk=task.pk), 'date_claimed', 0.05):
+            sleep(0.3)
+        self.assertGreater(PlannedTask.objects.get(pk=task.pk).date_claimed, date_claimed)
+        self.assertEqual(PlannedTask.release_timeout(), 0)
+
+
+class RecurringJobTestCase(SimpleTestCase):
+    def test_cron_expression(self):
+        self.assertEqual(CronExpression('0 4 * * *').get_next(datetime(2017, 10, 16, 4, 0)),
+                         datetime(2017, 10, 17, 4, 0))
+        self.assertEqual(CronExpression('*/15 * * * *').get_next(datetime(2017, 10, 16, 10, 7, 30)),
+                         datetime(2017, 10, 16, 10, 15))
+        self.assertEqual(CronExpression('0 5 * * 1').get_next(datetime(2017, 10, 15, 12, 0)),
+                         datetime(2017, 10, 16, 5, 0))
+
+    def test_interval_skips_missed_periods(self):
+        """ 错过的周期不补跑，下次执行时间对齐到原有节奏 """
+        job = RecurringJob(method='noop', interval=60, date_next=datetime(2017, 10, 16, 10, 0))
+        self.assertEqual(job.get_next(datetime(2017, 10, 16, 10, 3, 30)), datetime(2017, 10, 16, 10, 4))
+
+
+class RecurringJobRunTestCase(TestCase):
+    def test_lost_lock(self):
+        """ 锁超时被释放后才执行完毕，不改动其他执行者持有的锁，累计超时执行次数 """
+        job = RecurringJob.objects.create(method='noop', interval=60, date_next=datetime.now())
+
+        def lose_lock():
+            RecurringJob.objects.filter(pk=job.pk).update(worker='other')
+
+        with mock.patch.object(PlannedTask, 'noop', create=True, side_effect=lose_lock):
+            self.assertTrue(job.run())
+        job = RecurringJob.objects.get(pk=job.pk)
+        self.assertEqual(job.worker, 'other')
+        self.assertEqual(job.run_count, 1)
+        self.assertEqual(job.overrun_count, 1)
+
+
+class QueryMetricsTestCase(SimpleTestCase):
+    def test_histogram(self):
+        histogram = Histogram((1, 5, 10))
+        for value in (1, 3, 3, 8, 40):
+            histogram.observe(value)
+        self.assertEqual(histogram.counts, [1, 2, 1, 1])
+        self.assertEqual(histogram.quantile(0.5), 5)
+        self.assertEqual(histogram.quantile(0.99), 40)
+
+    def test_registry(self):
+        registry = MetricsRegistry()
+        registry.record('LiveViewSet.list', 12, 30.0, 80.0)
+        registry.record('LiveViewSet.list', 14, 20.0, 60.0)
+        registry.record('MemberViewSet.retrieve', 3, 2.0, 10.0)
+        snapshot = registry.snapshot()
+        self.assertEqual([item['endpoint'] for item in snapshot], ['LiveViewSet.list', 'MemberViewSet.retrieve'])
+        self.assertEqual(snapshot[0]['count'], 2)
+        self.assertEqual(snapshot[0]['queries']['avg'], 13)
+
+
+class TimeSeriesTestCase(TestCase):
+    def test_buckets(self):
+        """ 第一个桶从区间开始，最后一个桶截止到区间结束 """
+        buckets = timeseries.get_buckets(datetime(2017, 11, 15), datetime(2018, 2, 10), timeseries.GRANULARITY_MONTH)
+        self.assertEqual(buckets[0], (datetime(2017, 11, 15), datetime(2017, 12, 1)))
+        self.assertEqual(buckets[-1], (datetime(2018, 2, 1), datetime(2018, 2, 10)))
+        self.assertEqual(len(buckets), 4)
+        self.assertEqual(timeseries.get_label(
+            datetime(2018, 2, 1), datetime(2018, 2, 10), datetime(2018, 2, 10), timeseries.GRANULARITY_MONTH,
+        ), '2月1號 - 2月9號')
+
+    def test_chart_data(self):
+        """ 一次查询，空桶补 0 """
+        Message.objects.bulk_create([Message(content=str(i)) for i in range(4)])
+        for message, date in zip(Message.objects.order_by('id'), [
+            datetime(2018, 1, 1, 8), datetime(2018, 1, 1, 20), datetime(2018, 1, 3), datetime(2018, 1, 9),
+        ]):
+            Message.objects.filter(id=message.id).update(date_created=date)
+        with self.assertNumQueries(1):
+            data = timeseries.get_chart_data(
+                Message.objects.all(), 'date_created', datetime(2018, 1, 1), datetime(2018, 1, 5),
+            )
+        self.assertEqual(data['amounts'], [2, 0, 1, 0])
+        self.assertEqual(data['labels'][0], '1月1號')
+        data = timeseries.get_chart_data(
+            Message.objects.all(), 'date_created', datetime(2018, 1, 1), datetime(2018, 3, 1),
+        )
+        self.assertEqual(data['amounts'][:2], [3, 1])
@@ -0,0 +1,129 @@
+""" 按时间分桶的统计
+
+把 (查询集, 时间字段, 区间, 粒度) 转换为一条带日期截断的 GROUP BY 查询，
+数据库只返回有数据的桶，空桶在 Python 中补 0；
+一年的按日统计只需要一次查询，而不是 365 次 COUNT。
+
+周不是数据库的截断单位，按日分组后再在 Python 中合并到以区间开始日为起点的周；
+区间开始不在桶的边界上时，第一个桶从区间开始算起，最后一个桶截止到区间结束。
+"""
+from bisect import bisect_right
+from datetime import date, datetime, timedelta
+
+from django.db import models
+from django.db.models.functions import TruncDay, TruncHour, TruncMonth, TruncYear
+
+GRANULARITY_HOUR = 'HOUR'
+GRANULARITY_DAY = 'DAY'
+GRANULARITY_WEEK = 'WEEK'
+GRANULARITY_MONTH = 'MONTH'
+GRANULARITY_YEAR = 'YEAR'
+
+TRUNCATE_FUNCTIONS = {
+    GRANULARITY_HOUR: TruncHour,
+    GRANULARITY_DAY: TruncDay,
+    GRANULARITY_WEEK: TruncDay,
+    GRANULARITY_MONTH: TruncMonth,
+    GRANULARITY_YEAR: TruncYear,
+}
+
+
+def get_next_start(dt, granularity):
+    """ dt 所在桶的下一个桶的开始时间 """
+    if granularity == GRANULARITY_HOUR:
+        return datetime(dt.year, dt.month, dt.day, dt.hour) + timedelta(hours=1)
+    if granularity == GRANULARITY_DAY:
+        return datetime(dt.year, dt.month, dt.day) + timedelta(days=1)
+    if granularity == GRANULARITY_WEEK:
+        return datetime(dt.year, dt.month, dt.day) + timedelta(days=7)
+    if granularity == GRANULARITY_MONTH:
+        return datetime(dt.year + 1, 1, 1) if dt.month == 12 else datetime(dt.year, dt.month + 1, 1)
+    if granularity == GRANULARITY_YEAR:
+        return datetime(dt.year + 1, 1, 1)
+    raise ValueError('不支持的粒度：{}'.format(granularity))
+
+
+def get_buckets(begin, end, granularity):
+    """ 区间内的桶
+    :param begin: 区间开始（包含）
+    :param end: 区间结束（不包含）
+    :param granularity: 粒度
+    :return: [(桶开始, 桶结束), ...]
+    """
+    buckets = []
+    start = begin
+    while start < end:
+        stop = min(get_next_start(start, granularity), end)
+        buckets.append((start, stop))
+        start = stop
+    return buckets
+
+
+def aggregate_series(queryset, field, begin, end, granularity, value=None):
+    """ 按时间分桶聚合，只执行一次查询
+    :param queryset: 需要统计的查询集，可以已经带有其他过滤条件
+    :param field: 时间字段，可以跨关系，例如 live__date_created
+    :param begin: 区间开始（包含）
+    :param end: 区间结束（不包含）
+    :param granularity: 粒度，GRANULARITY_*
+    :param value: 聚合表达式，默认为记录数
+    :return: [(桶开始, 桶结束, 聚合值), ...]，没有数据的桶为 0
+    """
+    buckets = get_buckets(begin, end, granularity)
+    starts = [start for start, stop in buckets]
+    values = [0] * len(buckets)
+    rows = queryset.filter(**{
+        '{}__gte'.format(field): begin,
+        '{}__lt'.format(field): end,
+    }).annotate(
+        bucket=TRUNCATE_FUNCTIONS[granularity](field),
+    ).order_by().values('bucket').annotate(
+        amount=value or models.Count('pk'),
+    ).values_list('bucket', 'amount')
+    for bucket, amount in rows:
+        if type(bucket) is date:
+            bucket = datetime(bucket.year, bucket.month, bucket.day)
+        # 截断后的时间可能早于区间开始，计入第一个桶
+        index = max(bisect_right(starts, bucket) - 1, 0)
+        values[index] += amount or 0
+    return [(start, stop, values[i]) for i, (start, stop) in enumerate(buckets)]
+
+
+def get_granularity(begin, end):
+    """ 按区间长度选择图表的粒度：一个月内按日，两个月内按周，一年内按月，更长按年 """
+    days = (end - begin).days
+    if days <= 31:
+        return GRANULARITY_DAY
+    if days <= 62:
+        return GRANULARITY_WEEK
+    if days <= 366:
+        return GRANULARITY_MONTH
+    return GRANULARITY_YEAR
+
+
+def get_label(start, stop, end, granularity):
+    """ 图表的桶标签，截止到区间结束的桶显示区间的最后一天 """
+    if granularity == GRANULARITY_HOUR:
+        return '{:0>2d}:00 - {:0>2d}:00'.format(start.hour, start.hour + 1)
+    if granularity == GRANULARITY_DAY:
+        return '{}月{}號'.format(start.month, start.day)
+    if granularity == GRANULARITY_YEAR:
+        return '{}年'.format(start.year)
+    if stop >= end:
+        stop = end - timedelta(days=1)
+    return '{}月{}號 - {}月{}號'.format(start.month, start.day, stop.month, stop.day)
+
+
+def get_chart_data(queryset, field, begin, end, granularity=None, value=None):
+    """ 后台图表数据
+    :param begin: 区间开始
+    :param end: 区间结束（不包含），按日期选择时传入最后一天的次日
+    :param granularity: 粒度，默认按区间长度选择
+    :return: dict(labels=[...], amounts=[...])
+    """
+    granularity = granularity or get_granularity(begin, end - timedelta(days=1))
+    series = aggregate_series(queryset, field, begin, end, granularity, value)
+    return dict(
+        labels=[get_label(start, stop, end, granularity) for start, stop, amount in series],
+        amounts=[amount for start, stop, amount in series],
+    )
@@ -16,6 +16,7 @@ INSTALLED_APPS += [
 ]
 
 MIDDLEWARE += [
+    'django_base.middleware.QueryMetricsMiddleware',
 ]
 
 WSGI_APPLICATION = 'wecanlive.wsgi.application'
@@ -32,6 +33,39 @@ CRON_CLASSES = [
     'core.cron.AutomaticShelvesCronJob',
 ]
 
+# 计划任务执行器，说明见 django_base.models.PlannedTask.get_config
+PLANNED_TASK = dict(
+    WORKERS=4,
+    POOL='thread',
+    MAX_ATTEMPTS=3,
+    RETRY_DELAY=30,
+    CONCURRENCY=dict(
+        update_rank_record=1,
+        update_live_hot_ranking=1,
+    ),
+    RETENTION_DAYS=7,
+    FAIL_RETENTION_DAYS=30,
+)
+
+# =========== Leaderboard =================
+
+# 实时排行榜后端：sql / memory / redis
+LEADERBOARD_BACKEND = 'sql'
+# LEADERBOARD_REDIS_URL = 'redis://localhost:6379/0'
+
+# =========== Live Presence =================
+
+# 观众心跳超时（秒），批量写回心跳的间隔，多进程之间从数据库同步的间隔
+PRESENCE_TTL = 360
+PRESENCE_FLUSH_INTERVAL = 60
+PRESENCE_SYNC_INTERVAL = 60
+
+# =========== Query Metrics =================
+
+# 按接口统计查询数和耗时，结果见 /api/request_metric/，采样比例为 0~1
+QUERY_METRICS_ENABLED = False
+QUERY_METRICS_SAMPLE_RATE = 1
+
 # =============== SMS Config ===================
 
 SMS_APPKEY = '23405490'